@@ -2,8 +2,73 @@ class BCFunc:
     @staticmethod
     def get_barcodes(bcfile):
         namedir = []
-        BCname = open(bcfile, "r+")
-        for i in BCname:
-            if i.rstrip("\n") != '':
-                namedir.append(i.rstrip("\n"))
-        return namedir
\ No newline at end of file
+        with open(bcfile, "r") as BCname:
+            for i in BCname:
+                if i.rstrip("\n") != '':
+                    namedir.append(i.rstrip("\n"))
+        return namedir
+
+    @staticmethod
+    def build_index(bcfile, max_mismatch=1):
+        return BarcodeIndex(BCFunc.get_barcodes(bcfile), max_mismatch=max_mismatch)
+
+
+class BarcodeIndex:
+    """
+    Hash index over a barcode whitelist.
+
+    Every whitelisted barcode maps to itself, and (when max_mismatch is 1)
+    every sequence at Hamming distance 1 from exactly one barcode maps to
+    that barcode. Neighbours shared by two or more barcodes are dropped, so a
+    single dict lookup either returns the corrected barcode or None.
+    """
+
+    ALPHABET = "ACGTN"
+
+    def __init__(self, barcodes, max_mismatch=1):
+        if max_mismatch not in (0, 1):
+            raise ValueError("max_mismatch must be 0 or 1")
+        self.barcodes = list(dict.fromkeys(barcodes))
+        self.max_mismatch = max_mismatch
+        self.table = {bc: bc for bc in self.barcodes}
+        self.n_ambiguous = 0
+        self._byte_table = None
+        if max_mismatch:
+            self._add_neighbours()
+
+    def _add_neighbours(self):
+        owners = {}
+        for bc in self.barcodes:
+            for i, base in enumerate(bc):
+                prefix, suffix = bc[:i], bc[i + 1:]
+                for sub in self.ALPHABET:
+                    if sub == base:
+                        continue
+                    owners.setdefault(prefix + sub + suffix, set()).add(bc)
+        for seq, bcs in owners.items():
+            if seq in self.table:
+                # An exact whitelist entry always wins over a corrected one.
+                continue
+            if len(bcs) == 1:
+                self.table[seq] = next(iter(bcs))
+            else:
+                self.n_ambiguous += 1
+
+    @property
+    def byte_table(self):
+        """The same table keyed and valued by ASCII bytes, built on first use."""
+        if self._byte_table is None:
+            self._byte_table = {k.encode(): v.encode() for k, v in self.table.items()}
+        return self._byte_table
+
+    def lookup(self, seq):
+        return self.table.get(seq)
+
+    def __contains__(self, seq):
+        return seq in self.table
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    def __iter__(self):
+        return iter(self.barcodes)
@@ -0,0 +1,223 @@
+# annotation.py
+"""
+Gene annotation index and built-in gene assigner (--assigner builtin).
+
+GeneIndex parses the GTF once: exon lines are merged per gene and stored per
+chromosome as array-backed, start-sorted intervals (starts, ends, gene
+numbers and a running maximum of ends for overlap queries). The index is
+pickled next to the GTF as <gtf>.<key>.geneidx, so later runs skip the
+parse while the GTF is unchanged. The key hashes the GTF's path, size and
+mtime rather than its content, so finding the cache costs a stat() and
+not a read of a GTF of a GB or more, in every shard.
+
+GeneAssigner reproduces featureCounts' defaults as used by the pipeline
+(-t exon -g gene_id, unstranded, at least 1 bp overlap, no multi-overlap
+counting): an alignment whose aligned blocks overlap exons of exactly one
+gene is Assigned to it, several genes give Unassigned_Ambiguity, none
+Unassigned_NoFeatures. Reads are tagged with the same XS/XT tags, so the
+counters downstream work unchanged, but no second BAM has to be written.
+"""
+
+import gzip
+import hashlib
+import os
+import pickle
+import re
+import subprocess
+from array import array
+from bisect import bisect_right
+
+INDEX_VERSION = 1
+GENE_ID = re.compile(r'gene_id "([^"]+)"')
+CIGAR = re.compile(rb"(\d+)([MIDNSHP=X])")
+# CIGAR operations that consume the reference inside an aligned block; N
+# (a splice junction) ends the block.
+BLOCK_OPS = {b"M", b"D", b"=", b"X"}
+
+STATUSES = ["Assigned", "Unassigned_Unmapped", "Unassigned_MultiMapping",
+            "Unassigned_NoFeatures", "Unassigned_Ambiguity"]
+
+
+def cache_key(path):
+    """Hash of path's absolute path, size and mtime (ns)."""
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}\0{st.st_size}\0{st.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def cache_path(gtf):
+    return f"{gtf}.{cache_key(gtf)[:16]}.geneidx"
+
+
+class GeneIndex:
+    def __init__(self, genes, chroms):
+        self.genes = genes
+        # chrom -> (starts, ends, gene numbers, running max of ends), 1-based
+        # inclusive coordinates as in the GTF.
+        self.chroms = chroms
+
+    @classmethod
+    def from_gtf(cls, gtf, feature="exon"):
+        exons = {}
+        genes, gene_number = [], {}
+        opener = gzip.open if gtf.endswith(".gz") else open
+        with opener(gtf, "rt") as handle:
+            for line in handle:
+                if line.startswith("#"):
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 9 or fields[2] != feature:
+                    continue
+                match = GENE_ID.search(fields[8])
+                if match is None:
+                    continue
+                gene = match.group(1)
+                number = gene_number.get(gene)
+                if number is None:
+                    number = gene_number[gene] = len(genes)
+                    genes.append(gene)
+                exons.setdefault(fields[0], []).append((number, int(fields[3]), int(fields[4])))
+
+        chroms = {}
+        for chrom, rows in exons.items():
+            # Merge overlapping exons of the same gene, then sort by start.
+            merged = []
+            for number, start, end in sorted(rows):
+                if merged and merged[-1][0] == number and start <= merged[-1][2] + 1:
+                    if end > merged[-1][2]:
+                        merged[-1][2] = end
+                else:
+                    merged.append([number, start, end])
+            merged.sort(key=lambda row: row[1])
+            starts, ends, numbers, max_ends = array("q"), array("q"), array("i"), array("q")
+            running = 0
+            for number, start, end in merged:
+                starts.append(start)
+                ends.append(end)
+                numbers.append(number)
+                running = max(running, end)
+                max_ends.append(running)
+            chroms[chrom] = (starts, ends, numbers, max_ends)
+        return cls(genes, chroms)
+
+    @classmethod
+    def load(cls, gtf, cache=True):
+        """Load the cached index for gtf, building (and caching) it if needed."""
+        if not cache:
+            return cls.from_gtf(gtf)
+        path = cache_path(gtf)
+        if os.path.exists(path):
+            try:
+                with open(path, "rb") as handle:
+                    data = pickle.load(handle)
+                if data.get("version") == INDEX_VERSION:
+                    return cls(data["genes"], data["chroms"])
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+                pass
+            print(f"[Warning] Ignoring unreadable gene index {path}")
+        print(f"[Info] Building gene index from {gtf}...")
+        index = cls.from_gtf(gtf)
+        try:
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as handle:
+                pickle.dump({"version": INDEX_VERSION, "genes": index.genes, "chroms": index.chroms},
+                            handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+            print(f"[Info] Cached gene index as {path}")
+        except OSError as e:
+            print(f"[Warning] Could not cache the gene index next to the GTF: {e}")
+        return index
+
+    def overlapping(self, chrom, start, end, found):
+        """Add the numbers of genes with an exon overlapping [start, end] to found."""
+        intervals = self.chroms.get(chrom)
+        if intervals is None:
+            return
+        starts, ends, numbers, max_ends = intervals
+        i = bisect_right(starts, end) - 1
+        while i >= 0 and max_ends[i] >= start:
+            if ends[i] >= start:
+                found.add(numbers[i])
+            i -= 1
+
+
+def aligned_blocks(pos, cigar):
+    """Yield the reference (start, end) of each aligned block, 1-based inclusive."""
+    start = ref = pos
+    for length, op in CIGAR.findall(cigar):
+        if op in BLOCK_OPS:
+            ref += int(length)
+        elif op == b"N":
+            if ref > start:
+                yield start, ref - 1
+            ref += int(length)
+            start = ref
+    if ref > start:
+        yield start, ref - 1
+
+
+class GeneAssigner:
+    """Assign SAM alignments to genes; counts statuses like featureCounts' .summary."""
+
+    def __init__(self, index):
+        self.index = index
+        self.genes = [gene.encode() for gene in index.genes]
+        self.summary = dict.fromkeys(STATUSES, 0)
+
+    def assign(self, fields):
+        """Return (status, gene bytes or None) for a split SAM line."""
+        if int(fields[1]) & 0x4:
+            status, gene = "Unassigned_Unmapped", None
+        elif any(tag.startswith(b"NH:i:") and int(tag[5:]) > 1 for tag in fields[11:]):
+            status, gene = "Unassigned_MultiMapping", None
+        else:
+            found = set()
+            chrom = fields[2].decode()
+            for start, end in aligned_blocks(int(fields[3]), fields[5]):
+                self.index.overlapping(chrom, start, end, found)
+            if len(found) == 1:
+                status, gene = "Assigned", self.genes[found.pop()]
+            else:
+                status = "Unassigned_Ambiguity" if found else "Unassigned_NoFeatures"
+                gene = None
+        self.summary[status] += 1
+        return status, gene
+
+    def tag(self, line):
+        """Return the SAM line (bytes) with XS/XT tags added like featureCounts -R BAM."""
+        if line[:1] == b"@":
+            return line
+        fields = line.rstrip(b"\n").split(b"\t")
+        status, gene = self.assign(fields)
+        fields.append(b"XS:Z:" + status.encode())
+        if gene is not None:
+            fields.append(b"XT:Z:" + gene)
+        return b"\t".join(fields) + b"\n"
+
+    def write_summary(self, path, bam_path):
+        with open(path, "w") as out:
+            out.write(f"Status\t{bam_path}\n")
+            for status in STATUSES:
+                out.write(f"{status}\t{self.summary[status]}\n")
+
+
+def tag_bam(in_bam, out_bam, assigner, samtools="samtools", threads=1):
+    """
+    Write in_bam to out_bam with XS/XT tags, for umi_tools. This still
+    rewrites the BAM, but skips featureCounts' GTF parse.
+    """
+    extra = ["-@", str(int(threads) - 1)] if int(threads) > 1 else []
+    reader = subprocess.Popen([samtools, "view", "-h"] + extra + [in_bam], stdout=subprocess.PIPE,
+                              bufsize=1 << 20)
+    writer = subprocess.Popen([samtools, "view", "-b"] + extra + ["-o", out_bam, "-"],
+                              stdin=subprocess.PIPE, bufsize=1 << 20)
+    try:
+        tag = assigner.tag
+        for line in reader.stdout:
+            writer.stdin.write(tag(line))
+    finally:
+        reader.stdout.close()
+        writer.stdin.close()
+        codes = reader.wait(), writer.wait()
+    if any(codes):
+        raise RuntimeError(f"samtools failed while tagging {in_bam} (exit codes {codes})")
@@ -0,0 +1,279 @@
+# batch.py
+"""
+Batch mode: run every R1/R2 pair in a read folder through the pipeline.
+
+Samples are paired by the file name prefix in front of the _1/_2 read token.
+Files that differ only in a lane token (_L001, _L002, ...) are one sample
+sequenced on several lanes; they are read back to back (fastq_io.LaneReader).
+Each sample gets its own output subdirectory and Druglog.txt, and its
+stages run in child processes under a scheduler that knows the core and
+memory budget: transform steps run side by side, and STAR jobs are only
+started while their genome memory fits, which caps concurrent alignments.
+With --disk-budget-gb a sample also reserves its estimated peak disk use
+(lifecycle.estimate_peak_bytes) for as long as it runs.
+"""
+
+import glob
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager, nullcontext
+
+from .countUMI import CountUMI
+from .fastq_io import lane_paths
+from .genome_load import GenomeResidency
+from .lifecycle import estimate_peak_bytes
+from .resources import GB, TRANSFORM_MEMORY_GB, ResourcePlan
+
+_READ1_TOKEN = re.compile(r"_(R?)1(?=[_.])")
+_LANE_TOKEN = re.compile(r"_L0*(\d+)(?=_|$)")
+
+
+def pair_samples(read_folder):
+    """
+    Pair every *_1*.gz or *_R1*.gz file in read_folder with its *_2*.gz or
+    *_R2*.gz mate, so Illumina names such as A_S1_L001_R1_001.fastq.gz pair too.
+
+    Returns a sorted list of (sample, fq1, fq2); the sample name is the file
+    name up to the read token, e.g. LJQ-2_L3_801 for LJQ-2_L3_801_1.fastq.gz.
+    When several pairs differ only in their lane token, e.g. A_L001_1.fq.gz
+    and A_L002_1.fq.gz, they become one sample (A) whose fq1 and fq2 are the
+    lists of lane files in lane order.
+    """
+    fq2_candidates = _glob_reads(read_folder, "2")
+    samples = []
+    seen = {}
+    for fq1 in sorted(_glob_reads(read_folder, "1")):
+        name = os.path.basename(fq1)
+        # The rightmost token whose mate exists wins, so "A_1_S1_1.fq.gz"
+        # pairs with "A_1_S1_2.fq.gz".
+        for match in reversed(list(_READ1_TOKEN.finditer(name))):
+            mate = name[:match.start()] + "_" + match.group(1) + "2" + name[match.end():]
+            fq2 = os.path.join(os.path.dirname(fq1), mate)
+            if fq2 in fq2_candidates:
+                sample = name[:match.start()]
+                if sample in seen:
+                    raise ValueError(f"Sample name '{sample}' is shared by {seen[sample]} and {fq1}")
+                seen[sample] = fq1
+                samples.append((sample, fq1, fq2))
+                break
+    return _merge_lanes(samples)
+
+
+def _glob_reads(read_folder, read):
+    return set(glob.glob(os.path.join(read_folder, f"*_{read}*.gz"))
+               + glob.glob(os.path.join(read_folder, f"*_R{read}*.gz")))
+
+
+def _merge_lanes(samples):
+    lanes = {}
+    for sample, fq1, fq2 in samples:
+        match = list(_LANE_TOKEN.finditer(sample))
+        if match:
+            key = sample[:match[-1].start()] + sample[match[-1].end():]
+            lanes.setdefault(key, []).append((int(match[-1].group(1)), sample, fq1, fq2))
+    merged = {}
+    for key, group in lanes.items():
+        if len(group) > 1 and key not in {sample for sample, _, _ in samples}:
+            group.sort()
+            merged.update((sample, key) for _, sample, _, _ in group)
+            samples.append((key, [fq1 for _, _, fq1, _ in group], [fq2 for _, _, _, fq2 in group]))
+    return sorted((s for s in samples if s[0] not in merged), key=lambda s: s[0])
+
+
+class ResourcePool:
+    """Blocking counter of free cores, memory and disk shared by sample threads."""
+
+    def __init__(self, cores, memory_gb, disk_gb=None):
+        self.cores = cores
+        self.memory_gb = memory_gb
+        # None: no disk budget
+        self.disk_gb = disk_gb
+        self._free_cores = cores
+        self._free_memory = memory_gb
+        self._free_disk = disk_gb or 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, cores, memory_gb, disk_gb=0):
+        # A request larger than the whole budget would wait forever; it is
+        # clamped so that it runs alone instead.
+        cores = min(cores, self.cores)
+        memory_gb = min(memory_gb, self.memory_gb)
+        disk_gb = min(disk_gb, self.disk_gb) if self.disk_gb else 0
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._free_cores >= cores and self._free_memory >= memory_gb
+                and self._free_disk >= disk_gb
+            )
+            self._free_cores -= cores
+            self._free_memory -= memory_gb
+            self._free_disk -= disk_gb
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._free_cores += cores
+                self._free_memory += memory_gb
+                self._free_disk += disk_gb
+                self._cond.notify_all()
+
+
+def _child_main(log_path, workdir, func, args):
+    # Each stage writes only to its sample's log and runs inside the sample
+    # directory, so concurrent samples never share output or a cwd.
+    log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    os.chdir(workdir)
+    try:
+        func(*args)
+    except BaseException:
+        traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(1)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+def run_in_child(log_path, workdir, func, *args):
+    ctx = multiprocessing.get_context("spawn")
+    proc = ctx.Process(target=_child_main, args=(log_path, workdir, func, args))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError(f"exit code {proc.exitcode}, see {log_path}")
+
+
+def _transform_stage(options, plan, fq1, fq2, sample_dir, sample, bc_index, stream_star):
+    from .main import run_all_steps, run_transform_step
+    count_umi = CountUMI.from_options(options, plan)
+    log_filename = os.path.join(sample_dir, "Druglog.txt")
+    if stream_star:
+        run_all_steps(options, fq1, fq2, sample_dir, bc_index, count_umi, sample,
+                      True, log_filename)
+    else:
+        run_transform_step(options, fq1, fq2, sample_dir, bc_index, count_umi, sample,
+                           False, log_filename)
+
+
+def _count_stage(options, plan, sample_dir, sample, fq1, fq2, bc_index):
+    from .main import run_count_step
+    count_umi = CountUMI.from_options(options, plan)
+    # With --step all the transform child already recorded this sample's
+    # disk use, and its outputs can be recreated if they were released.
+    if options.step == "all":
+        run_count_step(options, count_umi, sample_dir, sample, False,
+                       os.path.join(sample_dir, "Druglog.txt"), fq1, fq2, bc_index, True)
+    else:
+        run_count_step(options, count_umi, sample_dir, sample, False,
+                       os.path.join(sample_dir, "Druglog.txt"))
+
+
+class BatchScheduler:
+    def __init__(self, options, bc_index, plan):
+        self.options = options
+        self.bc_index = bc_index
+        self.plan = plan
+        self.pool = ResourcePool(plan.cores, plan.memory_gb, options.disk_budget_gb)
+        self.star_memory_gb = plan.star_memory_gb
+        self.star_threads = plan.star_threads
+        self.transform_cores = plan.transform_workers + 1
+        self.transform_memory_gb = TRANSFORM_MEMORY_GB * plan.transform_workers
+        self.results = {}
+
+    def _run_sample(self, sample, fq1, fq2):
+        options = self.options
+        sample_dir = os.path.abspath(os.path.join(options.output, sample))
+        os.makedirs(sample_dir, exist_ok=True)
+        log_path = os.path.join(sample_dir, "Druglog.txt")
+        fq1 = [os.path.abspath(path) for path in lane_paths(fq1)]
+        fq2 = [os.path.abspath(path) for path in lane_paths(fq2)]
+        stream_star = options.stream_star and options.step == "all" and options.shards == 1
+        disk_gb = estimate_peak_bytes(fq1 + fq2, release=not options.keep_temp_files) / GB
+        start = time.time()
+        try:
+            with self.pool.reserve(0, 0, disk_gb):
+                self._run_steps(sample, sample_dir, log_path, fq1, fq2, stream_star)
+            self.results[sample] = ("ok", time.time() - start, log_path)
+            print(f"[Info] {sample}: finished in {time.time() - start:.0f}s")
+        except Exception as e:
+            self.results[sample] = (f"failed ({e})", time.time() - start, log_path)
+            print(f"[Error] {sample}: {e}")
+
+    def _run_steps(self, sample, sample_dir, log_path, fq1, fq2, stream_star):
+        options = self.options
+        if options.step in ["all", "transform"]:
+            cores, memory = self.transform_cores, self.transform_memory_gb
+            if stream_star:
+                cores += self.star_threads
+                memory += self.star_memory_gb
+            with self.pool.reserve(cores, memory):
+                print(f"[Info] {sample}: transform started")
+                run_in_child(log_path, sample_dir, _transform_stage, options, self.plan, fq1, fq2,
+                             sample_dir, sample, self.bc_index, stream_star)
+        if options.step in ["all", "count"] and not stream_star:
+            with self.pool.reserve(self.star_threads, self.star_memory_gb):
+                print(f"[Info] {sample}: count started")
+                run_in_child(log_path, sample_dir, _count_stage, options, self.plan,
+                             sample_dir, sample, fq1, fq2, self.bc_index)
+        if not options.keep_temp_files:
+            from .main import cleanup_folder
+            cleanup_folder(sample_dir)
+
+    def run(self, samples):
+        threads = [
+            threading.Thread(target=self._run_sample, args=sample, name=sample[0])
+            for sample in samples
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.results
+
+
+# Path options a stage opens after _child_main has changed into the sample
+# directory; relative values are resolved against the caller's cwd first.
+_PATH_OPTIONS = ("readFolder", "barcode", "output", "gtfname", "genomedir", "shard_queue")
+
+
+def run_batch(options, samples, bc_index):
+    for name in _PATH_OPTIONS:
+        value = getattr(options, name, None)
+        if value:
+            setattr(options, name, os.path.abspath(value))
+    # With a shared genome the index is paid for once, up front; each STAR
+    # job then only needs its BAM sorting buffer (see ResourcePlan).
+    shared = options.shared_genome and options.step in ["all", "count"]
+    plan = ResourcePlan.from_options(options, parallel=len(samples), shared=shared)
+    print(f"[Info] Batch mode: {len(samples)} samples, {plan.cores} cores, "
+          f"{plan.memory_gb:.1f} GB memory, {plan.star_memory_gb:.1f} GB per STAR job")
+    print(f"[Info] Resource plan: {plan}")
+    os.makedirs(options.output, exist_ok=True)
+    residency = nullcontext()
+    if shared:
+        residency = GenomeResidency(options.genomedir,
+                                    log_filename=os.path.join(options.output, "genome_load.log"))
+    scheduler = BatchScheduler(options, bc_index, plan)
+    with residency:
+        results = scheduler.run(samples)
+
+    print("-----------------Batch summary-----------------")
+    failed = []
+    for sample, _, _ in samples:
+        status, elapsed, log_path = results[sample]
+        print(f"{sample}\t{status}\t{elapsed:.0f}s\t{log_path}")
+        if status != "ok":
+            failed.append(sample)
+    if shared:
+        print(f"Genome load: {residency.load_seconds:.1f}s, unload: {residency.unload_seconds:.1f}s")
+    if failed:
+        raise RuntimeError(f"{len(failed)} sample(s) failed: {', '.join(failed)}")
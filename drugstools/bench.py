@@ -0,0 +1,301 @@
+# bench.py
+"""
+Offline benchmark harness.
+
+    python -m drugstools.bench --reads 100000,1000000 --whitelist 96,384 \\
+        --error-rate 0,0.1 --out bench.json [--count [--assigner builtin]] [--compare old.json]
+
+For every combination of the comma-separated dimensions (read count,
+whitelist size, linker rate, barcode error rate, UMI length) synthetic
+paired FASTQ is generated (synthetic.py, not timed) and the best of
+--repeat runs is recorded for:
+
+- barcodes: BCFunc.get_barcodes on the whitelist file
+- index: BarcodeIndex construction with single-mismatch neighbours
+- transform: Transformer.transform from the gzipped files
+- with --count, every pipeline stage (pipeline.SamplePipeline) against stub
+  STAR/featureCounts/samtools/umi_tools executables, taken from
+  run_metrics.json. The stubs only pass reads through, so these numbers
+  measure the pipeline's own Python work (native UMI counting, metrics,
+  manifests), not the real tools.
+
+Results go to a JSON file; --compare prints the speed ratio against a
+previous file for every matching benchmark.
+"""
+
+import itertools
+import json
+import os
+import platform
+import shutil
+import stat
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from .BCfunc import BCFunc, BarcodeIndex
+from .fastq_io import open_fastq
+from .synthetic import random_barcodes, write_gtf, write_pair, write_whitelist
+from .transformer import Transformer
+
+STUB_TOOLS = {
+    "STAR": '''
+import gzip, sys, zlib
+args = sys.argv[1:]
+if "--version" in args:
+    print("STAR-stub"); sys.exit(0)
+infile = args[args.index("--readFilesIn") + 1]
+prefix = args[args.index("--outFileNamePrefix") + 1]
+opener = gzip.open if infile.endswith(".gz") else open
+n = 0
+with opener(infile, "rt") as fq, open(prefix + "Aligned.sortedByCoord.out.bam", "w") as out:
+    out.write("@HD\\tVN:1.6\\n")
+    for header in fq:
+        seq, _, qual = next(fq).strip(), next(fq), next(fq).strip()
+        n += 1
+        pos = zlib.crc32(seq.encode()) % 100000 + 1
+        out.write("\\t".join([header[1:].split()[0], "0", "chr1", str(pos), "255",
+                             f"{len(seq)}M", "*", "0", "0", seq, qual, "NH:i:1"]) + "\\n")
+with open(prefix + "Log.final.out", "w") as log:
+    log.write(f"                          Number of input reads |\\t{n}\\n")
+''',
+    "featureCounts": '''
+import os, sys, zlib
+args = sys.argv[1:]
+if "-v" in args:
+    print("featureCounts v0-stub", file=sys.stderr); sys.exit(0)
+out, rpath, bam = args[args.index("-o") + 1], args[args.index("--Rpath") + 1], args[-1]
+counts = {"Assigned": 0, "Unassigned_NoFeatures": 0}
+with open(bam) as sam, open(os.path.join(rpath, os.path.basename(bam) + ".featureCounts.bam"), "w") as annotated:
+    for line in sam:
+        if line.startswith("@"):
+            annotated.write(line); continue
+        fields = line.rstrip("\\n").split("\\t")
+        gene = zlib.crc32(fields[9].encode()) % 200
+        if gene % 10 == 0:
+            status, tags = "Unassigned_NoFeatures", ["XS:Z:Unassigned_NoFeatures"]
+        else:
+            status, tags = "Assigned", ["XS:Z:Assigned", f"XT:Z:GENE{gene}"]
+        counts[status] += 1
+        annotated.write("\\t".join(fields + tags) + "\\n")
+with open(out, "w") as table:
+    table.write("Geneid\\tcounts\\n")
+with open(out + ".summary", "w") as summary:
+    summary.write("Status\\t" + bam + "\\n")
+    for status, n in counts.items():
+        summary.write(f"{status}\\t{n}\\n")
+''',
+    "samtools": '''
+import shutil, sys
+args = sys.argv[1:]
+if args[0] == "--version":
+    print("samtools stub")
+elif args[0] == "view":
+    sam = sys.stdin if args[-1] == "-" else open(args[-1])
+    out = open(args[args.index("-o") + 1], "w") if "-o" in args else sys.stdout
+    for line in sam:
+        if "-h" in args or "-o" in args or not line.startswith("@"):
+            out.write(line)
+elif args[0] == "sort":
+    shutil.copy(args[args.index("-o") - 1], args[args.index("-o") + 1])
+elif args[0] == "index":
+    open(args[-1] + ".bai", "w").close()
+''',
+    "umi_tools": '''
+import gzip, sys
+args = sys.argv[1:]
+if "--version" in args:
+    print("UMI-tools version: stub"); sys.exit(0)
+umis = {}
+with open(args[args.index("-I") + 1]) as sam:
+    for line in sam:
+        if line.startswith("@") or "XS:Z:Assigned" not in line:
+            continue
+        fields = line.rstrip("\\n").split("\\t")
+        gene = [t[5:] for t in fields[11:] if t.startswith("XT:Z:")][0]
+        _, cell, umi = fields[0].rsplit("_", 2)
+        umis.setdefault(gene, {}).setdefault(cell, set()).add(umi)
+cells = sorted({c for row in umis.values() for c in row})
+with gzip.open(args[args.index("-S") + 1], "wt") as out:
+    out.write("gene\\t" + "\\t".join(cells) + "\\n")
+    for gene in sorted(umis):
+        out.write(gene + "\\t" + "\\t".join(str(len(umis[gene].get(c, ()))) for c in cells) + "\\n")
+''',
+}
+
+DIMENSIONS = [
+    # option dest, params key, type
+    ("reads", "reads", int),
+    ("whitelist", "whitelist", int),
+    ("linker_rate", "linker_rate", float),
+    ("error_rate", "barcode_error_rate", float),
+    ("umi_length", "umi_length", int),
+]
+
+
+def install_stub_tools(bindir):
+    """Write the stub executables into bindir and return it."""
+    os.makedirs(bindir, exist_ok=True)
+    for name, source in STUB_TOOLS.items():
+        path = os.path.join(bindir, name)
+        with open(path, "w") as out:
+            out.write(f"#!{sys.executable}\n" + source)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return bindir
+
+
+def best_of(repeat, func):
+    """Run func repeat times and return (best seconds, all seconds, last result)."""
+    runs = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        runs.append(time.perf_counter() - start)
+    return min(runs), runs, result
+
+
+def _transform(fq1, fq2, outdir, bc_index, workers):
+    with open_fastq(fq1, "gzip") as r1, open_fastq(fq2, "gzip") as r2:
+        return Transformer().transform(r1, r2, bc_index, outdir, workers=workers)
+
+
+def _count_stages(workdir, fq1, fq2, whitelist, bc_index, umi_counter, assigner="featurecounts"):
+    from .countUMI import CountUMI
+    from .metrics import RunMetrics
+    from .pipeline import SamplePipeline
+    from .pipeline_params import get_parser
+
+    outdir = os.path.join(workdir, "pipeline")
+    genome = os.path.join(workdir, "genome")
+    gtf = os.path.join(workdir, "genes.gtf")
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(outdir)
+    os.makedirs(genome, exist_ok=True)
+    write_gtf(gtf)
+    options, _ = get_parser().parse_args([
+        "-f", os.path.dirname(fq1), "-b", whitelist, "-o", outdir, "-g", gtf, "-d", genome,
+        "--decompressor", "gzip", "--umi-counter", umi_counter, "--assigner", assigner, "--force",
+    ])
+    pipeline = SamplePipeline(options, CountUMI.from_options(options), outdir, "SYN", fq1, fq2,
+                              bc_index, log_filename=os.path.join(outdir, "Druglog.txt"))
+    pipeline.run(pipeline.stage_names("all"))
+    return RunMetrics(outdir).stages
+
+
+def run_case(params, workdir, repeat=3, workers=1, count=False, umi_counter="native",
+             assigner="featurecounts"):
+    """Benchmark one combination of dimensions; return a list of result dicts."""
+    barcodes = random_barcodes(params["whitelist"], seed=params["whitelist"])
+    whitelist = os.path.join(workdir, "barcodes.txt")
+    fq1 = os.path.join(workdir, "SYN_1.fastq.gz")
+    fq2 = os.path.join(workdir, "SYN_2.fastq.gz")
+    write_whitelist(whitelist, barcodes)
+    write_pair(fq1, fq2, params["reads"], barcodes, linker_rate=params["linker_rate"],
+               barcode_error_rate=params["barcode_error_rate"], umi_length=params["umi_length"])
+
+    results = []
+
+    def record(benchmark, seconds, runs, **extra):
+        results.append(dict(benchmark=benchmark, params=params, seconds=round(seconds, 6),
+                            runs=[round(r, 6) for r in runs], **extra))
+
+    seconds, runs, _ = best_of(repeat, lambda: BCFunc.get_barcodes(whitelist))
+    record("barcodes", seconds, runs)
+    seconds, runs, bc_index = best_of(repeat, lambda: BarcodeIndex(barcodes, max_mismatch=1))
+    record("index", seconds, runs)
+
+    outdir = os.path.join(workdir, "transform")
+    os.makedirs(outdir, exist_ok=True)
+    seconds, runs, stats = best_of(repeat, lambda: _transform(fq1, fq2, outdir, bc_index, workers))
+    record("transform", seconds, runs, workers=workers, counters=stats,
+           reads_per_second=round(params["reads"] / seconds, 1) if seconds else None)
+
+    if count:
+        stages = _count_stages(workdir, fq1, fq2, whitelist, bc_index, umi_counter, assigner)
+        for name, metrics in stages.items():
+            record("stage:" + name, metrics["wall_seconds"], [metrics["wall_seconds"]],
+                   umi_counter=umi_counter, assigner=assigner, metrics=metrics)
+    return results
+
+
+def result_key(result):
+    return json.dumps([result["benchmark"], result["params"], result.get("workers")], sort_keys=True)
+
+
+def compare(results, baseline_path):
+    """Print old/new time ratios (>1 means faster now) for matching benchmarks."""
+    with open(baseline_path) as handle:
+        baseline = {result_key(r): r for r in json.load(handle)["results"]}
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None or not result["seconds"]:
+            continue
+        ratio = old["seconds"] / result["seconds"]
+        print(f"[Info] {result['benchmark']} {result['params']}: "
+              f"{old['seconds']:.4f}s -> {result['seconds']:.4f}s ({ratio:.2f}x)")
+
+
+def get_parser():
+    parser = OptionParser(usage="python -m drugstools.bench [options]")
+    parser.add_option("--reads", default="100000", help="Read pairs per case, comma separated")
+    parser.add_option("--whitelist", default="96,384", help="Whitelist sizes, comma separated")
+    parser.add_option("--linker-rate", dest="linker_rate", default="0.9",
+                      help="Fraction of reads containing the linker, comma separated")
+    parser.add_option("--error-rate", dest="error_rate", default="0.1",
+                      help="Fraction of barcodes with one substitution, comma separated")
+    parser.add_option("--umi-length", dest="umi_length", default="10",
+                      help="UMI lengths, comma separated")
+    parser.add_option("--repeat", type="int", default=3, help="Runs per benchmark; the best is kept")
+    parser.add_option("--workers", type="int", default=1, help="Transform worker processes")
+    parser.add_option("--count", action="store_true", default=False,
+                      help="Also run every pipeline stage against stub tools")
+    parser.add_option("--umi-counter", dest="umi_counter", default="native",
+                      choices=["native", "umi_tools"], help="UMI counter for --count")
+    parser.add_option("--assigner", default="featurecounts", choices=["featurecounts", "builtin"],
+                      help="Gene assigner for --count")
+    parser.add_option("--out", default="bench.json", help="JSON file to write")
+    parser.add_option("--compare", default=None, help="Previous JSON file to compare against")
+    return parser
+
+
+def main(argv=None):
+    options, _ = get_parser().parse_args(argv)
+    axes = [[kind(v) for v in getattr(options, dest).split(",")] for dest, _, kind in DIMENSIONS]
+    workdir = tempfile.mkdtemp(prefix="drugstools_bench_")
+    old_path = os.environ.get("PATH", "")
+    os.environ["PATH"] = install_stub_tools(os.path.join(workdir, "bin")) + os.pathsep + old_path
+    results = []
+    try:
+        for values in itertools.product(*axes):
+            params = {key: value for (_, key, _), value in zip(DIMENSIONS, values)}
+            print(f"[Info] Benchmarking {params}")
+            case_dir = os.path.join(workdir, "case")
+            shutil.rmtree(case_dir, ignore_errors=True)
+            os.makedirs(case_dir)
+            results += run_case(params, case_dir, options.repeat, options.workers,
+                                options.count, options.umi_counter, options.assigner)
+    finally:
+        os.environ["PATH"] = old_path
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    with open(options.out, "w") as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+    print(f"[Info] Wrote {len(results)} results to {options.out}")
+    if options.compare:
+        compare(results, options.compare)
+    return report
+
+
+if __name__ == "__main__":
+    main()
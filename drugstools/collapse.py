@@ -0,0 +1,83 @@
+# collapse.py
+"""
+Pre-alignment collapse of PCR duplicates.
+
+Reads with the same (corrected) barcode, UMI and R2 sequence align and
+count identically, so with --collapse-duplicates the transform writes only
+the first of them. duplicates.tsv.gz records, for every representative
+that stood for more than one read, its read name and multiplicity; the
+native UMI counter reinflates read counts from it, so the directional UMI
+network and the read totals are the same as without collapsing.
+
+Each unique read is held as a 16-byte key and its read name, at most
+MAX_KEYS of them (about 2 GB). When that many are held, the multiplicities
+found so far are appended to duplicates.tsv.gz and a new window starts:
+duplicates are then only collapsed within a window, but every
+representative's multiplicity is complete when it is written, so the
+counts stay exact and memory stays bounded.
+"""
+
+import gzip
+import os
+
+MULTIPLICITY_NAME = "duplicates.tsv.gz"
+# Unique reads held at once; about 200 bytes each.
+MAX_KEYS = 10_000_000
+
+
+class DuplicateCollapser:
+    def __init__(self, outdir, max_keys=None):
+        self.path = os.path.join(outdir, MULTIPLICITY_NAME)
+        self.max_keys = max_keys or MAX_KEYS
+        self.seen = {}
+        self.extra = {}
+        self.duplicates = 0
+        self.windows = 1
+        self._out = gzip.open(self.path + ".tmp", "wb", compresslevel=4)
+        self._out.write(b"read\tmultiplicity\n")
+
+    def filter(self, keys, r1_records, r2_records):
+        """
+        Return (R1 bytes, R2 bytes) of the records not seen before; keys is
+        the (duplicate key, read name) list from transformer.transform_chunk.
+        """
+        seen, extra = self.seen, self.extra
+        out1, out2 = [], []
+        for (key, name), rec1, rec2 in zip(keys, r1_records, r2_records):
+            rep = seen.get(key)
+            if rep is None:
+                if len(seen) >= self.max_keys:
+                    self._flush()
+                    self.windows += 1
+                    seen, extra = self.seen, self.extra
+                seen[key] = name
+                out1.append(rec1)
+                out2.append(rec2)
+            else:
+                extra[rep] = extra.get(rep, 0) + 1
+        self.duplicates += len(keys) - len(out1)
+        return b"".join(out1), b"".join(out2)
+
+    def _flush(self):
+        """Append the window's multiplicities and forget its reads."""
+        self._out.writelines(name + b"\t" + str(n + 1).encode() + b"\n"
+                             for name, n in self.extra.items())
+        self.seen, self.extra = {}, {}
+
+    def write(self):
+        """Finish duplicates.tsv.gz and return its path."""
+        self._flush()
+        self._out.close()
+        os.replace(self.path + ".tmp", self.path)
+        return self.path
+
+
+def load_multiplicities(path):
+    """Return {read name (bytes): multiplicity} from duplicates.tsv.gz."""
+    multiplicities = {}
+    with gzip.open(path, "rb") as handle:
+        next(handle, None)
+        for line in handle:
+            name, n = line.rstrip(b"\n").split(b"\t")
+            multiplicities[name] = int(n)
+    return multiplicities
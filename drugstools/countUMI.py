@@ -1,58 +1,293 @@
 import os
 import datetime
 
+from .annotation import GeneAssigner, GeneIndex, tag_bam
+from .collapse import MULTIPLICITY_NAME, load_multiplicities
+from .fastq_io import find_existing
+from .genome_load import BAM_SORT_RAM
+from .runner import CommandFailed, run_command
+from .resources import ResourcePlan
+from .scatter import gather, scatter
+from .sparse import wide_to_sparse
+from .umicount import count_bam
+
+
+def star_input_reads(outdirname, outname):
+    """'Number of input reads' from STAR's Log.final.out, or None."""
+    try:
+        with open(os.path.join(outdirname, outname + "_Log.final.out")) as handle:
+            for line in handle:
+                if "Number of input reads" in line:
+                    return int(line.split("|")[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def summary_reads(summary_path):
+    """Total reads in a featureCounts .summary file, or None."""
+    try:
+        with open(summary_path) as handle:
+            next(handle)
+            return sum(int(line.split("\t")[1]) for line in handle if line.strip())
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+
+
 class CountUMI:
-    def __init__(self, gtfname, genomedir, featurecountthread="4", starthread="8"):
+    def __init__(self, gtfname, genomedir, featurecountthread="4", starthread="8",
+                 shared_genome=False, umi_counter="native", umi_method="directional",
+                 npz=False, timeout=None, collapse=False, assigner="featurecounts",
+                 shards=1, shard_workers=None, shard_queue=None, shard_timeout=None,
+                 samtools_threads=1,
+                 sort_memory_mb=None, bam_sort_ram=None, plan=None, release=False):
         self.gtfname = gtfname
         self.genomedir = genomedir
         self.featurecountthread = featurecountthread
         self.starthread = starthread
+        # shared_genome: attach to an index already loaded by
+        # genome_load.GenomeResidency instead of reading it from disk.
+        self.shared_genome = shared_genome
+        # umi_counter="native" counts UMIs in-process from the featureCounts
+        # BAM (umicount.py); "umi_tools" keeps the samtools sort/index +
+        # umi_tools count chain.
+        self.umi_counter = umi_counter
+        self.umi_method = umi_method
+        # Besides <outname>_counts.tsv.gz the count step writes the sparse
+        # <outname>_matrix.mtx.gz/_features.tsv/_barcodes.tsv, plus
+        # <outname>_counts.npz when npz is set (see sparse.py).
+        self.npz = npz
+        # Seconds each external tool may run before it is stopped.
+        self.timeout = timeout
+        # collapse: the transform wrote one read per PCR duplicate group and
+        # duplicates.tsv.gz, which the native counter reinflates from.
+        self.collapse = collapse
+        # assigner="builtin" assigns genes with annotation.GeneAssigner from a
+        # cached GTF index instead of running featureCounts.
+        self.assigner = assigner
+        # shards > 1: align and assign the reads in that many shards and merge
+        # the UMI tables (scatter.py), in shard_workers local processes or
+        # through the file-based job queue in shard_queue, whose jobs must
+        # all be done within shard_timeout seconds (None: no limit).
+        self.shards = shards
+        self.shard_workers = shard_workers
+        self.shard_queue = shard_queue
+        self.shard_timeout = shard_timeout
+        # samtools -@/sort -m and STAR --limitBAMsortRAM (bytes); None keeps
+        # the tools' defaults. from_options takes them, and the thread
+        # counts above, from a resources.ResourcePlan.
+        self.samtools_threads = samtools_threads
+        self.sort_memory_mb = sort_memory_mb
+        self.bam_sort_ram = bam_sort_ram
+        self.plan = plan
+        # release: shards delete their reads and BAMs once collected (see
+        # lifecycle.py); the sample's own files are released by SamplePipeline.
+        self.release = release
+
+    @classmethod
+    def from_options(cls, options, plan=None):
+        plan = plan or ResourcePlan.from_options(options)
+        return cls(
+            gtfname=options.gtfname,
+            genomedir=options.genomedir,
+            featurecountthread=str(plan.featurecounts_threads),
+            starthread=str(plan.star_threads),
+            shared_genome=getattr(options, "shared_genome", False),
+            umi_counter=getattr(options, "umi_counter", "native"),
+            umi_method=getattr(options, "umi_method", "directional"),
+            npz=getattr(options, "npz", False),
+            timeout=getattr(options, "command_timeout", None),
+            collapse=getattr(options, "collapse_duplicates", False),
+            assigner=getattr(options, "assigner", "featurecounts"),
+            shards=getattr(options, "shards", 1),
+            shard_workers=plan.jobs,
+            shard_queue=getattr(options, "shard_queue", None),
+            shard_timeout=getattr(options, "shard_timeout", None),
+            samtools_threads=plan.samtools_threads,
+            sort_memory_mb=plan.sort_memory_mb,
+            bam_sort_ram=plan.bam_sort_ram or None,
+            plan=plan,
+            release=not getattr(options, "keep_temp_files", True),
+        )
 
-    def count(self, fastqname, outdirname, outname):
+    @staticmethod
+    def log_name():
         now = datetime.datetime.now().strftime("%Y%m%d%H%M")
-        log_filename = now + "Druglog.txt"
-        
-        infile = os.path.join(outdirname, "datanew_R2.fastq")
+        return now + "Druglog.txt"
+
+    def star_argv(self, infile, outdirname, outname):
+        argv = [
+            "STAR", "--runThreadN", self.starthread,
+            "--genomeDir", self.genomedir,
+            "--readFilesIn", infile,
+        ]
+        if infile.endswith(".gz"):
+            argv += ["--readFilesCommand", "zcat"]
+        argv += [
+            "--outFileNamePrefix", f"{outdirname}/{outname}_",
+            "--outFilterMultimapNmax", "1", "--outSAMtype", "BAM", "SortedByCoordinate",
+        ]
+        if self.shared_genome:
+            argv += ["--genomeLoad", "LoadAndKeep"]
+        # A genome attached with LoadAndKeep needs an explicit sorting limit.
+        bam_sort_ram = self.bam_sort_ram or (BAM_SORT_RAM if self.shared_genome else None)
+        if bam_sort_ram:
+            argv += ["--limitBAMsortRAM", str(bam_sort_ram)]
+        return argv
+
+    def paths(self, outdirname, outname):
+        """Files produced by the count stages for one sample."""
         outfile = os.path.join(outdirname, outname)
         outbam = os.path.join(outdirname, outname + "_Aligned.sortedByCoord.out.bam")
-        
-        star_cmd = (
-            f"STAR --runThreadN {self.starthread} "
-            f"--genomeDir {self.genomedir} "
-            f"--readFilesIn {infile} "
-            f"--outFileNamePrefix {outdirname}/{outname}_ "
-            f"--outFilterMultimapNmax 1 --outSAMtype BAM SortedByCoordinate "
-            f">> {log_filename} 2>&1"
-        )
-        featurecounts_cmd = (
-            f"featureCounts -a {self.gtfname} -o gene_assigned "
-            f"-R BAM {outbam} -T {self.featurecountthread} "
-            f">> {log_filename} 2>&1"
-        )
-        mv1_cmd = f"mv gene_assigned* {outdirname} >> {log_filename} 2>&1"
-        mv2_cmd = f"mv *featureCounts* {outdirname} >> {log_filename} 2>&1"
-        samtools_sort_cmd = (
-            f"samtools sort {outbam}.featureCounts.bam "
-            f"-o {outfile}_assigned_sorted.bam "
-            f">> {log_filename} 2>&1"
-        )
-        samtools_index_cmd = (
-            f"samtools index {outfile}_assigned_sorted.bam "
-            f">> {log_filename} 2>&1"
-        )
-        umi_tools_cmd = (
-            f"umi_tools count --per-gene --gene-tag=XT --assigned-status-tag=XS "
-            f"--per-cell --wide-format-cell-counts "
-            f"-I {outfile}_assigned_sorted.bam "
-            f"-S {outfile}_counts.tsv.gz "
-            f">> {log_filename} 2>&1"
+        # The transform step writes datanew_R2.fastq, or datanew_R2.fastq.gz
+        # when output compression is enabled.
+        infile = find_existing(os.path.join(outdirname, "datanew_R2.fastq"))
+        if infile is None:
+            infile = os.path.join(outdirname, "datanew_R2.fastq")
+        return {
+            "infile": infile,
+            "outfile": outfile,
+            "outbam": outbam,
+            "assigned_bam": outbam + ".featureCounts.bam",
+            "summary": os.path.join(outdirname, "gene_assigned.summary"),
+            "sorted_bam": outfile + "_assigned_sorted.bam",
+            "sorted_bai": outfile + "_assigned_sorted.bam.bai",
+            "counts": outfile + "_counts.tsv.gz",
+            "duplicates": os.path.join(outdirname, MULTIPLICITY_NAME),
+        }
+
+    def _run(self, stage, argv, outdirname, outname, log_filename):
+        """
+        Run one tool; its stdout/stderr go to <outdirname>/logs/<outname>_<stage>.out/.err
+        and a one-line timing summary is appended to log_filename.
+        """
+        try:
+            result = run_command(argv, name=f"{outname}_{stage}",
+                                 log_dir=os.path.join(outdirname, "logs"), timeout=self.timeout)
+        except CommandFailed as e:
+            self._log(log_filename, f"[Error] {e}")
+            raise
+        self._log(log_filename, f"[Info] {result}")
+        return result
+
+    @staticmethod
+    def _log(log_filename, line):
+        with open(log_filename, "a") as log:
+            log.write(line + "\n")
+
+    def align(self, outdirname, outname, log_filename):
+        paths = self.paths(outdirname, outname)
+        result = self._run("align", self.star_argv(paths["infile"], outdirname, outname),
+                           outdirname, outname, log_filename)
+        print(paths["outbam"])
+        return {"commands": [result], "records": star_input_reads(outdirname, outname)}
+
+    def gene_assigner(self):
+        return GeneAssigner(GeneIndex.load(self.gtfname))
+
+    @property
+    def fused_count(self):
+        """Whether the native counter assigns genes itself (no assign stage)."""
+        return self.assigner == "builtin" and self.umi_counter != "umi_tools"
+
+    def assign(self, outdirname, outname, log_filename):
+        paths = self.paths(outdirname, outname)
+        if self.assigner == "builtin":
+            # Only umi_tools needs the tagged BAM; the native counter assigns
+            # genes while counting (see count_umis).
+            assigner = self.gene_assigner()
+            tag_bam(paths["outbam"], paths["assigned_bam"], assigner, threads=self.samtools_threads)
+            assigner.write_summary(paths["summary"], paths["outbam"])
+            self._log(log_filename, f"[Info] Built-in gene assignment of {paths['outbam']}: "
+                                    f"{assigner.summary}")
+            return {"records": sum(assigner.summary.values()), "counters": dict(assigner.summary)}
+        # -o and --Rpath put every featureCounts output in outdirname, so
+        # nothing lands in (or has to be moved out of) the working directory.
+        featurecounts_argv = [
+            "featureCounts", "-a", self.gtfname,
+            "-o", os.path.join(outdirname, "gene_assigned"),
+            "-R", "BAM", "--Rpath", outdirname,
+            "-T", self.featurecountthread,
+            paths["outbam"],
+        ]
+        result = self._run("assign", featurecounts_argv, outdirname, outname, log_filename)
+        return {"commands": [result], "records": summary_reads(paths["summary"])}
+
+    def sort(self, outdirname, outname, log_filename):
+        paths = self.paths(outdirname, outname)
+        samtools_sort_argv = ["samtools", "sort"]
+        if int(self.samtools_threads) > 1:
+            samtools_sort_argv += ["-@", str(int(self.samtools_threads) - 1)]
+        if self.sort_memory_mb:
+            samtools_sort_argv += ["-m", f"{self.sort_memory_mb}M"]
+        samtools_sort_argv += [paths["assigned_bam"], "-o", paths["sorted_bam"]]
+        return {"commands": [self._run("sort", samtools_sort_argv, outdirname, outname, log_filename)]}
+
+    def index(self, outdirname, outname, log_filename):
+        samtools_index_argv = ["samtools", "index"]
+        if int(self.samtools_threads) > 1:
+            samtools_index_argv += ["-@", str(int(self.samtools_threads) - 1)]
+        samtools_index_argv.append(self.paths(outdirname, outname)["sorted_bam"])
+        return {"commands": [self._run("index", samtools_index_argv, outdirname, outname, log_filename)]}
+
+    def scatter(self, outdirname, outname, log_filename):
+        return scatter(self, outdirname, outname, log_filename, self.shards,
+                       self.shard_workers or 1, self.shard_queue, self.shard_timeout)
+
+    def count_umis(self, outdirname, outname, log_filename):
+        paths = self.paths(outdirname, outname)
+        if self.shards > 1:
+            counter = gather(self, outdirname, outname, self.shards)
+            return {"records": counter.reads, "counters": {"assigned_reads": counter.reads,
+                                                            "groups": len(counter.groups)}}
+        outfile = paths["outfile"]
+        if self.umi_counter == "umi_tools":
+            umi_tools_argv = [
+                "umi_tools", "count", "--per-gene", "--gene-tag=XT", "--assigned-status-tag=XS",
+                "--per-cell", "--wide-format-cell-counts",
+                "-I", paths["sorted_bam"],
+                "-S", paths["counts"],
+            ]
+            result = self._run("count", umi_tools_argv, outdirname, outname, log_filename)
+            wide_to_sparse(paths["counts"], outfile, npz=self.npz)
+            return {"commands": [result]}
+        assigner = self.gene_assigner() if self.fused_count else None
+        counter = count_bam(
+            paths["outbam"] if assigner else paths["assigned_bam"], paths["counts"],
+            method=self.umi_method, threads=self.samtools_threads,
+            sparse_prefix=outfile, npz=self.npz,
+            multiplicities=load_multiplicities(paths["duplicates"]) if self.collapse else None,
+            assigner=assigner
         )
-        
-        os.system(star_cmd)
-        print(outbam)
-        os.system(featurecounts_cmd)
-        os.system(mv1_cmd)
-        os.system(mv2_cmd)
-        os.system(samtools_sort_cmd)
-        os.system(samtools_index_cmd)
-        os.system(umi_tools_cmd)
+        counters = {"assigned_reads": counter.reads, "groups": len(counter.groups)}
+        if assigner:
+            assigner.write_summary(paths["summary"], paths["outbam"])
+            counters.update(assigner.summary)
+        return {"records": counter.reads, "counters": counters}
+
+    def stage_names(self, run_star=True):
+        """
+        Count stages in run order; sort/index are only needed by umi_tools, and
+        the native counter does the built-in assignment itself. With shards,
+        scatter runs align/assign per shard and count merges the shards.
+        """
+        if self.shards > 1:
+            return ["scatter", "count"]
+        names = ["align"] if run_star else []
+        if not self.fused_count:
+            names.append("assign")
+        if self.umi_counter == "umi_tools":
+            names += ["sort", "index"]
+        names.append("count")
+        return names
+
+    def run_stage(self, name, outdirname, outname, log_filename):
+        method = self.count_umis if name == "count" else getattr(self, name)
+        return method(outdirname, outname, log_filename)
+
+    def count(self, fastqname, outdirname, outname, run_star=True, log_filename=None):
+        log_filename = log_filename or self.log_name()
+        # run_star=False when STAR already ran against the streamed reads
+        # (see star_stream.StarStream).
+        for name in self.stage_names(run_star):
+            self.run_stage(name, outdirname, outname, log_filename)
@@ -0,0 +1,229 @@
+# diagnostics.py
+"""
+Bounded in-memory diagnostics for the transform step.
+
+These replace the .fq/.fqD dumps (every short-read barcode and every
+unmatched R1 sequence), which grew to tens of GB:
+
+- HeavyHitters: a mergeable Misra-Gries summary of unmatched 12-mers, so
+  the most frequent ones (e.g. a missing whitelist entry or a shifted
+  linker) are reported with bounded memory.
+- BottomKSample: a uniform, deterministic sample of N failed raw reads.
+  Every read gets a key hashed from its name and the N smallest keys win,
+  so chunks sampled in different workers merge exactly.
+- TransformSummary: both of the above plus the read counters, written as
+  transform_summary.json at the end of the transform.
+- WellQC: per-well read counts and a HyperLogLog sketch of distinct UMIs
+  per well, giving a UMI saturation estimate long before alignment. It is
+  written as well_qc.tsv every QC_INTERVAL seconds during the transform and
+  at its end; memory is fixed per whitelisted well whatever the depth.
+"""
+
+import heapq
+import json
+import math
+import os
+import time
+from collections import Counter
+from hashlib import blake2b
+
+SUMMARY_NAME = "transform_summary.json"
+WELL_QC_NAME = "well_qc.tsv"
+# Seconds between rewrites of well_qc.tsv while the transform runs.
+QC_INTERVAL = 60
+# HyperLogLog precision: 2**12 registers, about 1.6% standard error.
+HLL_P = 12
+# Wells with fewer reads than this fraction of the median are flagged.
+LOW_WELL_FRACTION = 0.1
+
+
+class HeavyHitters:
+    """
+    Misra-Gries summary with at most `capacity` counters. Reported counts
+    are lower bounds, at most `error` below the true count.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.error = 0
+
+    def update(self, counts):
+        """Merge a {key: count} mapping (e.g. one chunk's misses)."""
+        table = self.counts
+        for key, n in counts.items():
+            table[key] = table.get(key, 0) + n
+        if len(table) > self.capacity:
+            # Subtract the (capacity+1)-th largest count from every counter
+            # and drop the ones that reach zero.
+            cut = heapq.nlargest(self.capacity + 1, table.values())[-1]
+            self.error += cut
+            self.counts = {k: n - cut for k, n in table.items() if n > cut}
+
+    def top(self, k):
+        return heapq.nlargest(k, self.counts.items(), key=lambda item: (item[1], item[0]))
+
+
+class BottomKSample:
+    """The n items with the smallest keys seen so far."""
+
+    def __init__(self, n):
+        self.n = n
+        self.items = []
+
+    def update(self, items):
+        """items: iterable of tuples whose first element is the key."""
+        if self.n:
+            self.items = heapq.nsmallest(self.n, self.items + list(items))
+
+
+class TransformSummary:
+    def __init__(self, top_k=20, sample_reads=0):
+        self.top_k = top_k
+        self.unmatched = HeavyHitters(max(1000, 50 * top_k))
+        self.sample = BottomKSample(sample_reads)
+        self.counters = {"reads": 0, "kept": 0, "obread": 0, "barcode_miss": 0, "no_linker": 0}
+        # WellQC.overview(), when the well QC ran.
+        self.well_qc = None
+
+    def add_chunk(self, n_reads, kept, misses, short, no_linker, samples):
+        counters = self.counters
+        counters["reads"] += n_reads
+        counters["kept"] += kept
+        counters["obread"] += short
+        counters["barcode_miss"] += sum(misses.values())
+        counters["no_linker"] += no_linker
+        self.unmatched.update(misses)
+        self.sample.update(samples)
+
+    def add_transformed(self, chunk):
+        """Add a transformer.TransformedChunk."""
+        if chunk.trimmed is not None:
+            counters = self.counters
+            counters["trimmed_too_short"] = counters.get("trimmed_too_short", 0) + chunk.trimmed[0]
+            counters["trimmed_bases"] = counters.get("trimmed_bases", 0) + chunk.trimmed[1]
+        if chunk.subsampled is not None:
+            self.counters["subsampled_out"] = self.counters.get("subsampled_out", 0) + chunk.subsampled
+        self.add_chunk(chunk.reads, chunk.kept, chunk.misses, chunk.obread, chunk.no_linker,
+                       chunk.samples)
+
+    def as_dict(self):
+        return {
+            "counters": dict(self.counters),
+            "unmatched_barcodes": [
+                {"barcode": bc.decode(errors="replace"), "count": n}
+                for bc, n in self.unmatched.top(self.top_k)
+            ],
+            "unmatched_count_error": self.unmatched.error,
+            "sampled_reads": [
+                {"reason": reason, "record": record.decode(errors="replace")}
+                for _, reason, record in self.sample.items
+            ],
+            **({"well_qc": self.well_qc} if self.well_qc is not None else {}),
+        }
+
+    def write(self, outdir):
+        path = os.path.join(outdir, SUMMARY_NAME)
+        with open(path, "w") as out:
+            json.dump(self.as_dict(), out, indent=2)
+        return path
+
+
+def hll_update(registers, umi, p=HLL_P):
+    """Add umi (bytes) to a sparse {register: rank} dict."""
+    h = int.from_bytes(blake2b(umi, digest_size=8).digest(), "little")
+    index = h & ((1 << p) - 1)
+    rank = 64 - p - (h >> p).bit_length() + 1
+    if registers.get(index, 0) < rank:
+        registers[index] = rank
+
+
+class HyperLogLog:
+    def __init__(self, p=HLL_P):
+        self.p = p
+        self.registers = bytearray(1 << p)
+
+    def merge(self, sparse):
+        """Merge a {register: rank} dict from hll_update."""
+        registers = self.registers
+        for index, rank in sparse.items():
+            if registers[index] < rank:
+                registers[index] = rank
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        # Counter walks the bytearray in C; the sum is then over <= 64 ranks.
+        ranks = Counter(self.registers)
+        estimate = alpha * m * m / sum(n * 2.0 ** -r for r, n in ranks.items())
+        zeros = ranks[0]
+        if estimate <= 2.5 * m and zeros:
+            # Small-range correction (linear counting).
+            estimate = m * math.log(m / zeros)
+        return estimate
+
+
+class WellQC:
+    """Reads and distinct UMIs per whitelisted well, from transform_chunk's wells."""
+
+    def __init__(self, barcodes=(), interval=QC_INTERVAL):
+        self.wells = {}
+        for barcode in barcodes:
+            self._well(barcode.encode() if isinstance(barcode, str) else barcode)
+        self.interval = interval
+        self.last_write = time.monotonic()
+
+    def _well(self, barcode):
+        well = self.wells.get(barcode)
+        if well is None:
+            well = self.wells[barcode] = [0, HyperLogLog()]
+        return well
+
+    def add_chunk(self, wells):
+        """wells: {barcode: (reads, {register: rank})} for one chunk."""
+        for barcode, (reads, registers) in wells.items():
+            well = self._well(barcode)
+            well[0] += reads
+            well[1].merge(registers)
+
+    def rows(self):
+        """(barcode, reads, estimated UMIs, saturation, flag), most reads first."""
+        reads = sorted(well[0] for well in self.wells.values())
+        median = reads[len(reads) // 2] if reads else 0
+        rows = []
+        for barcode, (n, sketch) in self.wells.items():
+            umis = min(n, round(sketch.estimate())) if n else 0
+            saturation = 1 - umis / n if n else 0.0
+            flag = "low_reads" if n < LOW_WELL_FRACTION * median else ""
+            rows.append((barcode.decode(), n, umis, saturation, flag))
+        rows.sort(key=lambda row: (-row[1], row[0]))
+        return rows
+
+    def overview(self, rows=None):
+        rows = self.rows() if rows is None else rows
+        reads = sum(row[1] for row in rows)
+        umis = sum(row[2] for row in rows)
+        counts = sorted(row[1] for row in rows)
+        return {
+            "wells": len(rows),
+            "wells_with_reads": sum(1 for row in rows if row[1]),
+            "low_wells": [row[0] for row in rows if row[4]],
+            "median_reads": counts[len(counts) // 2] if counts else 0,
+            "saturation": round(1 - umis / reads, 4) if reads else 0.0,
+        }
+
+    def write(self, outdir, rows=None):
+        rows = self.rows() if rows is None else rows
+        path = os.path.join(outdir, WELL_QC_NAME)
+        with open(path + ".tmp", "w") as out:
+            out.write("barcode\treads\tumis_estimate\tsaturation\tflag\n")
+            for barcode, n, umis, saturation, flag in rows:
+                out.write(f"{barcode}\t{n}\t{umis}\t{saturation:.4f}\t{flag}\n")
+        os.replace(path + ".tmp", path)
+        self.last_write = time.monotonic()
+        return path
+
+    def maybe_write(self, outdir):
+        """Rewrite well_qc.tsv if interval seconds have passed since the last write."""
+        if time.monotonic() - self.last_write >= self.interval:
+            self.write(outdir)
@@ -0,0 +1,361 @@
+# fastq_io.py
+"""
+Input readers and output writers for (gzipped) FASTQ files.
+
+open_fastq() returns a binary file-like object that supports iteration,
+readline() and read(), which is all Transformer.transform needs. Decoding is
+moved off the transform thread: an external parallel decompressor (pigz,
+igzip) is used as a subprocess pipe when one is on PATH, otherwise a
+background thread inflates with zlib ahead of the consumer. R1 and R2 each
+get their own process or thread, so both streams decode concurrently.
+
+A sample sequenced on several lanes is opened from its list of lane files:
+LaneReader streams them back to back as one file, with the decompressors
+of the next `prefetch` lanes already running, so lanes never have to be
+concatenated on disk first.
+"""
+
+import gzip
+import io
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+# Decompressors tried in order by method="auto".
+PIPE_DECOMPRESSORS = {
+    "pigz": ["pigz", "-dc"],
+    "igzip": ["igzip", "-dc"],
+}
+METHODS = ["auto", "pigz", "igzip", "thread", "gzip"]
+
+READ_BLOCK = 1 << 20
+READ_AHEAD_BLOCKS = 16
+
+
+def is_gzipped(path):
+    with open(path, "rb") as handle:
+        return handle.read(2) == b"\x1f\x8b"
+
+
+def find_decompressor():
+    """Return the name of the first pipe decompressor found on PATH, or None."""
+    for name, argv in PIPE_DECOMPRESSORS.items():
+        if shutil.which(argv[0]):
+            return name
+    return None
+
+
+def resolve_method(method="auto"):
+    if method not in METHODS:
+        raise ValueError(f"Unknown decompression method '{method}', choose from {METHODS}")
+    if method == "auto":
+        return find_decompressor() or "thread"
+    return method
+
+
+class PipeReader:
+    """Read the stdout of an external decompressor as a binary stream."""
+
+    def __init__(self, path, argv):
+        self.path = path
+        self._proc = subprocess.Popen(
+            argv + [path], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            bufsize=READ_BLOCK
+        )
+        self._stream = self._proc.stdout
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def readline(self, size=-1):
+        return self._stream.readline(size)
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def close(self):
+        if self._stream.closed:
+            return
+        finished = self._proc.poll() is not None
+        self._stream.close()
+        if not finished:
+            # Closed before EOF (e.g. the consumer stopped early); the
+            # decompressor will die of SIGPIPE, which is not an error.
+            self._proc.terminate()
+            self._proc.wait()
+            self._proc.stderr.close()
+            return
+        stderr = self._proc.stderr.read().decode(errors="replace").strip()
+        self._proc.stderr.close()
+        if self._proc.returncode != 0:
+            raise OSError(f"Decompressing {self.path} failed "
+                          f"(exit code {self._proc.returncode}): {stderr}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class _QueueRaw(io.RawIOBase):
+    """Raw stream over blocks produced by a background thread."""
+
+    def __init__(self, blocks):
+        self._blocks = blocks
+        self._current = memoryview(b"")
+        self._eof = False
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._current:
+            if self._eof:
+                return 0
+            block = self._blocks.get()
+            if block is None:
+                self._eof = True
+                if self.error is not None:
+                    raise self.error
+                return 0
+            self._current = memoryview(block)
+        n = min(len(buffer), len(self._current))
+        buffer[:n] = self._current[:n]
+        self._current = self._current[n:]
+        return n
+
+
+class ThreadedReader(io.BufferedReader):
+    """
+    Inflate a gzip file on a background thread with a bounded read-ahead.
+
+    zlib releases the GIL while inflating, so decoding overlaps with the
+    transform work running on the main thread.
+    """
+
+    def __init__(self, path, opener=gzip.open, block_size=READ_BLOCK,
+                 read_ahead=READ_AHEAD_BLOCKS):
+        self.path = path
+        self._blocks = queue.Queue(maxsize=read_ahead)
+        self._stop = threading.Event()
+        raw = _QueueRaw(self._blocks)
+        super().__init__(raw, buffer_size=block_size)
+        self._thread = threading.Thread(
+            target=self._produce, args=(path, opener, block_size, raw), daemon=True
+        )
+        self._thread.start()
+
+    def _produce(self, path, opener, block_size, raw):
+        try:
+            with opener(path, "rb") as handle:
+                while not self._stop.is_set():
+                    block = handle.read(block_size)
+                    if not block:
+                        break
+                    self._put(block)
+        except Exception as e:
+            raw.error = e
+        self._put(None)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        self._stop.set()
+        super().close()
+        self._thread.join()
+
+
+def lane_paths(path):
+    """The list of lane files for a path or a list of paths."""
+    return [path] if isinstance(path, (str, os.PathLike)) else list(path)
+
+
+class LaneReader:
+    """
+    Lines of several FASTQ files (lanes), in order, as one stream. Lanes are
+    opened with open_fastq; up to `prefetch` lanes after the current one are
+    already open and decompressing.
+    """
+
+    def __init__(self, paths, method="auto", prefetch=1):
+        self.paths = list(paths)
+        self.method = method
+        self.prefetch = max(0, prefetch)
+        self._next = 0
+        self._open = deque()
+        self._current = None
+        # chain pulls the next lane only once the current one is exhausted.
+        self._lines = chain.from_iterable(self._lanes())
+
+    def _fill(self, n):
+        while self._next < len(self.paths) and len(self._open) < n:
+            self._open.append(open_fastq(self.paths[self._next], self.method))
+            self._next += 1
+
+    def _lanes(self):
+        while True:
+            if self._current is not None:
+                self._current.close()
+                self._current = None
+            self._fill(1)
+            if not self._open:
+                return
+            self._current = self._open.popleft()
+            self._fill(self.prefetch)
+            yield self._current
+
+    def __iter__(self):
+        return self._lines
+
+    def readline(self):
+        return next(self._lines, b"")
+
+    def read(self):
+        return b"".join(self._lines)
+
+    def close(self):
+        for handle in [self._current, *self._open]:
+            if handle is not None:
+                handle.close()
+        self._current = None
+        self._open.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_fastq(path, method="auto", prefetch=1):
+    """
+    Open a FASTQ file for binary reading, decompressing gzip input with the
+    requested method (see METHODS). Uncompressed files are opened directly.
+    A list of lane files is read back to back through a LaneReader.
+    """
+    if not isinstance(path, (str, os.PathLike)):
+        paths = lane_paths(path)
+        if len(paths) > 1:
+            return LaneReader(paths, method, prefetch)
+        path = paths[0]
+    if not is_gzipped(path):
+        return open(path, "rb")
+    method = resolve_method(method)
+    if method in PIPE_DECOMPRESSORS:
+        if not shutil.which(PIPE_DECOMPRESSORS[method][0]):
+            raise OSError(f"'{method}' was requested but is not on PATH")
+        return PipeReader(path, PIPE_DECOMPRESSORS[method])
+    if method == "thread":
+        return ThreadedReader(path)
+    return gzip.open(path, "rb")
+
+
+# BGZF (blocked gzip, as written by bgzip/samtools): every block is a
+# self-contained gzip member carrying its compressed size in a "BC" extra
+# field, so any gzip reader (zcat, STAR --readFilesCommand) can read it.
+BGZF_BLOCK = 0xff00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def _bgzf_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                         ord("B"), ord("C"), 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+class BgzfWriter:
+    """
+    Write BGZF with blocks compressed on a thread pool.
+
+    write() only buffers and hands full blocks to the pool (zlib releases the
+    GIL); finished blocks are written to disk in order, and the caller only
+    waits when more than max_pending blocks are still being compressed.
+    """
+
+    def __init__(self, path, level=6, threads=4, max_pending=None):
+        self.path = path
+        self.level = level
+        self._handle = open(path, "wb")
+        self._pool = ThreadPoolExecutor(max_workers=max(1, threads))
+        self._pending = deque()
+        self._max_pending = max_pending or max(1, threads) * 4
+        self._buffer = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= BGZF_BLOCK:
+            view = memoryview(self._buffer)
+            end = len(self._buffer) - len(self._buffer) % BGZF_BLOCK
+            for start in range(0, end, BGZF_BLOCK):
+                self._submit(bytes(view[start:start + BGZF_BLOCK]))
+            view.release()
+            del self._buffer[:end]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(_bgzf_block, block, self.level))
+        while len(self._pending) > self._max_pending:
+            self._handle.write(self._pending.popleft().result())
+
+    def flush(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._handle.write(self._pending.popleft().result())
+        self._handle.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+            self._handle.write(BGZF_EOF)
+        finally:
+            self._pool.shutdown()
+            self._handle.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def output_name(name, compress_level=None):
+    """File name of a transform output, with .gz added when compressed."""
+    return name if compress_level is None else name + ".gz"
+
+
+def open_output(path, compress_level=None, threads=4):
+    """Open a binary output file, BGZF-compressed when compress_level is set."""
+    if compress_level is None:
+        return open(path, "wb")
+    return BgzfWriter(path, level=compress_level, threads=threads)
+
+
+def find_existing(path):
+    """Return path or path + '.gz', whichever exists and is newer, or None."""
+    candidates = [p for p in (path, path + ".gz") if os.path.exists(p)]
+    if not candidates:
+        return None
+    return max(candidates, key=os.path.getmtime)
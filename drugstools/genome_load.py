@@ -0,0 +1,102 @@
+# genome_load.py
+"""
+Keep one STAR genome index resident in shared memory across samples.
+
+GenomeResidency loads the index once (STAR --genomeLoad LoadAndExit), the
+per-sample STAR runs attach to it with --genomeLoad LoadAndKeep (see
+CountUMI.shared_genome), and the index is always removed again
+(--genomeLoad Remove) when the block exits, including on errors, Ctrl-C
+and SIGTERM.
+"""
+
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+# RAM STAR may use for BAM sorting when attached to a shared genome; STAR
+# requires an explicit --limitBAMsortRAM in that mode.
+BAM_SORT_RAM = 4 * 1024 ** 3
+
+
+class GenomeLoadError(RuntimeError):
+    pass
+
+
+class GenomeResidency:
+    def __init__(self, genomedir, log_filename=None, star="STAR"):
+        self.genomedir = genomedir
+        self.log_filename = log_filename
+        self.star = star
+        self.load_seconds = None
+        self.unload_seconds = None
+        self.loaded = False
+        self._previous_sigterm = None
+
+    def _run(self, mode):
+        workdir = tempfile.mkdtemp(prefix="drugstools_genome_")
+        cmd = [self.star, "--genomeDir", self.genomedir, "--genomeLoad", mode,
+               "--outFileNamePrefix", workdir + "/"]
+        start = time.time()
+        try:
+            if self.log_filename:
+                with open(self.log_filename, "a") as log:
+                    result = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT)
+            else:
+                result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        if result.returncode != 0:
+            raise GenomeLoadError(f"STAR --genomeLoad {mode} failed with exit code {result.returncode}")
+        return time.time() - start
+
+    def load(self):
+        print(f"[Info] Loading STAR genome {self.genomedir} into shared memory...")
+        self.load_seconds = self._run("LoadAndExit")
+        self.loaded = True
+        print(f"[Info] Genome loaded in {self.load_seconds:.1f}s")
+
+    def unload(self):
+        if not self.loaded:
+            return
+        self.unload_seconds = self._run("Remove")
+        self.loaded = False
+        print(f"[Info] Genome removed from shared memory in {self.unload_seconds:.1f}s")
+
+    def _on_sigterm(self, signum, frame):
+        raise SystemExit(128 + signum)
+
+    def __enter__(self):
+        # Turn SIGTERM into SystemExit so __exit__ still unloads the genome.
+        if threading.current_thread() is threading.main_thread():
+            self._previous_sigterm = signal.signal(signal.SIGTERM, self._on_sigterm)
+        try:
+            self.load()
+        except BaseException:
+            # An interrupted load may have left shared memory segments behind.
+            self.loaded = True
+            try:
+                self.unload()
+            except GenomeLoadError:
+                pass
+            self._restore_signal()
+            raise
+        return self
+
+    def _restore_signal(self):
+        if self._previous_sigterm is not None:
+            signal.signal(signal.SIGTERM, self._previous_sigterm)
+            self._previous_sigterm = None
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.unload()
+        except GenomeLoadError as e:
+            if exc_type is None:
+                raise
+            print(f"[Warning] {e}")
+        finally:
+            self._restore_signal()
+        return False
@@ -0,0 +1,140 @@
+# lifecycle.py
+"""
+Intermediate files and disk usage of one sample.
+
+Every stage output that is not a final result (KEEP_PATTERNS) is an
+intermediate. SamplePipeline knows from the stage chain of a full run which
+stages read each one, and unless --keep-temp-files is given it releases
+(deletes) an intermediate as soon as the last stage reading it has
+succeeded: datanew_R1 and Obread1/2, which no stage reads, right after the
+transform, datanew_R2 once STAR has aligned it, STAR's BAM once genes are
+assigned, and so on. The output directory then holds about one stage's
+input and output at a time instead of every intermediate at once.
+
+Released files are recorded with their fingerprints in
+pipeline_manifest.json, so a rerun still treats the stages around them as
+up to date; a stage that must rerun and reads a released file first reruns
+the stage that produced it.
+
+DiskMonitor samples the size of the output directory on a background
+thread; the peak of every stage and of the run goes to run_metrics.json.
+With --disk-budget-gb, batch mode only starts a sample while the estimated
+peaks of the samples running at once fit into the budget. The estimate
+(PEAK_DISK_FACTOR) is a reservation for scheduling, not a limit: nothing
+stops a sample that outgrows it, DiskMonitor only warns.
+"""
+
+import os
+import threading
+
+from .resources import GB
+
+# Files cleanup keeps; everything else a stage writes is an intermediate.
+KEEP_PATTERNS = [
+    'gene_assigned.summary',
+    'counts.tsv.gz',
+    'Druglog.txt',
+    '_matrix.mtx.gz',
+    '_features.tsv',
+    '_barcodes.tsv',
+    '_counts.npz',
+    'pipeline_manifest.json',
+    'run_metrics.json',
+    'transform_summary.json',
+    'well_qc.tsv'
+]
+DISK_SAMPLE_SECONDS = 2.0
+# Estimated peak disk use of one sample per byte of gzipped input, with
+# intermediates released eagerly or kept to the end.
+PEAK_DISK_FACTOR = {True: 3.0, False: 6.0}
+
+
+def format_bytes(n):
+    return f"{n / GB:.2f} GB" if n >= GB else f"{n / 1024 ** 2:.1f} MB"
+
+
+def is_final(path):
+    name = os.path.basename(path)
+    return any(pat in name for pat in KEEP_PATTERNS)
+
+
+def dir_bytes(root):
+    """Disk space used by the files under root."""
+    total = 0
+    stack = [root]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    total += getattr(st, "st_blocks", 0) * 512 or st.st_size
+            except OSError:
+                # Deleted while scanning (STAR temp files, released files).
+                continue
+    return total
+
+
+def estimate_peak_bytes(inputs, release=True):
+    """Rough peak disk use of a sample whose gzipped FASTQs are inputs."""
+    size = sum(os.path.getsize(path) for path in inputs if os.path.isfile(path))
+    return int(size * PEAK_DISK_FACTOR[release])
+
+
+class DiskMonitor:
+    """Peak size of root, sampled every interval seconds while running."""
+
+    def __init__(self, root, interval=DISK_SAMPLE_SECONDS, budget_bytes=None):
+        self.root = root
+        self.interval = interval
+        self.budget_bytes = budget_bytes
+        self.peak = 0
+        self.stage_peak = 0
+        self.released = 0
+        self._warned = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        used = dir_bytes(self.root)
+        self.peak = max(self.peak, used)
+        self.stage_peak = max(self.stage_peak, used)
+        if self.budget_bytes and used > self.budget_bytes and not self._warned:
+            self._warned = True
+            print(f"[Warning] {self.root} uses {used / GB:.1f} GB, over the disk budget of "
+                  f"{self.budget_bytes / GB:.1f} GB")
+        return used
+
+    def start_stage(self):
+        self.stage_peak = 0
+        self.sample()
+
+    def end_stage(self):
+        """Peak of the stage in MB, including its final size."""
+        self.sample()
+        return round(self.stage_peak / 1024 ** 2, 1)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        return False
+
+    def as_dict(self):
+        return {"peak_mb": round(self.peak / 1024 ** 2, 1),
+                "released_mb": round(self.released / 1024 ** 2, 1)}
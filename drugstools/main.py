@@ -3,18 +3,73 @@
 
 
 
-import gzip
 import os
 import glob
-import sys
-from .transformer import Transformer
+import shutil
 from .countUMI import CountUMI
 from .BCfunc import BCFunc
+from .pipeline import SamplePipeline
 from .pipeline_params import get_parser
+from .resources import ResourcePlan
+from .scatter import SHARD_DIR
+from .batch import pair_samples
+from .fastq_io import lane_paths
+from .lifecycle import is_final
 
 
 from .checktime import check_expiration
 
+
+def run_transform_step(options, FQ1, FQ2, outdir, BCfilelist,
+                       count_umi=None, outname=None, stream_star=False, log_filename=None):
+    """
+    Transform one sample's R1/R2 into outdir. Skipped when
+    pipeline_manifest.json shows the outputs are up to date (see pipeline.py).
+    """
+    pipeline = SamplePipeline(options, count_umi or CountUMI.from_options(options), outdir,
+                              outname, FQ1, FQ2, BCfilelist, stream_star, log_filename)
+    pipeline.run(pipeline.stage_names("transform"))
+
+
+def run_count_step(options, count_umi, outdir, outname, stream_star=False, log_filename=None,
+                   FQ1=None, FQ2=None, BCfilelist=None, merge_disk=False):
+    """
+    Count one transformed sample. Given the reads and barcodes, a transform
+    output released after the last run (lifecycle.py) can be recreated.
+    """
+    print("-----------------Barcode-UMI-Count analysis start-------------")
+
+    pipeline = SamplePipeline(options, count_umi, outdir, outname, FQ1, FQ2, BCfilelist,
+                              stream_star=stream_star, log_filename=log_filename)
+    pipeline.run(pipeline.stage_names("count"), merge_disk=merge_disk)
+
+
+def run_all_steps(options, FQ1, FQ2, outdir, BCfilelist,
+                  count_umi, outname, stream_star=False, log_filename=None):
+    """
+    Transform and count one sample as a single stage chain, so a count stage
+    that needs a released transform output can rerun the transform.
+    """
+    pipeline = SamplePipeline(options, count_umi, outdir, outname, FQ1, FQ2, BCfilelist,
+                              stream_star, log_filename)
+    pipeline.run(pipeline.stage_names("all"))
+
+
+def cleanup_folder(output_dir):
+
+    for file_path in glob.glob(os.path.join(output_dir, '*')):
+        file_name = os.path.basename(file_path)
+        if is_final(file_name):
+            continue
+        if os.path.isdir(file_path):
+            # Per-shard alignments (--shards) are intermediates too.
+            if file_name == SHARD_DIR:
+                shutil.rmtree(file_path)
+            continue
+
+        os.remove(file_path)
+
+
 def main():
     """
     Main pipeline script with optional step-wise execution.
@@ -45,23 +100,52 @@ def main():
             parser.error("Error: Please specify the GTF file path (use -g).")
         if not options.genomedir:
             parser.error("Error: Please specify the genome index directory (use -d).")
-
-        fq1_candidates = glob.glob(os.path.join(options.readFolder, "*_1*.gz"))
-        fq2_candidates = glob.glob(os.path.join(options.readFolder, "*_2*.gz"))
-        if not fq1_candidates or not fq2_candidates:
+        if options.collapse_duplicates and options.umi_counter == "umi_tools":
+            parser.error("Error: --collapse-duplicates needs the native UMI counter (--umi-counter native).")
+        if options.shards < 1:
+            parser.error("Error: --shards must be at least 1.")
+        if options.shards > 1 and options.umi_counter == "umi_tools":
+            parser.error("Error: --shards needs the native UMI counter (--umi-counter native).")
+        if options.fraction is not None and not 0 < options.fraction <= 1:
+            parser.error("Error: --fraction must be in (0, 1].")
+        if options.max_reads is not None and options.max_reads < 1:
+            parser.error("Error: --max-reads must be at least 1.")
+        if options.lane_prefetch < 0:
+            parser.error("Error: --lane-prefetch must be 0 or more.")
+        if options.disk_budget_gb is not None and options.disk_budget_gb <= 0:
+            parser.error("Error: --disk-budget-gb must be greater than 0.")
+        if options.resources:
+            try:
+                ResourcePlan(1, 1.0).override(options.resources)
+            except ValueError as e:
+                parser.error(f"Error: --resources: {e}")
+
+        samples = pair_samples(options.readFolder)
+        if not samples:
             parser.error(
-                "Error: Could not find files matching '*_1*.gz' or '*_2*.gz' in the provided readFolder.\n"
+                "Error: Could not pair any R1/R2 files by sample prefix in the provided readFolder.\n"
                 "Please ensure your input files are named accordingly, for example:\n"
-                "  sampleA_1.fastq.gz  and  sampleA_2.fastq.gz"
+                "  sampleA_1.fastq.gz  and  sampleA_2.fastq.gz, or\n"
+                "  sampleA_S1_L001_R1_001.fastq.gz  and  sampleA_S1_L001_R2_001.fastq.gz"
             )
 
-        FQ1 = fq1_candidates[0]
-        FQ2 = fq2_candidates[0]
+        if options.batch:
+            for sample, fq1, fq2 in samples:
+                print(f"[Info] Sample {sample}: R1 {', '.join(lane_paths(fq1))}, "
+                      f"R2 {', '.join(lane_paths(fq2))}")
+        else:
+            # Lane files of one sample (_L001, _L002, ...) are paired by lane
+            # and read back to back.
+            _, FQ1, FQ2 = samples[0]
 
-        print("[Info] Detected R1 file:", FQ1)
-        print("[Info] Detected R2 file:", FQ2)
+            for fq1, fq2 in zip(lane_paths(FQ1), lane_paths(FQ2)):
+                print("[Info] Detected R1 file:", fq1)
+                print("[Info] Detected R2 file:", fq2)
+            if len(samples) > 1:
+                print(f"[Warning] {len(samples)} samples found; only the first is processed. "
+                      f"Use --batch to process every sample.")
 
-        outname2 = os.path.basename(FQ1).split("_")[0]
+            outname2 = os.path.basename(lane_paths(FQ1)[0]).split("_")[0]
 
         # os.system(f"rm -rf {options.output}")
 
@@ -73,60 +157,40 @@ def main():
             else:
                 print(f"目录已存在，跳过创建。：{output_path}")
 
-        BCfilelist = BCFunc.get_barcodes(options.barcode)
-
-        if options.step in ["all", "transform"]:
-            transformer = Transformer()
-            print("[Info] Running transform step...")
-
-            fq_file = os.path.join(options.output, options.readFolder + ".fq")
-            fq_file_d = os.path.join(options.output, options.readFolder + ".fqD")
-
-            with gzip.open(FQ1, "rb") as frdata1, gzip.open(FQ2, "rb") as frdata2, \
-                 open(fq_file, "w") as wr1, \
-                 open(fq_file_d, "w") as wr1d:
-                transformer.transform(
-                    FRdata1=frdata1,
-                    FRdata2=frdata2,
-                    WRdata1=wr1,
-                    WRdata1D=wr1d,
-                    BClist=BCfilelist,
-                    Outdir=options.output
-                )
-
-            print("-----------------Transform done-----------------")
-
-        if options.step in ["all", "count"]:
-            print("-----------------Barcode-UMI-Count analysis start-------------")
-
-            count_umi = CountUMI(
-                gtfname=options.gtfname,
-                genomedir=options.genomedir
-            )
-
-            fq_file = os.path.join(options.output, options.readFolder + "datanew_R2.fastq")
-            
-            count_umi.count(
-                fastqname=os.path.basename(fq_file),
-                outdirname=options.output,
-                outname=outname2
+        BCfilelist = BCFunc.build_index(options.barcode, max_mismatch=options.barcode_mismatch)
+        print(f"[Info] Loaded {len(BCfilelist)} barcodes "
+              f"({len(BCfilelist.table) - len(BCfilelist)} single-mismatch neighbours, "
+              f"{BCfilelist.n_ambiguous} ambiguous dropped)")
+
+        if options.batch:
+            from .batch import run_batch
+            run_batch(options, samples, BCfilelist)
+            print("-----------------Pipeline finished successfully!-----------------")
+            return
+
+        if options.shared_genome:
+            print("[Warning] --shared-genome only applies to --batch; ignoring it.")
+
+        # --stream-star: STAR reads datanew_R2 from a FIFO while the transform
+        # runs, so the count step below skips its own STAR call.
+        stream_star = options.stream_star and options.step == "all" and options.shards == 1
+        if options.stream_star and not stream_star:
+            print("[Warning] --stream-star only applies to --step all without --shards; ignoring it.")
+
+        plan = ResourcePlan.from_options(options, parallel=options.shards, stream_star=stream_star)
+        print(f"[Info] Resource plan: {plan}")
+        count_umi = CountUMI.from_options(options, plan)
+
+        if options.step == "all":
+            run_all_steps(options, FQ1, FQ2, options.output, BCfilelist, count_umi, outname2,
+                          stream_star)
+        elif options.step == "transform":
+            run_transform_step(
+                options, FQ1, FQ2, options.output,
+                BCfilelist, count_umi, outname2, stream_star
             )
-        
-
-        def cleanup_folder(output_dir):
-
-            keep_patterns = [
-                'gene_assigned.summary',
-                'counts.tsv.gz',
-                'Druglog.txt'
-            ]
-
-            for file_path in glob.glob(os.path.join(output_dir, '*')):
-                file_name = os.path.basename(file_path)
-                if any(pat in file_name for pat in keep_patterns):
-                    continue
-
-                os.remove(file_path)
+        else:
+            run_count_step(options, count_umi, options.output, outname2, stream_star)
 
         if not options.keep_temp_files:
             print("-----------------remove temp files with auto-clean-----------------")
@@ -0,0 +1,132 @@
+# metrics.py
+"""
+Per-stage run metrics, written to run_metrics.json in the output directory.
+
+StageMeter measures one stage: wall time, CPU time (this process plus every
+child it waited for: tools, samtools view, transform workers), peak RSS of
+this process during the stage and of the largest child, and optionally a
+cProfile dump. StageRunner (pipeline.py) adds the bytes of the stage's
+input and output files, record counts and records per second.
+"""
+
+import cProfile
+import json
+import os
+import resource
+import time
+
+METRICS_NAME = "run_metrics.json"
+
+
+def _reset_peak_rss():
+    # Linux >= 4.0 resets VmHWM (the peak RSS) when 5 is written here.
+    try:
+        with open("/proc/self/clear_refs", "w") as handle:
+            handle.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_kb():
+    try:
+        with open("/proc/self/status") as handle:
+            for line in handle:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+class StageMeter:
+    def __init__(self, profile_path=None):
+        self.profile_path = profile_path
+        self.metrics = {}
+
+    def __enter__(self):
+        self._per_stage_rss = _reset_peak_rss()
+        self._children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._cpu = time.process_time()
+        self._wall = time.time()
+        self._profiler = None
+        if self.profile_path:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._profiler is not None:
+            self._profiler.disable()
+            os.makedirs(os.path.dirname(self.profile_path) or ".", exist_ok=True)
+            self._profiler.dump_stats(self.profile_path)
+            self.metrics["profile"] = self.profile_path
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.metrics.update({
+            "wall_seconds": round(time.time() - self._wall, 3),
+            "cpu_seconds": round(time.process_time() - self._cpu
+                                 + _cpu_seconds(children) - _cpu_seconds(self._children), 3),
+            # Without clear_refs this is the process high-water mark so far.
+            "peak_rss_mb": round(_peak_rss_kb() / 1024, 1),
+            "peak_rss_per_stage": self._per_stage_rss,
+        })
+        # RUSAGE_CHILDREN.ru_maxrss is the largest child ever waited for, so
+        # it only describes this stage when it grew during it.
+        if children.ru_maxrss > self._children.ru_maxrss:
+            self.metrics["child_peak_rss_mb"] = round(children.ru_maxrss / 1024, 1)
+        return False
+
+
+class RunMetrics:
+    """
+    run_metrics.json: {"stages": {name: metrics}, "resources": plan, "disk":
+    peak and released MB}, updated one stage at a time.
+    """
+
+    def __init__(self, outdir):
+        self.path = os.path.join(outdir, METRICS_NAME)
+        self.stages = {}
+        self.resources = {}
+        self.disk = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as handle:
+                    data = json.load(handle)
+                self.stages = data.get("stages", {})
+                self.resources = data.get("resources", {})
+                self.disk = data.get("disk", {})
+            except ValueError:
+                print(f"[Warning] Ignoring unreadable {self.path}")
+
+    def record(self, name, metrics):
+        self.stages[name] = metrics
+        self._write()
+
+    def record_resources(self, plan):
+        """Record the resources.ResourcePlan (as_dict) the run used."""
+        self.resources = plan
+        self._write()
+
+    def record_disk(self, disk, merge=False):
+        """
+        Record the peak and released disk use (lifecycle.DiskMonitor.as_dict);
+        with merge, combine it with the recorded entry (larger peak, summed
+        releases).
+        """
+        if merge and self.disk:
+            disk = {"peak_mb": max(self.disk.get("peak_mb", 0), disk["peak_mb"]),
+                    "released_mb": round(self.disk.get("released_mb", 0)
+                                         + disk["released_mb"], 1)}
+        self.disk = disk
+        self._write()
+
+    def _write(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as handle:
+            json.dump({"stages": self.stages, "resources": self.resources, "disk": self.disk},
+                      handle, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
@@ -0,0 +1,524 @@
+# pipeline.py
+"""
+Resumable stage DAG for one sample.
+
+The pipeline is a chain of stages: transform -> align -> assign -> sort ->
+index -> count (sort/index only with --umi-counter umi_tools; with
+--assigner builtin the native count stage assigns genes itself; with
+--shards, scatter -> count, see scatter.py). After a
+stage succeeds, pipeline_manifest.json in the output directory records
+its input and output fingerprints (size, mtime and a content hash), its
+parameters and the versions of the tools it ran. On the next run a stage
+is skipped when all of that still matches, so a rerun resumes at the
+first stale or failed stage. Intermediates are deleted as soon as their
+last reader has succeeded and recorded as released (see lifecycle.py).
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import nullcontext
+
+from .diagnostics import SUMMARY_NAME, WELL_QC_NAME
+from .fastq_io import lane_paths, open_fastq, output_name, resolve_method
+from .lifecycle import DiskMonitor, format_bytes, is_final
+from .metrics import RunMetrics, StageMeter
+from .resources import GB, ResourcePlan
+from .runner import CommandResult, run_command_async, run_loop
+from .scatter import PARTIAL_NAME, shard_dirs
+from .star_stream import StarStream
+from .transformer import Transformer
+from .trimming import R2Trimmer
+
+MANIFEST_NAME = "pipeline_manifest.json"
+STAGES = ["transform", "align", "assign", "sort", "index", "scatter", "count"]
+
+# Bytes hashed from the start, middle and end of a file. Hashing whole
+# multi-GB FASTQ/BAM files would cost as much as the stages themselves;
+# size + sampled content catches rewrites, truncation and swapped files.
+HASH_SAMPLE = 1 << 20
+
+# Command printing each tool's version; featureCounts uses -v.
+TOOL_VERSION_ARGS = {
+    "STAR": ["STAR", "--version"],
+    "featureCounts": ["featureCounts", "-v"],
+    "samtools": ["samtools", "--version"],
+    "umi_tools": ["umi_tools", "--version"],
+}
+
+# run() may return None or a dict with "commands" (runner.CommandResult list),
+# "records" and "counters" for run_metrics.json. in_process marks stages
+# whose work is Python code in this process, the ones worth profiling.
+Stage = namedtuple("Stage", ["name", "inputs", "outputs", "params", "tools", "run", "in_process"])
+Stage.__new__.__defaults__ = (False,)
+
+
+def content_hash(path):
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as handle:
+        for offset in sorted({0, max(0, size // 2 - HASH_SAMPLE // 2), max(0, size - HASH_SAMPLE)}):
+            handle.seek(offset)
+            digest.update(handle.read(HASH_SAMPLE))
+    return digest.hexdigest()
+
+
+def fingerprint(path, previous=None):
+    """
+    Fingerprint a file (or a directory, e.g. the STAR index, by its listing).
+    The content hash is reused when size and mtime match the previous record.
+    """
+    if os.path.isdir(path):
+        listing = []
+        for name in sorted(os.listdir(path)):
+            st = os.stat(os.path.join(path, name))
+            listing.append(f"{name}:{st.st_size}:{st.st_mtime}")
+        return {"hash": hashlib.sha1("\n".join(listing).encode()).hexdigest()}
+    st = os.stat(path)
+    if previous and previous.get("size") == st.st_size and previous.get("mtime") == st.st_mtime:
+        return previous
+    return {"size": st.st_size, "mtime": st.st_mtime, "hash": content_hash(path)}
+
+
+_tool_versions = {}
+
+
+def _first_line(*paths):
+    for path in paths:
+        with open(path, errors="replace") as handle:
+            for line in handle:
+                if line.strip():
+                    return line.strip()
+    return "unknown"
+
+
+def probe_tool_versions(tools):
+    """Ask every not yet cached tool for its version, all at once."""
+    tools = sorted(set(tools) - set(_tool_versions))
+    if not tools:
+        return
+    with tempfile.TemporaryDirectory(prefix="drugstools_versions_") as log_dir:
+        commands = [{"argv": TOOL_VERSION_ARGS.get(tool, [tool, "--version"]), "name": tool,
+                     "log_dir": log_dir, "check": False, "timeout": 60} for tool in tools]
+
+        async def probe():
+            return await asyncio.gather(*[run_command_async(**c) for c in commands],
+                                        return_exceptions=True)
+
+        for tool, result in zip(tools, run_loop(probe())):
+            if isinstance(result, CommandResult):
+                _tool_versions[tool] = _first_line(result.stdout_path, result.stderr_path)
+            else:
+                _tool_versions[tool] = "not found"
+
+
+def tool_version(tool):
+    probe_tool_versions([tool])
+    return _tool_versions[tool]
+
+
+class Manifest:
+    def __init__(self, outdir):
+        self.path = os.path.join(outdir, MANIFEST_NAME)
+        self.stages = {}
+        # path: {"stage": producer, "fingerprint": ...} of deleted intermediates
+        self.released = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as handle:
+                    data = json.load(handle)
+                self.stages = data.get("stages", {})
+                self.released = data.get("released", {})
+            except ValueError:
+                print(f"[Warning] Ignoring unreadable {self.path}")
+
+    def get(self, name):
+        return self.stages.get(name)
+
+    def record(self, name, entry):
+        self.stages[name] = entry
+        self._write()
+
+    def release(self, path, stage):
+        """Record that stage's output path was deleted on purpose."""
+        fp = self.stages.get(stage, {}).get("outputs", {}).get(path)
+        self.released[path] = {"stage": stage, "fingerprint": fp}
+        self._write()
+
+    def is_released(self, path, recorded):
+        """True if path is missing because it was released as recorded."""
+        entry = self.released.get(path)
+        return entry is not None and entry["fingerprint"] == recorded and not os.path.exists(path)
+
+    def _write(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as handle:
+            json.dump({"stages": self.stages, "released": self.released}, handle,
+                      indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def _total_bytes(paths):
+    return sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+
+
+class StageRunner:
+    def __init__(self, manifest, force=False, metrics=None, profile_dir=None, disk=None):
+        self.manifest = manifest
+        self.force = force
+        self.metrics = metrics
+        self.profile_dir = profile_dir
+        # lifecycle.DiskMonitor for the per-stage peak disk use
+        self.disk = disk
+
+    def stale_reason(self, stage, force=False):
+        """Return why stage must run, or None when it is up to date."""
+        if self.force or force:
+            return "forced"
+        entry = self.manifest.get(stage.name)
+        if entry is None:
+            return "never run"
+        if entry.get("status") != "done":
+            return f"previous run {entry.get('status')}"
+        if entry.get("params") != stage.params:
+            return "parameters changed"
+        if entry.get("tools") != {tool: tool_version(tool) for tool in stage.tools}:
+            return "tool versions changed"
+        for kind, paths in (("inputs", stage.inputs), ("outputs", stage.outputs)):
+            recorded = entry.get(kind, {})
+            if sorted(recorded) != sorted(paths):
+                return f"{kind} changed"
+            for path in paths:
+                if self.manifest.is_released(path, recorded[path]):
+                    continue
+                if not os.path.exists(path):
+                    return f"{path} is missing"
+                if fingerprint(path, recorded[path]) != recorded[path]:
+                    return f"{path} changed"
+        return None
+
+    def run(self, stage, force=False):
+        reason = self.stale_reason(stage, force)
+        if reason is None:
+            print(f"[Info] Stage '{stage.name}' is up to date, skipping.")
+            if self.metrics is not None:
+                self.metrics.record(stage.name, {"status": "skipped"})
+            return False
+        print(f"[Info] Running stage '{stage.name}' ({reason})")
+        entry = {
+            "params": stage.params,
+            "tools": {tool: tool_version(tool) for tool in stage.tools},
+            "inputs": {path: fingerprint(path) for path in stage.inputs},
+            "started": time.time(),
+        }
+        profile_path = None
+        if self.profile_dir and stage.in_process:
+            profile_path = os.path.join(self.profile_dir, stage.name + ".prof")
+        meter = StageMeter(profile_path)
+        if self.disk is not None:
+            self.disk.start_stage()
+        try:
+            with meter:
+                report = stage.run() or {}
+        except BaseException as e:
+            entry["status"] = "failed"
+            entry["error"] = repr(e)
+            self.manifest.record(stage.name, entry)
+            self._record_metrics(stage, meter, {}, "failed")
+            raise
+        entry["outputs"] = {path: fingerprint(path) for path in stage.outputs}
+        for path in stage.outputs:
+            self.manifest.released.pop(path, None)
+        entry["status"] = "done"
+        entry["finished"] = time.time()
+        self.manifest.record(stage.name, entry)
+        self._record_metrics(stage, meter, report, "done")
+        return True
+
+    def _record_metrics(self, stage, meter, report, status):
+        if self.metrics is None:
+            return
+        metrics = dict(meter.metrics, status=status)
+        if self.disk is not None:
+            metrics["peak_disk_mb"] = self.disk.end_stage()
+        metrics["bytes_read"] = _total_bytes(stage.inputs)
+        metrics["bytes_written"] = _total_bytes(stage.outputs)
+        records = report.get("records")
+        if records is not None:
+            metrics["records"] = records
+            if metrics.get("wall_seconds"):
+                metrics["records_per_second"] = round(records / metrics["wall_seconds"], 1)
+        if report.get("counters"):
+            metrics["counters"] = report["counters"]
+        metrics["commands"] = [r.as_dict() for r in report.get("commands", [])]
+        self.metrics.record(stage.name, metrics)
+
+
+class SamplePipeline:
+    """The stages of one sample, built from the command-line options."""
+
+    def __init__(self, options, count_umi, outdir, outname, FQ1=None, FQ2=None,
+                 BCfilelist=None, stream_star=False, log_filename=None):
+        self.options = options
+        self.count_umi = count_umi
+        self.outdir = outdir
+        self.outname = outname
+        self.FQ1 = FQ1
+        self.FQ2 = FQ2
+        self.BCfilelist = BCfilelist
+        self.stream_star = stream_star
+        self.log_filename = log_filename
+        profile_dir = None
+        if getattr(options, "profile", False):
+            profile_dir = os.path.join(outdir, "logs", f"{outname}_profile")
+        # Threads and memory per tool (resources.py); planned in run() when
+        # count_umi was built without one.
+        self.plan = count_umi.plan
+        self.runner = StageRunner(Manifest(outdir), force=getattr(options, "force", False),
+                                  metrics=RunMetrics(outdir), profile_dir=profile_dir)
+        # Delete intermediates once their last reader is done (lifecycle.py).
+        self.release = not getattr(options, "keep_temp_files", True)
+        budget = getattr(options, "disk_budget_gb", None)
+        self.disk_budget = int(budget * GB) if budget else None
+
+    def stage_names(self, step):
+        names = []
+        if step in ["all", "transform"]:
+            names.append("transform")
+        if step in ["all", "count"]:
+            # With --stream-star, STAR runs inside the transform stage.
+            names += self.count_umi.stage_names(run_star=not self.stream_star)
+        return names
+
+    def run(self, names, merge_disk=False):
+        """
+        Run names in order. merge_disk: this run continues one whose disk use
+        is already in run_metrics.json (batch mode runs the count stages in a
+        second process), so the peaks are combined rather than replaced.
+        """
+        if self.plan is None:
+            self.plan = ResourcePlan.from_options(self.options)
+        self.runner.metrics.record_resources(self.plan.as_dict())
+        probe_tool_versions(tool for name in names for tool in self.stage(name).tools)
+        with DiskMonitor(self.outdir, budget_bytes=self.disk_budget) as disk:
+            self.runner.disk = disk
+            try:
+                self._run_stages(names, disk)
+            finally:
+                self.runner.disk = None
+                self.runner.metrics.record_disk(disk.as_dict(), merge=merge_disk)
+        print(f"[Info] Peak disk use of {self.outdir}: {format_bytes(disk.peak)} "
+              f"({format_bytes(disk.released)} of intermediates released)")
+
+    def _run_stages(self, names, disk):
+        manifest = self.runner.manifest
+        chain = self.stage_names("all")
+        forced = set()
+        i = 0
+        while i < len(names):
+            name = names[i]
+            stage = self.stage(name)
+            released = [path for path in stage.inputs
+                        if path in manifest.released and not os.path.exists(path)]
+            if released and self.runner.stale_reason(stage, name in forced) is not None:
+                producer = manifest.released[released[0]]["stage"]
+                if producer in forced or not (producer in names[:i] or self._can_build(producer)):
+                    raise RuntimeError(f"{released[0]} was deleted after use and stage "
+                                       f"'{producer}' is not part of this run; rerun with "
+                                       f"--step all to recreate it")
+                print(f"[Info] Stage '{name}' needs the released {released[0]}; "
+                      f"rerunning '{producer}'")
+                forced.add(producer)
+                if producer not in names[:i]:
+                    names = names[:i] + [producer] + names[i:]
+                i = names.index(producer)
+                continue
+            self.runner.run(stage, name in forced)
+            if self.release and name in chain:
+                self._release_after(chain, chain.index(name), disk)
+            i += 1
+
+    def _can_build(self, name):
+        """True if stage name can run here; the transform needs the reads and barcodes."""
+        if name == "transform":
+            return self.FQ1 is not None and self.BCfilelist is not None
+        return name in self.stage_names("count")
+
+    def _stage_files(self, name):
+        """(inputs, outputs) of a stage; the transform's inputs are never released."""
+        if name == "transform":
+            return [], self._transform_outputs()
+        stage = self.stage(name)
+        return stage.inputs, stage.outputs
+
+    def _release_after(self, chain, index, disk):
+        """Delete the outputs of chain[:index + 1] that no later stage reads."""
+        manifest = self.runner.manifest
+        later = {path for name in chain[index + 1:] for path in self._stage_files(name)[0]}
+        for name in chain[:index + 1]:
+            entry = manifest.get(name)
+            if not entry or entry.get("status") != "done":
+                continue
+            for path in self._stage_files(name)[1]:
+                if path in later or is_final(path) or not os.path.isfile(path):
+                    continue
+                size = os.path.getsize(path)
+                os.remove(path)
+                manifest.release(path, name)
+                disk.released += size
+                print(f"[Info] Released {os.path.basename(path)} ({format_bytes(size)}) "
+                      f"after stage '{chain[index]}'")
+
+    def _log(self):
+        if self.log_filename is None:
+            self.log_filename = self.count_umi.log_name()
+        return self.log_filename
+
+    def _count_stage(self, name):
+        def run():
+            return self.count_umi.run_stage(name, self.outdir, self.outname, self._log())
+        return run
+
+    def stage(self, name):
+        options = self.options
+        count_umi = self.count_umi
+        paths = count_umi.paths(self.outdir, self.outname)
+        star_params = {"genomedir": os.path.abspath(count_umi.genomedir)}
+        if name == "transform":
+            level = options.compress_level
+            outputs = self._transform_outputs()
+            params = {
+                "same_seq": Transformer().same_seq,
+                # The whitelist as loaded, rather than the -b file itself.
+                "barcodes": hashlib.sha1("\n".join(self.BCfilelist.barcodes).encode()).hexdigest(),
+                "barcode_mismatch": self.BCfilelist.max_mismatch,
+                "compress_level": level,
+                "top_barcodes": options.top_barcodes,
+                "sample_reads": options.sample_reads,
+                "collapse": options.collapse_duplicates,
+                "well_qc": options.well_qc,
+                "fraction": options.fraction,
+                "max_reads": options.max_reads,
+                "stream_star": self.stream_star,
+            }
+            trimmer = R2Trimmer.from_options(options)
+            if trimmer is not None:
+                params["trim_r2"] = trimmer.params()
+            tools = []
+            if self.stream_star:
+                params.update(star_params)
+                tools.append("STAR")
+            return Stage(name, lane_paths(self.FQ1) + lane_paths(self.FQ2), outputs, params, tools,
+                         self._run_transform, in_process=True)
+        if name == "align":
+            return Stage(name, [paths["infile"], count_umi.genomedir], [paths["outbam"]],
+                         star_params, ["STAR"], self._count_stage(name))
+        if name == "assign":
+            builtin = count_umi.assigner == "builtin"
+            return Stage(name, [paths["outbam"], count_umi.gtfname],
+                         [paths["assigned_bam"], paths["summary"]],
+                         {"assigner": count_umi.assigner},
+                         ["samtools"] if builtin else ["featureCounts"], self._count_stage(name),
+                         in_process=builtin)
+        if name == "sort":
+            return Stage(name, [paths["assigned_bam"]], [paths["sorted_bam"]], {}, ["samtools"],
+                         self._count_stage(name))
+        if name == "index":
+            return Stage(name, [paths["sorted_bam"]], [paths["sorted_bai"]], {}, ["samtools"],
+                         self._count_stage(name))
+        if name == "scatter":
+            builtin = count_umi.assigner == "builtin"
+            inputs = [paths["infile"], count_umi.genomedir, count_umi.gtfname]
+            if count_umi.collapse:
+                inputs.append(paths["duplicates"])
+            partials = [os.path.join(d, PARTIAL_NAME)
+                        for d in shard_dirs(self.outdir, count_umi.shards)]
+            params = dict(star_params, shards=count_umi.shards, assigner=count_umi.assigner,
+                          collapse=count_umi.collapse)
+            tools = ["STAR", "samtools"] + ([] if builtin else ["featureCounts"])
+            return Stage(name, inputs, partials, params, tools, self._count_stage(name))
+        if name == "count":
+            prefix = paths["outfile"]
+            outputs = [paths["counts"], prefix + "_matrix.mtx.gz", prefix + "_features.tsv",
+                       prefix + "_barcodes.tsv"]
+            if count_umi.npz:
+                outputs.append(prefix + "_counts.npz")
+            params = {"umi_counter": count_umi.umi_counter, "umi_method": count_umi.umi_method}
+            if count_umi.umi_counter == "umi_tools":
+                inputs, tools = [paths["sorted_bam"], paths["sorted_bai"]], ["umi_tools"]
+            elif count_umi.shards > 1:
+                # The shards were assigned and collected in the scatter stage.
+                inputs = [os.path.join(d, PARTIAL_NAME)
+                          for d in shard_dirs(self.outdir, count_umi.shards)]
+                return Stage(name, inputs, outputs + [paths["summary"]], params, [],
+                             self._count_stage(name), in_process=True)
+            elif count_umi.fused_count:
+                inputs, tools = [paths["outbam"], count_umi.gtfname], ["samtools"]
+                outputs.append(paths["summary"])
+                params["assigner"] = "builtin"
+            else:
+                inputs, tools = [paths["assigned_bam"]], ["samtools"]
+            if count_umi.umi_counter != "umi_tools":
+                if count_umi.collapse:
+                    inputs.append(paths["duplicates"])
+                    params["collapse"] = True
+            return Stage(name, inputs, outputs, params, tools, self._count_stage(name),
+                         in_process=count_umi.umi_counter != "umi_tools")
+        raise ValueError(f"Unknown stage '{name}', choose from {STAGES}")
+
+    def _transform_outputs(self):
+        options = self.options
+        level = options.compress_level
+        paths = self.count_umi.paths(self.outdir, self.outname)
+        outputs = [os.path.join(self.outdir, output_name(n, level))
+                   for n in ("datanew_R1.fastq", "Obread1.fastq", "Obread2.fastq")]
+        outputs.append(os.path.join(self.outdir, SUMMARY_NAME))
+        if options.collapse_duplicates:
+            outputs.append(paths["duplicates"])
+        if options.well_qc:
+            outputs.append(os.path.join(self.outdir, WELL_QC_NAME))
+        if self.stream_star:
+            outputs.append(paths["outbam"])
+        else:
+            outputs.insert(1, os.path.join(self.outdir, output_name("datanew_R2.fastq", level)))
+        return outputs
+
+    def _run_transform(self):
+        options = self.options
+        transformer = Transformer()
+        print("[Info] Running transform step...")
+
+        print(f"[Info] Decompressing input with: {resolve_method(options.decompressor)}")
+
+        lanes = len(lane_paths(self.FQ1))
+        if lanes > 1:
+            print(f"[Info] Reading {lanes} lanes back to back")
+        prefetch = options.lane_prefetch
+        with open_fastq(self.FQ1, options.decompressor, prefetch) as frdata1, \
+             open_fastq(self.FQ2, options.decompressor, prefetch) as frdata2, \
+             (StarStream(self.count_umi, self.outdir, self.outname, self._log())
+              if self.stream_star else nullcontext()) as r2_handle:
+            stats = transformer.transform(
+                FRdata1=frdata1,
+                FRdata2=frdata2,
+                BClist=self.BCfilelist,
+                Outdir=self.outdir,
+                workers=self.plan.transform_workers,
+                compress_level=options.compress_level,
+                compress_threads=self.plan.compress_threads,
+                r2_handle=r2_handle,
+                top_barcodes=options.top_barcodes,
+                sample_reads=options.sample_reads,
+                collapse=options.collapse_duplicates,
+                trimmer=R2Trimmer.from_options(options),
+                well_qc=options.well_qc,
+                fraction=options.fraction,
+                max_reads=options.max_reads
+            )
+
+        print("-----------------Transform done-----------------")
+        return {"records": stats["reads"], "counters": stats}
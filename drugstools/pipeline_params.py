@@ -15,7 +15,7 @@ def get_parser():
     中文：
     -f, --readFolder
       RNA-seq读段所在文件夹，需包含gz格式的FASTQ文件，
-      文件名应包含 *_1*.gz 与 *_2*.gz。
+      文件名应包含 *_1*.gz 与 *_2*.gz（或 *_R1*.gz 与 *_R2*.gz）。
 
     -b, --barcode
       条形码文件路径，文件中每行包含一个barcode序列。
@@ -30,7 +30,14 @@ def get_parser():
       STAR 基因组索引文件夹路径，例如 /path/to/star_genomeIndex/。
 
     --keep-temp-files
-      默认删除中间产物，若指定此参数则保留这些文件。
+      默认删除中间产物，若指定此参数则保留这些文件。默认情况下，每个中间文件在最后一个
+      读取它的阶段成功后立即删除（记录在 pipeline_manifest.json 中），输出目录的磁盘峰值
+      记录在 run_metrics.json。
+
+    --disk-budget-gb
+      磁盘预算 (GB)。批量模式下，仅当同时运行样本的估计磁盘峰值之和不超过该预算时才启动
+      新样本；单样本运行时超出预算会给出警告。估计值为 gz 输入大小的固定倍数，预算只用于
+      调度，不会中止已在运行的样本；实际峰值见 run_metrics.json。默认不限制。
 
     --check-installation
       检查并尝试自动安装所需的外部依赖（STAR、samtools、featureCounts、umi_tools）。
@@ -38,10 +45,125 @@ def get_parser():
     --step
       选择运行流程的步骤：可选 'all'（默认），'transform'，'count'。
 
+    --barcode-mismatch
+      条形码允许的错配数 (0 或 1)，默认 1：与唯一白名单条形码相差一个碱基的读段会被校正。
+
+    --transform-workers
+      transform 步骤使用的进程数，默认由资源规划自动确定（见 --resources）。输出顺序与单进程一致。
+
+    --decompressor
+      输入 gz 文件的解压方式：auto（默认，优先使用 PATH 中的 pigz/igzip，否则使用后台线程解压）、
+      pigz、igzip、thread、gzip。R1 与 R2 在各自的进程/线程中同时解压。
+
+    --lane-prefetch
+      样本分多个 lane 测序时（如 _L001/_L002），各 lane 文件按 lane 配对、依次连续读入，无需预先合并。
+      该参数指定提前启动解压的后续 lane 数（默认 1，0 表示逐个 lane 解压）。
+
+    --compress-level
+      transform 输出 (datanew_R1/R2、Obread1/2) 以 BGZF(.gz) 压缩写出时使用的压缩级别 (0-9)；
+      默认不压缩。STAR 会通过 --readFilesCommand zcat 读取压缩后的 R2。
+
+    --compress-threads
+      后台压缩线程数，默认由资源规划自动确定（最多 4）。
+
+    --stream-star
+      仅用于 --step all：先启动 STAR，并通过命名管道 (FIFO) 将 transform 产生的 R2 直接送入 STAR，
+      比对与条形码提取同时进行，datanew_R2.fastq 不再写入磁盘。
+
+    --batch
+      批量模式：按样本前缀配对 readFolder 中所有 R1/R2 文件并全部处理。每个样本有独立的输出子目录
+      (<outputDir>/<样本名>/) 和日志 Druglog.txt。
+
+    --cores / --memory-gb
+      本次运行可用的 CPU 核数和内存 (GB)，默认自动检测（考虑 CPU 亲和性与 cgroup 限制）。
+      资源规划据此为 transform、STAR、featureCounts 和 samtools 分配线程与内存。
+
+    --star-memory-gb
+      每个 STAR 任务所需内存 (GB)，用于限制同时运行的 STAR 数量，默认 32。
+
+    --shared-genome
+      批量模式下只将 STAR 基因组索引加载一次到共享内存 (--genomeLoad LoadAndKeep)，所有样本共用，
+      结束时（包括出错或 Ctrl-C）自动卸载，并报告加载/卸载耗时。
+
+    --umi-counter
+      UMI 计数方式：native（默认，直接流式读取 featureCounts 注释后的 BAM，在进程内按 (孔, 基因) 去重计数，
+      无需 samtools sort/index）或 umi_tools（原有的 samtools sort + index + umi_tools count 流程）。
+
+    --umi-method
+      native 计数的 UMI 去重方法：directional（默认，与 umi_tools 相同）或 unique。
+
+    --npz
+      除 *_counts.tsv.gz 和稀疏矩阵 (*_matrix.mtx.gz、*_features.tsv、*_barcodes.tsv) 外，
+      另存 NumPy CSR 格式的 *_counts.npz（需要 numpy）。可用 drugstools.sparse.load_counts 读取。
+
+    --force
+      忽略输出目录中的 pipeline_manifest.json，重新运行所有阶段。默认跳过输入、参数和
+      工具版本均未改变的阶段；已删除的中间文件也记录在其中，不会导致重新运行。
+
+    --command-timeout
+      每个外部工具（STAR、featureCounts、samtools、umi_tools）的最长运行秒数，超时即终止并报错。
+      各工具的输出保存在 <outputDir>/logs/<样本>_<阶段>.out/.err。默认不限时。
+
+    --profile
+      对在 Python 进程内运行的阶段（transform、原生 UMI 计数）做 cProfile 分析，结果保存到
+      <outputDir>/logs/<样本>_profile/<阶段>.prof。各阶段的耗时、内存峰值、读写字节数与
+      处理速度始终记录在 <outputDir>/run_metrics.json。
+
+    --top-barcodes
+      transform_summary.json 中列出的最常见未匹配条形码数量（默认 20）。该文件记录保留、
+      过短（Obread）、条形码未匹配和无接头序列的 reads 数，取代原来的 .fq/.fqD 文件。
+
+    --sample-reads
+      在 transform_summary.json 中随机保留 N 条未通过的原始 R1 reads 便于排查（默认 0）。
+
+    --fraction / --max-reads
+      快速预览模式：--fraction F 仅保留约 F 比例的 read 对（如 0.02），按 read 名称的哈希选取，
+      重复运行及不同 lane 结果一致；--max-reads N 只读取前 N 个 read 对，之后不再解压剩余输入。
+      后续比对与计数均在缩减后的数据上运行。
+
+    --well-qc
+      开启 transform 过程中的每孔快速质控：在读取 FASTQ 的同时统计每孔 reads 数，
+      用 HyperLogLog 估计每孔不同 UMI 数与 UMI 饱和度，每分钟及结束时写入 well_qc.tsv，
+      便于在比对前发现失败的孔或板并提前终止。会使 transform 变慢，默认关闭。
+
+    --trim-quality / --trim-adapter / --trim-polya / --min-r2-length
+      在 transform 的同一次遍历中修剪 R2（cDNA）：按质量值从 3' 端修剪低质量碱基 (--trim-quality Q)，
+      在接头序列处截断 (--trim-adapter 序列)，去除 3' 端 polyA 尾 (--trim-polya)，修剪后短于
+      --min-r2-length 的 read 对直接丢弃，不再送入 STAR。默认均不启用。
+
+    --collapse-duplicates
+      在比对前合并条形码、UMI 与 R2 序列均相同的 PCR 重复 reads，仅比对一条代表序列，
+      重复数记录在 duplicates.tsv.gz 中，计数时还原。仅适用于 --umi-counter native。
+
+    --assigner
+      基因注释方式：featurecounts（默认，调用 featureCounts）或 builtin（内置注释：GTF 只解析一次，
+      索引缓存在 GTF 旁的 <gtf>.<hash>.geneidx；配合 --umi-counter native 时注释与计数一次完成，
+      不再生成 .featureCounts.bam）。
+
+    --resources
+      覆盖自动资源规划中的取值，格式 key=value[,key=value]，可用的键：transform_workers、
+      compress_threads、star_threads、bam_sort_ram（字节）、featurecounts_threads、
+      samtools_threads、sort_memory_mb。最终规划会打印并记录在 run_metrics.json 中。
+
+    --shards
+      将 transform 后的 reads 拆分为 N 份，分别比对、注释并收集 UMI 表，最后精确合并
+      （同一孔的 UMI 分布在不同分片中也不影响计数）。默认 1（不拆分）。仅适用于 --umi-counter native。
+
+    --shard-workers
+      本机同时处理的分片数，默认按 CPU 核数与 --star-memory-gb 自动确定。
+
+    --shard-queue
+      共享文件系统上的任务队列目录：分片任务写入该目录，其他节点可运行
+      python -m drugstools.scatter <目录> 领取任务；主进程同时也处理队列中的任务。
+      工作进程超过 5 分钟没有心跳的任务会被重新放回队列。
+
+    --shard-timeout
+      等待队列中全部分片任务完成的最长秒数，超时则报错退出。默认不限制。
+
     英文：
     -f, --readFolder
       Directory containing gzipped FASTQ files. Filenames should include '*_1*.gz'
-      and '*_2*.gz'.
+      and '*_2*.gz' (or '*_R1*.gz' and '*_R2*.gz').
 
     -b, --barcode
       Path to a text file listing barcodes (one barcode per line).
@@ -57,6 +179,17 @@ def get_parser():
 
     --keep-temp-files
       By default, intermediate files are deleted. Use this option to keep them.
+      Without it, each intermediate is deleted as soon as the last stage
+      reading it has succeeded (recorded in pipeline_manifest.json), and the
+      peak disk use of the output directory goes to run_metrics.json.
+
+    --disk-budget-gb
+      Disk budget in GB. Batch mode only starts a sample while the estimated
+      peak disk use of the samples running at once fits; a single-sample run
+      warns when it goes over. The estimate is a fixed multiple of the gzipped
+      input size and the budget only schedules samples: a running sample is
+      never stopped. The measured peak is in run_metrics.json. No limit by
+      default.
 
     --check-installation
       Check and attempt to auto-install required dependencies (STAR, samtools, 
@@ -65,6 +198,156 @@ def get_parser():
     --step
       Choose which pipeline step(s) to run: 'all' (default), 'transform', or 'count'.
 
+    --barcode-mismatch
+      Mismatches allowed when matching barcodes (0 or 1). Default 1: reads one base
+      away from a single whitelisted barcode are corrected to it.
+
+    --transform-workers
+      Number of worker processes for the transform step. Chosen by the
+      resource plan by default (see --resources). Output order is identical
+      to the serial run.
+
+    --decompressor
+      How gzipped input is decompressed: auto (default; pigz/igzip from PATH if
+      available, otherwise a background read-ahead thread), pigz, igzip, thread or
+      gzip. R1 and R2 are decompressed concurrently in separate processes/threads.
+
+    --lane-prefetch
+      A sample sequenced on several lanes (_L001, _L002, ...) is read lane by
+      lane, R1 and R2 paired by lane, as one stream with no concatenated copy.
+      This many following lanes are already being decompressed while the
+      current one is read (default 1; 0 decompresses one lane at a time).
+
+    --compress-level
+      Write the transform outputs (datanew_R1/R2, Obread1/2) as BGZF (.gz) at this
+      compression level (0-9). Default: uncompressed. STAR then reads the
+      compressed R2 through --readFilesCommand zcat.
+
+    --compress-threads
+      Number of background compression threads. Chosen by the resource plan
+      by default (at most 4).
+
+    --stream-star
+      Only with --step all: start STAR first and feed it the transformed R2 reads
+      through a named pipe (FIFO), so alignment overlaps with barcode extraction
+      and datanew_R2.fastq is never written to disk.
+
+    --batch
+      Batch mode: pair every R1/R2 file in readFolder by sample prefix and process
+      them all. Each sample gets its own output subdirectory (<outputDir>/<sample>/)
+      and its own Druglog.txt.
+
+    --cores / --memory-gb
+      Cores and memory (GB) available to the run. Detected automatically by
+      default, honouring the CPU affinity mask and cgroup limits. The resource
+      plan divides them into threads and memory for the transform, STAR,
+      featureCounts and samtools.
+
+    --star-memory-gb
+      Memory (GB) needed by one STAR job; caps how many run at once. Default 32.
+
+    --shared-genome
+      In batch mode, load the STAR genome index into shared memory once
+      (--genomeLoad LoadAndKeep) and align every sample against it. The index is
+      always unloaded at the end, including on errors or Ctrl-C, and the load and
+      unload times are reported.
+
+    --umi-counter
+      How UMIs are counted: native (default; stream the featureCounts-annotated BAM
+      once and deduplicate per (well, gene) in-process, no samtools sort/index) or
+      umi_tools (the previous samtools sort + index + umi_tools count chain).
+
+    --umi-method
+      UMI deduplication for the native counter: directional (default, as in
+      umi_tools) or unique.
+
+    --npz
+      Besides *_counts.tsv.gz and the sparse matrix (*_matrix.mtx.gz,
+      *_features.tsv, *_barcodes.tsv), also write a NumPy CSR *_counts.npz
+      (requires numpy). Load either with drugstools.sparse.load_counts.
+
+    --force
+      Ignore pipeline_manifest.json in the output directory and rerun every
+      stage. By default, stages whose inputs, parameters and tool versions are
+      unchanged are skipped. Released intermediates are recorded there too
+      and do not cause a rerun.
+
+    --command-timeout
+      Seconds each external tool (STAR, featureCounts, samtools, umi_tools)
+      may run before it is stopped and the run fails. Each tool's output is
+      kept in <outputDir>/logs/<sample>_<stage>.out/.err. No limit by default.
+
+    --profile
+      Run the in-process Python stages (transform, native UMI counting) under
+      cProfile and save <outputDir>/logs/<sample>_profile/<stage>.prof. Time,
+      peak memory, bytes and throughput of every stage are always recorded
+      in <outputDir>/run_metrics.json.
+
+    --top-barcodes
+      Number of most frequent unmatched barcodes listed in
+      transform_summary.json (default 20). The file also counts kept, short
+      (Obread), barcode-miss and no-linker reads, replacing the .fq/.fqD files.
+
+    --sample-reads
+      Keep a random sample of N failed raw R1 reads in transform_summary.json
+      for debugging (default 0).
+
+    --fraction / --max-reads
+      Quick-look mode. --fraction F keeps about a fraction F of the read pairs
+      (e.g. 0.02), chosen by a hash of the read name, so reruns and lanes keep
+      the same pairs; --max-reads N reads only the first N pairs and never
+      decompresses the rest. Alignment and counting then run on the reduced set.
+
+    --well-qc
+      Quick-look per-well QC: the transform counts reads per well and
+      estimates distinct UMIs per well (HyperLogLog) and the UMI saturation,
+      writing well_qc.tsv every minute and at its end, so failed wells or
+      plates show up before the alignment is paid for. Off by default, as it
+      slows the transform down.
+
+    --trim-quality / --trim-adapter / --trim-polya / --min-r2-length
+      Trim R2 (cDNA) in the same pass as the transform: low-quality 3' bases
+      below Q (--trim-quality Q), everything from the adapter on (--trim-adapter
+      SEQ), and the 3' polyA tail (--trim-polya). Pairs left shorter than
+      --min-r2-length are dropped and never reach STAR. All off by default.
+
+    --collapse-duplicates
+      Before alignment, collapse PCR duplicates (same barcode, UMI and R2
+      sequence) to one representative read; multiplicities are kept in
+      duplicates.tsv.gz and restored when counting. Needs --umi-counter native.
+
+    --assigner
+      How reads are assigned to genes: featurecounts (default, runs
+      featureCounts) or builtin (the GTF is parsed once and the index cached
+      next to it as <gtf>.<hash>.geneidx; with --umi-counter native, assignment
+      and counting happen in one pass and no .featureCounts.bam is written).
+
+    --resources
+      Override values of the automatic resource plan, as key=value[,key=value].
+      Keys: transform_workers, compress_threads, star_threads, bam_sort_ram
+      (bytes), featurecounts_threads, samtools_threads, sort_memory_mb. The
+      final plan is printed and recorded in run_metrics.json.
+
+    --shards
+      Split the transformed reads into N shards that are aligned, assigned and
+      collected independently, then merge the per-shard UMI tables exactly (a
+      well's UMIs may land in different shards). Default 1 (no splitting).
+      Needs --umi-counter native.
+
+    --shard-workers
+      Shards processed at once on this node. By default derived from the cores
+      and --star-memory-gb.
+
+    --shard-queue
+      Job queue directory on a shared filesystem: shard jobs are written there
+      and workers on other nodes can claim them with
+      python -m drugstools.scatter <dir>. The main process works the queue too.
+      Jobs whose worker has sent no heartbeat for 5 minutes are requeued.
+
+    --shard-timeout
+      Seconds to wait for all queued shard jobs before failing the run.
+      No limit by default.
+
     示例 (Example):
         python pipeline_main.py \\
             -f /path/to/readFolder \\
@@ -90,7 +373,7 @@ def get_parser():
         action="store",
         dest="readFolder",
         help=(
-            "中文：RNA-seq读段所在文件夹 (包含 *_1*.gz, *_2*.gz)\n\n"
+            "中文：RNA-seq读段所在文件夹 (包含 *_1*.gz, *_2*.gz 或 *_R1*.gz, *_R2*.gz)\n\n"
             "English: Path to the folder containing gzipped FASTQ files."
         )
     )
@@ -146,6 +429,19 @@ def get_parser():
         )
     )
 
+    parser.add_option(
+        "--disk-budget-gb",
+        action="store",
+        type="float",
+        dest="disk_budget_gb",
+        default=None,
+        help=(
+            "中文：磁盘预算 (GB)；批量模式按样本估计磁盘峰值控制并发，默认不限制\n\n"
+            "English: Disk budget in GB. Batch mode only starts samples whose estimated peak "
+            "disk use fits; this is a scheduling estimate, not a hard limit. No limit by default."
+        )
+    )
+
     parser.add_option(
         "--check-installation",
         action="store_true",
@@ -169,4 +465,405 @@ def get_parser():
         )
     )
 
+    parser.add_option(
+        "--barcode-mismatch",
+        action="store",
+        type="int",
+        dest="barcode_mismatch",
+        default=1,
+        help=(
+            "中文：条形码允许的错配数 (0 或 1)，默认 1\n\n"
+            "English: Mismatches allowed when matching barcodes (0 or 1). Default 1."
+        )
+    )
+
+    parser.add_option(
+        "--transform-workers",
+        action="store",
+        type="int",
+        dest="transform_workers",
+        default=None,
+        help=(
+            "中文：transform 步骤使用的进程数，默认自动\n\n"
+            "English: Number of worker processes for the transform step. Default: automatic."
+        )
+    )
+
+    parser.add_option(
+        "--decompressor",
+        action="store",
+        type="choice",
+        choices=["auto", "pigz", "igzip", "thread", "gzip"],
+        dest="decompressor",
+        default="auto",
+        help=(
+            "中文：输入 gz 文件的解压方式 (auto/pigz/igzip/thread/gzip)，默认 auto\n\n"
+            "English: How gzipped input is decompressed (auto/pigz/igzip/thread/gzip). Default 'auto'."
+        )
+    )
+
+    parser.add_option(
+        "--lane-prefetch",
+        action="store",
+        type="int",
+        dest="lane_prefetch",
+        default=1,
+        help=(
+            "中文：多 lane 输入时提前开始解压的后续 lane 数，默认 1\n\n"
+            "English: With multi-lane input, how many following lanes are decompressed ahead. Default: 1."
+        )
+    )
+
+    parser.add_option(
+        "--compress-level",
+        action="store",
+        type="int",
+        dest="compress_level",
+        default=None,
+        help=(
+            "中文：以 BGZF(.gz) 压缩 transform 输出的压缩级别 (0-9)，默认不压缩\n\n"
+            "English: Compress the transform outputs as BGZF (.gz) at this level (0-9). "
+            "Default: uncompressed."
+        )
+    )
+
+    parser.add_option(
+        "--compress-threads",
+        action="store",
+        type="int",
+        dest="compress_threads",
+        default=None,
+        help=(
+            "中文：后台压缩线程数，默认自动（最多 4）\n\n"
+            "English: Number of background compression threads. Default: automatic (at most 4)."
+        )
+    )
+
+    parser.add_option(
+        "--stream-star",
+        action="store_true",
+        dest="stream_star",
+        default=False,
+        help=(
+            "中文：通过命名管道将 transform 输出的 R2 直接送入 STAR (仅 --step all)\n\n"
+            "English: Stream the transformed R2 reads into STAR through a named pipe "
+            "(--step all only)."
+        )
+    )
+
+    parser.add_option(
+        "--batch",
+        action="store_true",
+        dest="batch",
+        default=False,
+        help=(
+            "中文：批量处理 readFolder 中所有样本，每个样本输出到独立子目录\n\n"
+            "English: Process every sample pair in readFolder, each in its own output subdirectory."
+        )
+    )
+
+    parser.add_option(
+        "--cores",
+        action="store",
+        type="int",
+        dest="cores",
+        default=None,
+        help=(
+            "中文：可用的 CPU 核数，默认自动检测（含 cgroup 限制）\n\n"
+            "English: Cores available to the run. Detected automatically (including cgroup limits)."
+        )
+    )
+
+    parser.add_option(
+        "--memory-gb",
+        action="store",
+        type="float",
+        dest="memory_gb",
+        default=None,
+        help=(
+            "中文：可用的内存 (GB)，默认自动检测（含 cgroup 限制）\n\n"
+            "English: Memory (GB) available to the run. Detected automatically (including cgroup limits)."
+        )
+    )
+
+    parser.add_option(
+        "--star-memory-gb",
+        action="store",
+        type="float",
+        dest="star_memory_gb",
+        default=32.0,
+        help=(
+            "中文：每个 STAR 任务所需内存 (GB)，默认 32\n\n"
+            "English: Memory (GB) needed by one STAR job. Default 32."
+        )
+    )
+
+    parser.add_option(
+        "--shared-genome",
+        action="store_true",
+        dest="shared_genome",
+        default=False,
+        help=(
+            "中文：批量模式下将 STAR 基因组索引加载到共享内存一次，供所有样本使用\n\n"
+            "English: In batch mode, keep one copy of the STAR genome in shared memory for all samples."
+        )
+    )
+
+    parser.add_option(
+        "--umi-counter",
+        action="store",
+        type="choice",
+        choices=["native", "umi_tools"],
+        dest="umi_counter",
+        default="native",
+        help=(
+            "中文：UMI 计数方式 (native/umi_tools)，默认 native\n\n"
+            "English: How UMIs are counted (native/umi_tools). Default 'native'."
+        )
+    )
+
+    parser.add_option(
+        "--umi-method",
+        action="store",
+        type="choice",
+        choices=["directional", "unique"],
+        dest="umi_method",
+        default="directional",
+        help=(
+            "中文：native 计数的 UMI 去重方法 (directional/unique)，默认 directional\n\n"
+            "English: UMI deduplication for the native counter (directional/unique). Default 'directional'."
+        )
+    )
+
+    parser.add_option(
+        "--npz",
+        action="store_true",
+        dest="npz",
+        default=False,
+        help=(
+            "中文：另存 NumPy CSR 格式的计数矩阵 *_counts.npz（需要 numpy）\n\n"
+            "English: Also write the counts as a NumPy CSR *_counts.npz (requires numpy)."
+        )
+    )
+
+    parser.add_option(
+        "--force",
+        action="store_true",
+        dest="force",
+        default=False,
+        help=(
+            "中文：重新运行所有阶段，不跳过已是最新的阶段\n\n"
+            "English: Rerun every stage instead of skipping stages that are up to date."
+        )
+    )
+
+    parser.add_option(
+        "--command-timeout",
+        type="float",
+        dest="command_timeout",
+        default=None,
+        help=(
+            "中文：每个外部工具的最长运行秒数，默认不限时\n\n"
+            "English: Seconds each external tool may run before it is stopped. No limit by default."
+        )
+    )
+
+    parser.add_option(
+        "--profile",
+        action="store_true",
+        dest="profile",
+        default=False,
+        help=(
+            "中文：对 Python 阶段做 cProfile 分析，保存 .prof 文件\n\n"
+            "English: Save a cProfile .prof dump for each in-process Python stage."
+        )
+    )
+
+    parser.add_option(
+        "--top-barcodes",
+        type="int",
+        dest="top_barcodes",
+        default=20,
+        help=(
+            "中文：transform_summary.json 中列出的最常见未匹配条形码数量，默认 20\n\n"
+            "English: Most frequent unmatched barcodes listed in transform_summary.json. Default: 20."
+        )
+    )
+
+    parser.add_option(
+        "--sample-reads",
+        type="int",
+        dest="sample_reads",
+        default=0,
+        help=(
+            "中文：随机保留 N 条未通过的原始 reads 用于排查，默认 0\n\n"
+            "English: Keep a random sample of N failed raw reads for debugging. Default: 0."
+        )
+    )
+
+    parser.add_option(
+        "--fraction",
+        action="store",
+        type="float",
+        dest="fraction",
+        default=None,
+        help=(
+            "中文：仅按 read 名称哈希保留该比例的 read 对 (0-1)，用于快速预览\n\n"
+            "English: Keep this fraction (0-1) of the read pairs, chosen by a hash of the read name, "
+            "for a quick-look run."
+        )
+    )
+
+    parser.add_option(
+        "--max-reads",
+        action="store",
+        type="int",
+        dest="max_reads",
+        default=None,
+        help=(
+            "中文：只处理前 N 个 read 对，其余输入不再读取\n\n"
+            "English: Process only the first N read pairs and stop reading the input."
+        )
+    )
+
+    parser.add_option(
+        "--well-qc",
+        action="store_true",
+        dest="well_qc",
+        default=False,
+        help=(
+            "中文：在 transform 中生成每孔快速质控表 well_qc.tsv（会降低 transform 速度）\n\n"
+            "English: Write the per-well quick-look QC table well_qc.tsv during the transform "
+            "(slows the transform down)."
+        )
+    )
+
+    parser.add_option(
+        "--trim-quality",
+        action="store",
+        type="int",
+        dest="trim_quality",
+        default=0,
+        help=(
+            "中文：从 R2 的 3' 端修剪低于该质量值的碱基，默认 0（不修剪）\n\n"
+            "English: Trim 3' R2 bases below this quality (BWA-style). Default 0 (off)."
+        )
+    )
+
+    parser.add_option(
+        "--trim-adapter",
+        action="store",
+        dest="trim_adapter",
+        default=None,
+        help=(
+            "中文：在 R2 中该接头序列出现处截断，默认不修剪\n\n"
+            "English: Cut R2 where this adapter sequence starts. Default: off."
+        )
+    )
+
+    parser.add_option(
+        "--trim-polya",
+        action="store_true",
+        dest="trim_polya",
+        default=False,
+        help=(
+            "中文：去除 R2 3' 端的 polyA 尾\n\n"
+            "English: Trim the 3' polyA tail of R2."
+        )
+    )
+
+    parser.add_option(
+        "--min-r2-length",
+        action="store",
+        type="int",
+        dest="min_r2_length",
+        default=0,
+        help=(
+            "中文：修剪后 R2 短于该长度的 read 对被丢弃，默认 0\n\n"
+            "English: Drop pairs whose trimmed R2 is shorter than this. Default 0."
+        )
+    )
+
+    parser.add_option(
+        "--collapse-duplicates",
+        action="store_true",
+        dest="collapse_duplicates",
+        default=False,
+        help=(
+            "中文：比对前合并 PCR 重复 reads，计数时按重复数还原\n\n"
+            "English: Collapse PCR duplicates before alignment and restore their counts when counting."
+        )
+    )
+
+    parser.add_option(
+        "--assigner",
+        action="store",
+        type="choice",
+        choices=["featurecounts", "builtin"],
+        dest="assigner",
+        default="featurecounts",
+        help=(
+            "中文：基因注释方式 (featurecounts/builtin)，默认 featurecounts\n\n"
+            "English: How reads are assigned to genes (featurecounts/builtin). Default 'featurecounts'."
+        )
+    )
+
+    parser.add_option(
+        "--resources",
+        action="store",
+        dest="resources",
+        default=None,
+        help=(
+            "中文：覆盖资源规划，例如 star_threads=16,sort_memory_mb=2048\n\n"
+            "English: Override the resource plan, e.g. star_threads=16,sort_memory_mb=2048."
+        )
+    )
+
+    parser.add_option(
+        "--shards",
+        action="store",
+        type="int",
+        dest="shards",
+        default=1,
+        help=(
+            "中文：将 reads 拆分为 N 份分别比对后精确合并，默认 1\n\n"
+            "English: Align the reads in N shards and merge the counts exactly. Default 1."
+        )
+    )
+
+    parser.add_option(
+        "--shard-workers",
+        action="store",
+        type="int",
+        dest="shard_workers",
+        default=None,
+        help=(
+            "中文：本机同时处理的分片数，默认自动\n\n"
+            "English: Shards processed at once on this node. Default: automatic."
+        )
+    )
+
+    parser.add_option(
+        "--shard-queue",
+        action="store",
+        dest="shard_queue",
+        default=None,
+        help=(
+            "中文：分片任务队列目录（共享文件系统），供其他节点领取任务\n\n"
+            "English: Shared job queue directory that workers on other nodes can take shards from."
+        )
+    )
+
+    parser.add_option(
+        "--shard-timeout",
+        action="store",
+        type="float",
+        dest="shard_timeout",
+        default=None,
+        help=(
+            "中文：等待队列中全部分片任务完成的最长秒数，默认不限制\n\n"
+            "English: Seconds to wait for all queued shard jobs before failing. Default: no limit."
+        )
+    )
+
     return parser
@@ -0,0 +1,192 @@
+# resources.py
+"""
+Thread and memory planning for one run.
+
+available_cores/available_memory_gb honour the CPU affinity mask and the
+cgroup (v2 or v1) CPU quota and memory limit, so a container or a Slurm
+allocation is measured rather than the whole host. ResourcePlan divides
+that budget between the jobs that run at once (shards, batch samples) and
+gives every tool in one job its threads and memory: the transform workers
+and compression threads, STAR --runThreadN/--limitBAMsortRAM,
+featureCounts -T, and samtools -@ (view/sort) and sort -m. Tools run one
+after another within a job, so each gets the job's full share.
+
+Every value can be overridden with --resources key=value[,key=value], e.g.
+--resources star_threads=16,sort_memory_mb=2048; the plan is printed and
+recorded in run_metrics.json.
+"""
+
+import math
+import os
+
+from .genome_load import BAM_SORT_RAM
+
+GB = 1024 ** 3
+# Memory one transform worker needs (chunk buffers plus the barcode table).
+TRANSFORM_MEMORY_GB = 1.0
+# Fewest cores worth giving one of several concurrent jobs.
+MIN_JOB_CORES = 4
+# featureCounts accepts at most 32 threads.
+FEATURECOUNTS_MAX_THREADS = 32
+SORT_MEMORY_MB = (256, 4096)
+
+
+def _read(path):
+    try:
+        with open(path) as handle:
+            return handle.read().split()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit():
+    """CPUs allowed by the cgroup CPU quota, or None if unlimited."""
+    fields = _read("/sys/fs/cgroup/cpu.max")
+    if fields and fields[0] != "max":
+        quota, period = int(fields[0]), int(fields[1])
+    else:
+        quota, period = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us"), \
+            _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+        if not quota or not period or int(quota[0]) <= 0:
+            return None
+        quota, period = int(quota[0]), int(period[0])
+    return max(1, math.ceil(quota / period))
+
+
+def cgroup_memory_gb():
+    """Memory left under the cgroup memory limit (GB), or None if unlimited."""
+    for limit_path, usage_path in (("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                                   ("/sys/fs/cgroup/memory/memory.limit_in_bytes",
+                                    "/sys/fs/cgroup/memory/memory.usage_in_bytes")):
+        limit = _read(limit_path)
+        if not limit or limit[0] == "max":
+            continue
+        # cgroup v1 reports "unlimited" as a huge number.
+        if int(limit[0]) >= 1 << 60:
+            continue
+        usage = _read(usage_path)
+        return max(0.0, (int(limit[0]) - (int(usage[0]) if usage else 0)) / GB)
+    return None
+
+
+def available_cores():
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    return min(cores, limit) if limit else cores
+
+
+def available_memory_gb():
+    memory = 8.0
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    memory = int(line.split()[1]) / 1024 / 1024
+                    break
+    except OSError:
+        pass
+    limit = cgroup_memory_gb()
+    return min(memory, limit) if limit is not None else memory
+
+
+def concurrent_jobs(cores, memory_gb, star_memory_gb, limit):
+    """How many STAR jobs (at most limit) fit at once into cores and memory."""
+    by_cores = cores // MIN_JOB_CORES
+    by_memory = int(memory_gb // star_memory_gb) if star_memory_gb else limit
+    return max(1, min(limit, by_cores, by_memory))
+
+
+class ResourcePlan:
+    # Field: type; the keys accepted by --resources.
+    FIELDS = {
+        "transform_workers": int,
+        "compress_threads": int,
+        "star_threads": int,
+        "bam_sort_ram": int,
+        "featurecounts_threads": int,
+        "samtools_threads": int,
+        "sort_memory_mb": int,
+    }
+
+    def __init__(self, cores, memory_gb, jobs=1, star_memory_gb=32, shared_genome=False,
+                 stream_star=False):
+        self.cores = cores
+        self.memory_gb = memory_gb
+        self.jobs = jobs
+        # Memory one STAR job holds; attached to a shared genome only its
+        # BAM sorting buffer.
+        self.star_memory_gb = BAM_SORT_RAM / GB + 1 if shared_genome else star_memory_gb
+        job_cores = max(1, cores // jobs)
+        job_memory = memory_gb / jobs
+        # With --stream-star STAR aligns while the transform runs.
+        transform_cores = max(1, job_cores // 2) if stream_star else job_cores
+        self.transform_workers = max(1, min(transform_cores,
+                                            int(job_memory // TRANSFORM_MEMORY_GB) or 1))
+        self.compress_threads = max(1, min(4, transform_cores))
+        self.star_threads = job_cores
+        if shared_genome:
+            self.bam_sort_ram = BAM_SORT_RAM
+        else:
+            # What is left next to the genome; 0 keeps STAR's own default.
+            spare = (job_memory - star_memory_gb) * 0.75
+            self.bam_sort_ram = int(spare * GB) if spare >= 2 else 0
+        self.featurecounts_threads = min(job_cores, FEATURECOUNTS_MAX_THREADS)
+        self.samtools_threads = job_cores
+        low, high = SORT_MEMORY_MB
+        per_thread = int(job_memory * 1024 * 0.5 / self.samtools_threads)
+        self.sort_memory_mb = max(low, min(high, per_thread))
+
+    @classmethod
+    def from_options(cls, options, parallel=1, stream_star=False, shared=False):
+        """
+        Plan for up to `parallel` jobs at once (batch samples or --shards);
+        as many run concurrently as cores and STAR memory allow. shared: STAR
+        attaches to a genome loaded once by genome_load.GenomeResidency.
+        """
+        cores = options.cores or available_cores()
+        memory_gb = options.memory_gb or available_memory_gb()
+        if shared:
+            # The shared index is paid for once, up front.
+            memory_gb = max(1.0, memory_gb - options.star_memory_gb)
+        star_memory_gb = BAM_SORT_RAM / GB + 1 if shared else options.star_memory_gb
+        if options.shard_workers and options.shards > 1:
+            jobs = options.shard_workers
+        else:
+            jobs = concurrent_jobs(cores, memory_gb, star_memory_gb, parallel)
+        plan = cls(cores, memory_gb, jobs=jobs, star_memory_gb=options.star_memory_gb,
+                   shared_genome=shared, stream_star=stream_star)
+        if options.transform_workers:
+            plan.transform_workers = options.transform_workers
+        if options.compress_threads:
+            plan.compress_threads = options.compress_threads
+        if options.resources:
+            plan.override(options.resources)
+        return plan
+
+    def override(self, text):
+        """Apply "key=value[,key=value]" overrides."""
+        for item in filter(None, (part.strip() for part in text.split(","))):
+            key, sep, value = item.partition("=")
+            key = key.strip()
+            if not sep or key not in self.FIELDS:
+                raise ValueError(f"Unknown resource '{item}', use key=value with keys "
+                                 f"{', '.join(self.FIELDS)}")
+            setattr(self, key, self.FIELDS[key](value))
+
+    def as_dict(self):
+        plan = {"cores": self.cores, "memory_gb": round(self.memory_gb, 1), "jobs": self.jobs,
+                "star_memory_gb": round(self.star_memory_gb, 1)}
+        plan.update((key, getattr(self, key)) for key in self.FIELDS)
+        return plan
+
+    def __str__(self):
+        sort_ram = f"{self.bam_sort_ram / GB:.1f} GB" if self.bam_sort_ram else "STAR default"
+        return (f"{self.cores} cores, {self.memory_gb:.1f} GB for {self.jobs} job(s) at once; "
+                f"per job: transform {self.transform_workers} workers + "
+                f"{self.compress_threads} compression threads, "
+                f"STAR {self.star_threads} threads (BAM sort RAM {sort_ram}), "
+                f"featureCounts {self.featurecounts_threads} threads, "
+                f"samtools {self.samtools_threads} threads ({self.sort_memory_mb}M per sort thread)")
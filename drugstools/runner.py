@@ -0,0 +1,168 @@
+# runner.py
+"""
+Subprocess runner for the external tools (STAR, featureCounts, samtools,
+umi_tools).
+
+Every command gets its own stdout/stderr files, a nonzero exit raises
+CommandFailed, a timeout or cancellation stops the process (SIGTERM, then
+SIGKILL after a grace period), and wall time, CPU time and peak RSS (the
+child's rusage, including its own children) are recorded in a
+CommandResult.
+This is a per-command runner: the count stages of a sample form a strict
+chain, and each stage runs its command through the blocking run_command().
+Overlap between samples comes from the batch scheduler (batch.py), which
+runs each sample's stages in their own processes. The only commands that
+share one event loop are the tool version probes
+(pipeline.probe_tool_versions); run_commands() is the blocking helper for
+such independent commands.
+"""
+
+import asyncio
+import os
+import subprocess
+import time
+
+# Seconds between SIGTERM and SIGKILL when stopping a command.
+KILL_GRACE = 5.0
+
+
+class CommandFailed(RuntimeError):
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+class CommandResult:
+    def __init__(self, name, argv, returncode, wall_seconds, cpu_seconds,
+                 stdout_path=None, stderr_path=None, peak_rss_kb=None):
+        self.name = name
+        self.argv = argv
+        self.returncode = returncode
+        self.wall_seconds = wall_seconds
+        self.cpu_seconds = cpu_seconds
+        self.stdout_path = stdout_path
+        self.stderr_path = stderr_path
+        self.peak_rss_kb = peak_rss_kb
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "argv": self.argv,
+            "returncode": self.returncode,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "peak_rss_mb": None if self.peak_rss_kb is None else round(self.peak_rss_kb / 1024, 1),
+            "stdout": self.stdout_path,
+            "stderr": self.stderr_path,
+        }
+
+    def __str__(self):
+        return (f"{self.name}: exit {self.returncode}, wall {self.wall_seconds:.1f}s, "
+                f"cpu {self.cpu_seconds:.1f}s")
+
+
+def _exit_code(status):
+    return os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+
+async def _reap(proc, waiter, grace):
+    """Stop proc if it is still running and return its wait4() result."""
+    for stop in (proc.terminate, proc.kill):
+        if waiter.done():
+            break
+        stop()
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), grace)
+        except asyncio.TimeoutError:
+            pass
+    return await waiter
+
+
+async def run_command_async(argv, name=None, log_dir=None, timeout=None, cwd=None,
+                            check=True, grace=KILL_GRACE):
+    """
+    Run argv and return a CommandResult. With log_dir, stdout and stderr go to
+    <log_dir>/<name>.out and <log_dir>/<name>.err; otherwise they are inherited.
+    """
+    argv = [str(a) for a in argv]
+    name = name or os.path.basename(argv[0])
+    stdout_path = stderr_path = None
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+        stdout_path = os.path.join(log_dir, name + ".out")
+        stderr_path = os.path.join(log_dir, name + ".err")
+
+    loop = asyncio.get_event_loop()
+    start = time.time()
+    stdout = open(stdout_path, "wb") if stdout_path else None
+    stderr = open(stderr_path, "wb") if stderr_path else None
+    try:
+        proc = subprocess.Popen(argv, stdout=stdout, stderr=stderr, cwd=cwd)
+    except OSError as e:
+        raise CommandFailed(f"{name}: could not start {argv[0]} ({e})") from e
+    finally:
+        for handle in (stdout, stderr):
+            if handle:
+                handle.close()
+
+    # os.wait4 gives the child's own rusage, unlike RUSAGE_CHILDREN, which
+    # mixes every command that finished in this process.
+    waiter = loop.run_in_executor(None, os.wait4, proc.pid, 0)
+    timed_out = False
+    try:
+        _, status, usage = await asyncio.wait_for(asyncio.shield(waiter), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        _, status, usage = await _reap(proc, waiter, grace)
+    except asyncio.CancelledError:
+        await _reap(proc, waiter, grace)
+        proc.returncode = -1
+        raise
+    proc.returncode = _exit_code(status)
+
+    result = CommandResult(name, argv, proc.returncode, time.time() - start,
+                           usage.ru_utime + usage.ru_stime, stdout_path, stderr_path,
+                           usage.ru_maxrss)
+    if timed_out:
+        raise CommandFailed(f"{name} timed out after {timeout}s", result)
+    if check and result.returncode != 0:
+        where = f", see {stderr_path}" if stderr_path else ""
+        raise CommandFailed(f"{name} failed (exit code {result.returncode}){where}", result)
+    return result
+
+
+async def run_commands_async(commands, limit=None):
+    """Run several independent commands (dicts of run_command_async kwargs) concurrently."""
+    semaphore = asyncio.Semaphore(limit or len(commands) or 1)
+
+    async def one(kwargs):
+        async with semaphore:
+            return await run_command_async(**kwargs)
+
+    return await asyncio.gather(*[one(kwargs) for kwargs in commands])
+
+
+def run_loop(coro):
+    loop = asyncio.new_event_loop()
+    task = loop.create_task(coro)
+    try:
+        return loop.run_until_complete(task)
+    except BaseException:
+        # Ctrl-C/SystemExit: cancel so running commands are stopped and reaped.
+        if not task.done():
+            task.cancel()
+            try:
+                loop.run_until_complete(task)
+            except BaseException:
+                pass
+        raise
+    finally:
+        loop.close()
+
+
+def run_command(argv, **kwargs):
+    return run_loop(run_command_async(argv, **kwargs))
+
+
+def run_commands(commands, limit=None):
+    return run_loop(run_commands_async(commands, limit))
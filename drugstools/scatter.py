@@ -0,0 +1,345 @@
+# scatter.py
+"""
+Scatter-gather alignment for one sample (--shards N).
+
+The transformed R2 reads are split round-robin into N shards under
+<outputDir>/shards/shard_NNN/datanew_R2.fastq. Every shard is aligned and
+gene-assigned on its own (the same CountUMI align/assign stages, run in the
+shard directory) and its reads are collected into a UMICounter, saved as
+partial_counts.pkl. The count stage then merges the partial tables: read
+counts per (well, gene, UMI) are summed before UMIs are deduplicated, so a
+well whose UMIs landed in different shards is counted exactly as without
+sharding.
+
+Shards run in a local process pool (--shard-workers, by default as many as
+the resource plan fits, see resources.py), or through a
+file-based queue on a shared filesystem (--shard-queue DIR): jobs are
+pickled into DIR/pending, and any number of
+
+    python -m drugstools.scatter DIR
+
+workers, e.g. on other nodes, claim them by renaming them to DIR/running.
+The coordinating process works the queue as well, so the run finishes even
+if no other worker ever starts. Paths in a job are absolute; the genome,
+GTF and output directory must be visible at the same paths to every worker.
+
+A worker touches its job file in DIR/running every HEARTBEAT_SECONDS. A
+job whose file has not been touched for LEASE_SECONDS belongs to a worker
+that died; the coordinator moves it back to DIR/pending, where it is
+claimed again. With --shard-timeout the coordinator gives up and raises
+when the shards are not all done in time.
+"""
+
+import copy
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+
+from .collapse import load_multiplicities
+from .fastq_io import open_fastq
+from .umicount import UMICounter, collect_bam
+
+SHARD_DIR = "shards"
+PARTIAL_NAME = "partial_counts.pkl"
+# Records written to one shard before moving to the next.
+SPLIT_BLOCK = 4096
+# Queue workers refresh the mtime of their running job this often; a
+# running job untouched for LEASE_SECONDS is requeued.
+HEARTBEAT_SECONDS = 30
+LEASE_SECONDS = 300
+
+
+def shard_dirs(outdir, shards):
+    return [os.path.join(outdir, SHARD_DIR, f"shard_{i:03d}") for i in range(shards)]
+
+
+def split_fastq(infile, dirs, block=SPLIT_BLOCK):
+    """Deal blocks of records from infile round-robin into <dir>/datanew_R2.fastq."""
+    outs = []
+    for path in dirs:
+        os.makedirs(path, exist_ok=True)
+        outs.append(open(os.path.join(path, "datanew_R2.fastq"), "wb"))
+    n = 0
+    try:
+        with open_fastq(infile) as handle:
+            lines = iter(handle)
+            while True:
+                record = b"".join(next(lines, b"") for _ in range(4 * block))
+                if not record:
+                    break
+                outs[n % len(outs)].write(record)
+                n += 1
+    finally:
+        for out in outs:
+            out.close()
+
+
+def run_shard(job):
+    """Align, assign and collect one shard; write and return its partial_counts.pkl path."""
+    count_umi, shard_dir = job["count_umi"], job["shard_dir"]
+    outname, log_filename = job["outname"], job["log_filename"]
+    commands = []
+    paths = count_umi.paths(shard_dir, outname)
+    for name in count_umi.stage_names():
+        if name == "count":
+            continue
+        commands += count_umi.run_stage(name, shard_dir, outname, log_filename).get("commands", [])
+    assigner = count_umi.gene_assigner() if count_umi.fused_count else None
+    multiplicities = load_multiplicities(job["duplicates"]) if job.get("duplicates") else None
+    counter = collect_bam(paths["outbam"] if assigner else paths["assigned_bam"],
+                          threads=count_umi.samtools_threads,
+                          multiplicities=multiplicities, assigner=assigner)
+    if assigner:
+        assigner.write_summary(paths["summary"], paths["outbam"])
+    partial = os.path.join(shard_dir, PARTIAL_NAME)
+    with open(partial + ".tmp", "wb") as out:
+        pickle.dump({"groups": counter.groups, "reads": counter.reads, "commands": commands},
+                    out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(partial + ".tmp", partial)
+    # The reads are only released with the BAMs, so a queued job requeued
+    # after its worker died can still run again from the start.
+    if count_umi.release:
+        _remove(paths["infile"], paths["outbam"], paths["assigned_bam"])
+    return partial
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ShardQueue:
+    """pending/ -> running/ -> done/ or failed/ job files under root."""
+
+    def __init__(self, root):
+        self.root = root
+        for state in ("pending", "running", "done", "failed"):
+            os.makedirs(os.path.join(root, state), exist_ok=True)
+
+    def path(self, state, name):
+        return os.path.join(self.root, state, name + ".pkl")
+
+    def submit(self, name, job):
+        for state in ("done", "failed"):
+            if os.path.exists(self.path(state, name)):
+                os.remove(self.path(state, name))
+        tmp = self.path("pending", name) + ".tmp"
+        with open(tmp, "wb") as out:
+            pickle.dump(job, out, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path("pending", name))
+
+    def requeue_stale(self, lease=LEASE_SECONDS):
+        """Move running jobs whose worker stopped heartbeating back to pending/."""
+        requeued = []
+        now = time.time()
+        for entry in os.listdir(os.path.join(self.root, "running")):
+            if not entry.endswith(".pkl"):
+                continue
+            name = entry[:-4]
+            try:
+                if now - os.path.getmtime(self.path("running", name)) < lease:
+                    continue
+                os.rename(self.path("running", name), self.path("pending", name))
+            except FileNotFoundError:
+                # Finished or requeued in the meantime.
+                continue
+            print(f"[Warning] Shard job {name} had no heartbeat for {lease:.0f}s; requeued")
+            requeued.append(name)
+        return requeued
+
+    def claim(self):
+        """Move one pending job to running/ and return its name, or None."""
+        for entry in sorted(os.listdir(os.path.join(self.root, "pending"))):
+            if not entry.endswith(".pkl"):
+                continue
+            name = entry[:-4]
+            try:
+                # rename is atomic, so exactly one worker wins each job.
+                os.rename(self.path("pending", name), self.path("running", name))
+            except FileNotFoundError:
+                continue
+            return name
+        return None
+
+    def work_one(self):
+        """Run one pending job; return False when there was none."""
+        name = self.claim()
+        if name is None:
+            return False
+        running = self.path("running", name)
+        with open(running, "rb") as handle:
+            job = pickle.load(handle)
+        print(f"[Info] Running shard job {name}")
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(running, stop), daemon=True)
+        heartbeat.start()
+        try:
+            run_shard(job)
+        except Exception:
+            with open(self.path("failed", name) + ".tmp", "w") as out:
+                out.write(traceback.format_exc())
+            os.replace(self.path("failed", name) + ".tmp", self.path("failed", name))
+            self._discard(running)
+            print(f"[Error] Shard job {name} failed")
+            return True
+        finally:
+            stop.set()
+            heartbeat.join()
+        try:
+            os.replace(running, self.path("done", name))
+        except FileNotFoundError:
+            # Requeued meanwhile: mark it done and drop the pending copy if
+            # no other worker has claimed it yet.
+            with open(self.path("done", name), "wb"):
+                pass
+            self._discard(self.path("pending", name))
+        return True
+
+    @staticmethod
+    def _heartbeat(running, stop):
+        while not stop.wait(HEARTBEAT_SECONDS):
+            try:
+                os.utime(running)
+            except FileNotFoundError:
+                # Requeued after a missed lease; the job still finishes here.
+                return
+
+    @staticmethod
+    def _discard(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def wait(self, names, poll=2.0, timeout=None, lease=LEASE_SECONDS):
+        """
+        Work the queue until every job in names is done; raise if one failed
+        or, with timeout (seconds), if they are not all done by then. Jobs
+        of dead workers are requeued after lease seconds without heartbeat.
+        """
+        remaining = set(names)
+        deadline = time.time() + timeout if timeout else None
+        while remaining:
+            self.requeue_stale(lease)
+            worked = self.work_one()
+            for name in list(remaining):
+                if os.path.exists(self.path("failed", name)):
+                    with open(self.path("failed", name)) as handle:
+                        raise RuntimeError(f"Shard job {name} failed:\n{handle.read()}")
+                if os.path.exists(self.path("done", name)):
+                    remaining.discard(name)
+            if remaining and deadline is not None and time.time() > deadline:
+                raise RuntimeError(f"{len(remaining)} shard jobs not done after {timeout:.0f}s "
+                                   f"in {self.root}: {', '.join(sorted(remaining))}")
+            if remaining and not worked:
+                time.sleep(poll)
+
+
+def scatter(count_umi, outdir, outname, log_filename, shards, workers=1, queue_dir=None,
+            timeout=None):
+    """Split, align and collect every shard; return the stage report."""
+    dirs = shard_dirs(outdir, shards)
+    paths = count_umi.paths(outdir, outname)
+    split_fastq(paths["infile"], dirs)
+    # Workers elsewhere resolve the genome and GTF at the same absolute paths.
+    shard_umi = copy.copy(count_umi)
+    shard_umi.shards = 1
+    shard_umi.gtfname = os.path.abspath(count_umi.gtfname)
+    shard_umi.genomedir = os.path.abspath(count_umi.genomedir)
+    jobs = [{
+        "count_umi": shard_umi,
+        "shard_dir": os.path.abspath(shard_dir),
+        "outname": outname,
+        "log_filename": os.path.abspath(log_filename),
+        "duplicates": os.path.abspath(paths["duplicates"]) if count_umi.collapse else None,
+    } for shard_dir in dirs]
+
+    if queue_dir:
+        queue = ShardQueue(queue_dir)
+        # Several samples may share one queue.
+        names = [f"{outname}_{os.path.basename(d)}_"
+                 f"{hashlib.sha1(os.path.abspath(d).encode()).hexdigest()[:8]}" for d in dirs]
+        for name, job in zip(names, jobs):
+            queue.submit(name, job)
+        print(f"[Info] Queued {shards} shard jobs in {queue_dir}; "
+              f"start more workers with: python -m drugstools.scatter {queue_dir}")
+        queue.wait(names, timeout=timeout)
+        partials = [os.path.join(d, PARTIAL_NAME) for d in dirs]
+    elif workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            partials = list(pool.map(run_shard, jobs))
+    else:
+        partials = [run_shard(job) for job in jobs]
+
+    commands, reads = [], 0
+    for partial in partials:
+        with open(partial, "rb") as handle:
+            data = pickle.load(handle)
+        commands += data["commands"]
+        reads += data["reads"]
+    return {"commands": commands, "records": reads,
+            "counters": {"shards": shards, "workers": "queue" if queue_dir else workers}}
+
+
+def merge_summaries(paths, out_path):
+    """Sum featureCounts-style .summary files into out_path."""
+    totals = {}
+    for path in paths:
+        with open(path) as handle:
+            next(handle)
+            for line in handle:
+                if line.strip():
+                    status, n = line.rstrip("\n").split("\t")[:2]
+                    totals[status] = totals.get(status, 0) + int(n)
+    with open(out_path, "w") as out:
+        out.write("Status\tshards\n")
+        for status, n in totals.items():
+            out.write(f"{status}\t{n}\n")
+
+
+def gather(count_umi, outdir, outname, shards):
+    """Merge the shards' partial tables and write the sample's counts."""
+    counter = UMICounter(count_umi.umi_method)
+    dirs = shard_dirs(outdir, shards)
+    for shard_dir in dirs:
+        with open(os.path.join(shard_dir, PARTIAL_NAME), "rb") as handle:
+            data = pickle.load(handle)
+        counter.merge(data["groups"], data["reads"])
+    paths = count_umi.paths(outdir, outname)
+    counter.write(paths["counts"], paths["outfile"], count_umi.npz)
+    merge_summaries([count_umi.paths(d, outname)["summary"] for d in dirs], paths["summary"])
+    return counter
+
+
+def get_parser():
+    parser = OptionParser(usage="python -m drugstools.scatter QUEUE_DIR [options]")
+    parser.add_option("--wait", type="float", default=0,
+                      help="Keep polling for new jobs for this many idle seconds before exiting")
+    parser.add_option("--poll", type="float", default=2.0, help="Seconds between polls")
+    return parser
+
+
+def main(argv=None):
+    options, args = get_parser().parse_args(argv)
+    if len(args) != 1:
+        get_parser().error("Please give the queue directory.")
+    queue = ShardQueue(args[0])
+    idle_since = time.time()
+    while True:
+        if queue.work_one():
+            idle_since = time.time()
+        elif time.time() - idle_since >= options.wait:
+            return
+        else:
+            time.sleep(options.poll)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# sparse.py
+"""
+Sparse gene x well count matrices.
+
+write_sparse() stores counts as <prefix>_matrix.mtx.gz (Matrix Market
+coordinate format, genes as rows, wells as columns, 1-based) with
+<prefix>_features.tsv and <prefix>_barcodes.tsv, and optionally
+<prefix>_counts.npz holding the same matrix in CSR form with the keys
+scipy.sparse.save_npz uses. load_counts() reads either back in seconds.
+numpy and scipy are optional.
+"""
+
+import gzip
+import os
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for the .npz files
+    np = None
+
+MTX_HEADER = "%%MatrixMarket matrix coordinate integer general\n"
+
+
+def sparse_paths(prefix):
+    return {
+        "matrix": prefix + "_matrix.mtx.gz",
+        "features": prefix + "_features.tsv",
+        "barcodes": prefix + "_barcodes.tsv",
+        "npz": prefix + "_counts.npz",
+    }
+
+
+class CountMatrix:
+    """Gene x well counts in CSR form (plain lists, or numpy arrays from .npz)."""
+
+    def __init__(self, features, barcodes, indptr, indices, data):
+        self.features = list(features)
+        self.barcodes = list(barcodes)
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    @property
+    def shape(self):
+        return len(self.features), len(self.barcodes)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def row(self, feature):
+        """Return {barcode: count} for one gene."""
+        i = self.features.index(feature)
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return {self.barcodes[j]: int(v) for j, v in zip(self.indices[start:end], self.data[start:end])}
+
+    def to_scipy(self):
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
+
+def _csr(rows):
+    indptr, indices, data = [0], [], []
+    for row in rows:
+        for j, v in row:
+            indices.append(j)
+            data.append(v)
+        indptr.append(len(data))
+    return indptr, indices, data
+
+
+def write_sparse(prefix, features, barcodes, rows, npz=False):
+    """
+    Write the sparse files for a matrix given as one list of
+    (barcode_index, count) pairs per feature, in feature order.
+    """
+    paths = sparse_paths(prefix)
+    indptr, indices, data = _csr(rows)
+    with open(paths["features"], "w") as out:
+        for feature in features:
+            out.write(feature + "\n")
+    with open(paths["barcodes"], "w") as out:
+        for barcode in barcodes:
+            out.write(barcode + "\n")
+    with gzip.open(paths["matrix"], "wt", compresslevel=4) as out:
+        out.write(MTX_HEADER)
+        out.write(f"{len(features)} {len(barcodes)} {len(data)}\n")
+        for i in range(len(features)):
+            for k in range(indptr[i], indptr[i + 1]):
+                out.write(f"{i + 1} {indices[k] + 1} {data[k]}\n")
+    if npz:
+        if np is None:
+            print("[Warning] numpy is not installed; skipping the .npz count matrix.")
+        else:
+            np.savez_compressed(
+                paths["npz"], format=np.array(b"csr"),
+                shape=np.array([len(features), len(barcodes)]),
+                data=np.array(data, dtype=np.int32), indices=np.array(indices, dtype=np.int32),
+                indptr=np.array(indptr, dtype=np.int64),
+            )
+    return paths
+
+
+def wide_to_sparse(tsv_path, prefix, npz=False):
+    """Convert a wide gene x well table (umi_tools format) to the sparse files."""
+    opener = gzip.open if tsv_path.endswith(".gz") else open
+    features, rows = [], []
+    with opener(tsv_path, "rt") as handle:
+        barcodes = handle.readline().rstrip("\n").split("\t")[1:]
+        for line in handle:
+            fields = line.rstrip("\n").split("\t")
+            features.append(fields[0])
+            rows.append([(j, int(v)) for j, v in enumerate(fields[1:]) if v not in ("0", "")])
+    return write_sparse(prefix, features, barcodes, rows, npz=npz)
+
+
+def _read_lines(path):
+    with open(path) as handle:
+        return [line.rstrip("\n").split("\t")[0] for line in handle]
+
+
+def load_counts(prefix):
+    """
+    Load the counts written by write_sparse() as a CountMatrix, from the
+    .npz file when it exists and numpy is available, else from the .mtx.gz.
+    """
+    paths = sparse_paths(prefix)
+    features = _read_lines(paths["features"])
+    barcodes = _read_lines(paths["barcodes"])
+    if np is not None and os.path.exists(paths["npz"]):
+        with np.load(paths["npz"]) as npz:
+            return CountMatrix(features, barcodes, npz["indptr"], npz["indices"], npz["data"])
+
+    entries = [[] for _ in features]
+    with gzip.open(paths["matrix"], "rt") as handle:
+        for line in handle:
+            if line.startswith("%"):
+                continue
+            break  # dimensions line
+        for line in handle:
+            i, j, v = line.split()
+            entries[int(i) - 1].append((int(j) - 1, int(v)))
+    for row in entries:
+        row.sort()
+    indptr, indices, data = _csr(entries)
+    return CountMatrix(features, barcodes, indptr, indices, data)
@@ -0,0 +1,136 @@
+# star_stream.py
+"""
+Stream transformed R2 reads straight into STAR through a named pipe.
+
+STAR is started first with --readFilesIn pointing at a FIFO in the output
+directory; Transformer.transform then writes datanew_R2 into that FIFO, so
+alignment overlaps with barcode extraction and the R2 file never touches
+disk. If STAR dies, the next write fails with a broken pipe and the
+transform is aborted with STAR's exit status; if the transform fails, STAR
+is terminated. STAR is started without a shell, so the process terminated
+is STAR itself and not a shell that would leave it running on the FIFO.
+"""
+
+import errno
+import fcntl
+import os
+import subprocess
+import time
+
+FIFO_NAME = "datanew_R2.fifo"
+
+
+class StarFailed(RuntimeError):
+    pass
+
+
+class StarStream:
+    """
+    Context manager yielding a binary handle that feeds STAR.
+
+        with StarStream(count_umi, outdirname, outname) as r2_handle:
+            transformer.transform(..., r2_handle=r2_handle)
+        count_umi.count(..., run_star=False)
+    """
+
+    def __init__(self, count_umi, outdirname, outname, log_filename=None, poll_interval=0.1):
+        self.count_umi = count_umi
+        self.outdirname = outdirname
+        self.outname = outname
+        self.log_filename = log_filename or count_umi.log_name()
+        self.poll_interval = poll_interval
+        self.fifo = os.path.join(outdirname, FIFO_NAME)
+        self.proc = None
+        self.handle = None
+        self.log = None
+
+    def __enter__(self):
+        if os.path.exists(self.fifo):
+            os.remove(self.fifo)
+        os.mkfifo(self.fifo)
+        argv = self.count_umi.star_argv(self.fifo, self.outdirname, self.outname)
+        print("[Info] Streaming transformed reads into STAR through", self.fifo)
+        self.log = open(self.log_filename, "ab")
+        try:
+            self.proc = subprocess.Popen(argv, stdout=self.log, stderr=subprocess.STDOUT)
+        except BaseException:
+            self._abort()
+            raise
+        try:
+            self.handle = self._open_writer()
+        except BaseException:
+            self._abort()
+            raise
+        return self.handle
+
+    def _open_writer(self):
+        # A blocking open would hang forever if STAR exits before opening the
+        # FIFO, so poll with O_NONBLOCK (ENXIO = no reader yet) while
+        # watching the process.
+        while True:
+            try:
+                fd = os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+            if self.proc.poll() is not None:
+                raise StarFailed(
+                    f"STAR exited with code {self.proc.returncode} before reading "
+                    f"{self.fifo}; see {self.log_filename}"
+                )
+            time.sleep(self.poll_interval)
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        return os.fdopen(fd, "wb", buffering=1 << 20)
+
+    def _close_handle(self):
+        if self.handle is None:
+            return
+        try:
+            self.handle.close()
+        except BrokenPipeError:
+            pass
+        self.handle = None
+
+    def _abort(self):
+        self._close_handle()
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+        if self.proc is not None:
+            self.proc.wait()
+        self._close_log()
+        if os.path.exists(self.fifo):
+            os.remove(self.fifo)
+
+    def _close_log(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            if isinstance(exc, BrokenPipeError):
+                # STAR stopped reading: report its status, not the pipe error.
+                self._close_handle()
+                returncode = self.proc.wait()
+                self._close_log()
+                os.remove(self.fifo)
+                raise StarFailed(
+                    f"STAR exited with code {returncode} while reading the streamed "
+                    f"reads; see {self.log_filename}"
+                ) from exc
+            self._abort()
+            return False
+
+        try:
+            self.handle.close()
+        except BrokenPipeError:
+            pass
+        self.handle = None
+        returncode = self.proc.wait()
+        self._close_log()
+        os.remove(self.fifo)
+        if returncode != 0:
+            raise StarFailed(f"STAR exited with code {returncode}; see {self.log_filename}")
+        return False
@@ -0,0 +1,97 @@
+# synthetic.py
+"""
+Synthetic paired DRUG-seq FASTQ for tests and benchmarks.
+
+R1 is [0-7 random bases] + linker (same_seq) + 12 bp barcode + UMI + cDNA,
+R2 is cDNA only. linker_rate is the fraction of reads that contain the
+linker at all, barcode_error_rate the fraction whose barcode carries
+errors (one substitution, correctable, for three in four of them; two,
+a whitelist miss, for the rest) and short_rate the fraction whose cDNA is
+too short to keep (Obread). The transform thus sees exact hits,
+corrections, misses, short reads and reads without a linker in known
+proportions. duplicate_rate is the fraction of pairs that repeat an earlier
+pair under a new name, like PCR duplicates.
+
+write_gtf tiles chr1 with two-exon genes (every tenth overlapping its
+neighbour) matching where bench.py's stub STAR places reads.
+"""
+
+import gzip
+import random
+from collections import deque
+
+LINKER = "CAGTGGTATCAACGCAGA"
+BASES = "ACGT"
+
+
+def random_seq(rng, length):
+    return "".join(rng.choice(BASES) for _ in range(length))
+
+
+def random_barcodes(n, length=12, seed=0):
+    """n distinct random barcodes."""
+    rng = random.Random(seed)
+    barcodes = {}
+    while len(barcodes) < n:
+        barcodes[random_seq(rng, length)] = None
+    return list(barcodes)
+
+
+def write_whitelist(path, barcodes):
+    with open(path, "w") as out:
+        for barcode in barcodes:
+            out.write(barcode + "\n")
+
+
+def _mutate(rng, seq):
+    i = rng.randrange(len(seq))
+    return seq[:i] + rng.choice(BASES.replace(seq[i], "")) + seq[i + 1:]
+
+
+def generate_reads(n_reads, barcodes, linker_rate=0.9, barcode_error_rate=0.1, umi_length=10,
+                   short_rate=0.05, duplicate_rate=0.0, cdna_length=50, same_seq=LINKER, seed=1):
+    """Yield (r1_record, r2_record) FASTQ text pairs."""
+    rng = random.Random(seed)
+    recent = deque(maxlen=1000)
+    for i in range(n_reads):
+        if duplicate_rate and recent and rng.random() < duplicate_rate:
+            seq1, seq2 = rng.choice(recent)
+        else:
+            if rng.random() < linker_rate:
+                barcode = rng.choice(barcodes)
+                if rng.random() < barcode_error_rate:
+                    barcode = _mutate(rng, barcode)
+                    if rng.random() < 0.25:
+                        barcode = _mutate(rng, barcode)
+                cdna = rng.randrange(2) if rng.random() < short_rate else cdna_length
+                seq1 = (random_seq(rng, rng.randrange(8)) + same_seq + barcode
+                        + random_seq(rng, umi_length) + random_seq(rng, cdna))
+            else:
+                seq1 = random_seq(rng, len(same_seq) + 12 + umi_length + cdna_length)
+            seq2 = random_seq(rng, cdna_length)
+            recent.append((seq1, seq2))
+        yield (f"@SYN{i} 1:N:0:ACGT\n{seq1}\n+\n{'F' * len(seq1)}\n",
+               f"@SYN{i} 2:N:0:ACGT\n{seq2}\n+\n{'F' * len(seq2)}\n")
+
+
+def write_pair(r1_path, r2_path, n_reads, barcodes, compresslevel=1, **kwargs):
+    """Write gzipped R1/R2 files; kwargs go to generate_reads."""
+    with gzip.open(r1_path, "wt", compresslevel=compresslevel) as out1, \
+         gzip.open(r2_path, "wt", compresslevel=compresslevel) as out2:
+        for r1, r2 in generate_reads(n_reads, barcodes, **kwargs):
+            out1.write(r1)
+            out2.write(r2)
+
+
+def write_gtf(path, n_genes=200, length=100000):
+    """Write a GTF with n_genes two-exon genes spread over chr1:1-length."""
+    span = length // n_genes
+    with open(path, "w") as out:
+        for g in range(n_genes):
+            start = g * span + 1
+            # Every tenth gene reaches into the next one, giving ambiguous reads.
+            end = start + span + span // 2 if g % 10 == 9 and g < n_genes - 1 else start + span - 1
+            attrs = f'gene_id "GENE{g}"; transcript_id "TX{g}";'
+            middle = start + (end - start) // 2
+            for a, b in ((start, middle - 20), (middle + 20, end)):
+                out.write(f"chr1\tsynthetic\texon\t{a}\t{b}\t.\t+\t.\t{attrs}\n")
@@ -1,84 +1,466 @@
 
 ### transformer.py
 import gzip
+import heapq
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import blake2b
+from itertools import islice, tee
+from zlib import crc32
+
+from tqdm import tqdm
+
+from .BCfunc import BarcodeIndex
+from .collapse import DuplicateCollapser
+from .diagnostics import HLL_P, LOW_WELL_FRACTION, TransformSummary, WellQC
+from .fastq_io import open_output, output_name
+
+# Read pairs handed to a worker (or processed serially) at a time.
+CHUNK_RECORDS = 20000
+
+# ReadPair dispositions, named like the transform_summary.json counters.
+KEPT = "kept"
+OBREAD = "obread"
+BARCODE_MISS = "barcode_miss"
+NO_LINKER = "no_linker"
+TOO_SHORT = "trimmed_too_short"
+SUBSAMPLED = "subsampled_out"
+
+
+def subsample_threshold(fraction):
+    """crc32 bound below which a read name is kept by transform_chunk's keep_below."""
+    return None if fraction is None or fraction >= 1 else int(fraction * 2 ** 32)
+
+
+def read_chunk(handle, n_records):
+    """Read up to n_records FASTQ records (4 lines each) as raw lines."""
+    return list(islice(handle, n_records * 4))
+
+
+class ReadPair:
+    """
+    One read pair from Transformer.stream. r1/r2 are FASTQ records (bytes,
+    newline-terminated): tagged for KEPT pairs, as read otherwise. barcode
+    and umi are set for KEPT pairs only.
+    """
+
+    __slots__ = ("disposition", "r1", "r2", "barcode", "umi")
+
+    def __init__(self, disposition, r1, r2, barcode=None, umi=None):
+        self.disposition = disposition
+        self.r1 = r1
+        self.r2 = r2
+        self.barcode = barcode
+        self.umi = umi
+
+    def __repr__(self):
+        return f"ReadPair({self.disposition}, {self.r1.split(maxsplit=1)[0].decode()})"
+
+
+class TransformedChunk:
+    """What transform_chunk returns for one chunk; see its docstring."""
+
+    __slots__ = ("reads", "kept", "r1", "r2", "ob1", "ob2", "misses", "no_linker", "samples",
+                 "keys", "trimmed", "wells", "rejected", "subsampled")
+
+    def __init__(self, reads, kept, r1, r2, ob1, ob2, misses, no_linker, samples, keys=None,
+                 trimmed=None, wells=None, rejected=None, subsampled=None):
+        self.reads = reads
+        self.kept = kept
+        self.r1 = r1
+        self.r2 = r2
+        self.ob1 = ob1
+        self.ob2 = ob2
+        self.misses = misses
+        self.no_linker = no_linker
+        self.samples = samples
+        self.keys = keys
+        self.trimmed = trimmed
+        self.wells = wells
+        self.rejected = rejected
+        self.subsampled = subsampled
+
+    @property
+    def obread(self):
+        dropped = self.trimmed[0] if self.trimmed is not None else 0
+        dropped += self.subsampled or 0
+        return self.reads - self.kept - sum(self.misses.values()) - self.no_linker - dropped
+
+
+def _tag_header(header, barcode, umi):
+    # header.split(" ")[0] + "_" + barcode + "_" + umi + " " + header.split(" ")[1]
+    sp = header.find(b" ")
+    if sp < 0:
+        return header + b"_" + barcode + b"_" + umi
+    sp2 = header.find(b" ", sp + 1)
+    comment = header[sp + 1:] if sp2 < 0 else header[sp + 1:sp2]
+    return header[:sp] + b"_" + barcode + b"_" + umi + b" " + comment
+
+
+def transform_chunk(lines1, lines2, same_seq, bc_lookup, sample_reads=0, collapse=False,
+                    trimmer=None, well_qc=False, records=False, keep_below=None):
+    """
+    Barcode/UMI extraction for one synchronized chunk of R1/R2 lines.
+
+    Works on the raw bytes lines: the linker is located once per read and the
+    new records are built by slice concatenation, never decoding to str.
+    bc_lookup maps a 12 bp bytes barcode to its whitelisted (possibly
+    corrected) bytes barcode or None.
+
+    Returns a TransformedChunk: r1, r2, ob1 and ob2 are the bytes to append
+    to datanew_R1/R2 and Obread1/2, so chunks can be processed anywhere and
+    written back in order. misses is
+    {unmatched 12-mer: reads} and, with sample_reads, samples holds the
+    sample_reads failed R1 records (barcode miss or no linker) with the
+    smallest name hashes as (key, reason, record) for diagnostics.BottomKSample.
+
+    With collapse, r1 and r2 are lists of records instead of joined bytes
+    and keys lists (duplicate key, read name) per kept record, the key
+    hashing barcode + UMI + R2 sequence (see collapse.DuplicateCollapser).
+
+    With a trimming.R2Trimmer, kept R2 reads are trimmed in the same pass
+    and pairs left shorter than its min_length are dropped; trimmed is
+    (dropped pairs, trimmed bases).
+
+    With well_qc, wells maps each barcode to (kept reads, {register: rank}),
+    its UMIs as a sparse diagnostics.HyperLogLog update.
+
+    With records, all four outputs are lists of records and rejected lists
+    (disposition, R1 record, R2 record) for the pairs written nowhere, as
+    Transformer.stream needs.
+
+    With keep_below (see subsample_threshold), only pairs whose R1 read name
+    has a crc32 below it are processed, so the same pairs are kept on every
+    run; subsampled counts the others.
+    """
+    if isinstance(same_seq, str):
+        same_seq = same_seq.encode()
+    link_len = len(same_seq)
+    datanew, datanew2, Obread1, Obread2 = [], [], [], []
+    misses = {}
+    failed = [] if sample_reads else None
+    rejected = [] if records else None
+    keys = [] if collapse else None
+    wells = {} if well_qc else None
+    hll_mask, rank_bits = (1 << HLL_P) - 1, 64 - HLL_P + 1
+    index = no_linker = 0
+    trim = trimmer.trim if trimmer is not None else None
+    min_length = trimmer.min_length if trimmer is not None else 0
+    trim_dropped = trimmed_bases = 0
+    subsampled = 0
+    empty = b""
+    n1 = len(lines1) + (-len(lines1) % 4)
+    if len(lines1) < n1:
+        lines1 = lines1 + [empty] * (n1 - len(lines1))
+    if len(lines2) < n1:
+        lines2 = lines2 + [empty] * (n1 - len(lines2))
+    it1 = iter(lines1)
+    it2 = iter(lines2)
+    for line1, line2, line3, line4, line2_1, line2_2, line2_3, line2_4 in zip(
+            it1, it1, it1, it1, it2, it2, it2, it2):
+        if keep_below is not None:
+            # A blank or whitespace-only header hashes as an empty name.
+            name = (line1.split(None, 1) or [empty])[0]
+            if name.endswith(b"/1"):
+                name = name[:-2]
+            if crc32(name) >= keep_below:
+                subsampled += 1
+                if rejected is not None:
+                    rejected.append((SUBSAMPLED, line1 + line2 + line3 + line4,
+                                     line2_1 + line2_2 + line2_3 + line2_4))
+                continue
+        line2 = line2.rstrip()
+        pos = line2.find(same_seq)
+        if pos < 0:
+            no_linker += 1
+            if failed is not None:
+                failed.append((crc32(line1), "no_linker", line1 + line2 + b"\n" + line3 + line4))
+            if rejected is not None:
+                rejected.append((NO_LINKER, line1 + line2 + b"\n" + line3 + line4,
+                                 line2_1 + line2_2 + line2_3 + line2_4))
+            continue
+        # lineUMI is what line2.split(same_seq)[1] used to be.
+        start = pos + link_len
+        stop = line2.find(same_seq, start)
+        lineUMI = line2[start:] if stop < 0 else line2[start:stop]
+        lineUMI2 = lineUMI[:12]  # the first 12 bp as barcode
+        barcode = bc_lookup(lineUMI2)
+        if barcode is None:
+            misses[lineUMI2] = misses.get(lineUMI2, 0) + 1
+            if failed is not None:
+                failed.append((crc32(line1), "barcode_miss", line1 + line2 + b"\n" + line3 + line4))
+            if rejected is not None:
+                rejected.append((BARCODE_MISS, line1 + line2 + b"\n" + line3 + line4,
+                                 line2_1 + line2_2 + line2_3 + line2_4))
+            continue
+
+        line1 = line1.rstrip()
+        line4 = line4.rstrip()
+        rec2 = [line2_1.rstrip(), line2_2.rstrip(), line2_3.rstrip(), line2_4.rstrip(), empty]
+        if len(lineUMI) > 23:
+            if trim is not None:
+                end = trim(rec2[1], rec2[3])
+                if end < min_length:
+                    trim_dropped += 1
+                    if rejected is not None:
+                        rejected.append((TOO_SHORT, b"\n".join((line1, line2, line3.rstrip(),
+                                                                 line4, empty)), b"\n".join(rec2)))
+                    continue
+                if end < len(rec2[1]):
+                    trimmed_bases += len(rec2[1]) - end
+                    rec2[1], rec2[3] = rec2[1][:end], rec2[3][:end]
+            umi = lineUMI[12:22]
+            line2toBC = lineUMI[22:]
+            datanew.append(b"\n".join((
+                _tag_header(line1, barcode, umi), line2toBC, line3.rstrip(),
+                line4[len(line4) - len(line2toBC):], empty)))
+            rec2[0] = _tag_header(rec2[0], barcode, umi)
+            datanew2.append(b"\n".join(rec2))
+            index += 1
+            if wells is not None:
+                well = wells.get(barcode)
+                if well is None:
+                    well = wells[barcode] = [0, {}]
+                well[0] += 1
+                # diagnostics.hll_update, inlined for the hot loop
+                h = int.from_bytes(blake2b(umi, digest_size=8).digest(), "little")
+                rank = rank_bits - (h >> HLL_P).bit_length()
+                registers = well[1]
+                if registers.get(h & hll_mask, 0) < rank:
+                    registers[h & hll_mask] = rank
+            if keys is not None:
+                keys.append((blake2b(barcode + umi + rec2[1], digest_size=16).digest(),
+                             rec2[0][1:].split(b" ", 1)[0]))
+        else:
+            Obread1.append(b"\n".join((line1, line2, line3.rstrip(), line4, empty)))
+            Obread2.append(b"\n".join(rec2))
+    samples = heapq.nsmallest(sample_reads, failed) if failed else []
+    if keys is None and not records:
+        datanew, datanew2 = empty.join(datanew), empty.join(datanew2)
+    if not records:
+        Obread1, Obread2 = empty.join(Obread1), empty.join(Obread2)
+    trimmed = (trim_dropped, trimmed_bases) if trim is not None else None
+    return TransformedChunk(n1 // 4, index, datanew, datanew2, Obread1, Obread2, misses,
+                            no_linker, samples, keys, trimmed, wells, rejected,
+                            subsampled if keep_below is not None else None)
+
+
+# Per-process state for the pool workers, set once by _init_worker so the
+# barcode table is not pickled with every chunk.
+_WORKER = {}
+
+
+def _init_worker(same_seq, byte_table, settings):
+    _WORKER["same_seq"] = same_seq
+    _WORKER["bc_lookup"] = byte_table.get
+    _WORKER["settings"] = settings
+
+
+def _worker_chunk(lines1, lines2):
+    return transform_chunk(lines1, lines2, _WORKER["same_seq"], _WORKER["bc_lookup"],
+                           **_WORKER["settings"])
+
+
+def _record_lines(pairs, mate):
+    for pair in pairs:
+        record = pair[mate]
+        yield from (record if isinstance(record, (list, tuple)) else
+                    record.splitlines(keepends=True))
+
+
+def split_pairs(pairs, chunk_records=CHUNK_RECORDS):
+    """
+    Two line iterators (R1, R2) over an iterable of (R1 record, R2 record)
+    pairs, each record as bytes or as its four lines. Reading a chunk of R1
+    and then of R2 buffers at most one chunk of pairs.
+    """
+    first, second = tee(pairs, 2)
+    return _record_lines(first, 0), _record_lines(second, 1)
 
-from tqdm import tqdm 
 
 class Transformer:
     def __init__(self, same_seq="CAGTGGTATCAACGCAGA"):
         self.same_seq = same_seq
 
-    def transform(self, FRdata1, FRdata2, WRdata1, WRdata1D, BClist, Outdir):
-        index = 0
-        datanew = open(os.path.join(Outdir, "datanew_R1.fastq"), "w+")
-        datanew2 = open(os.path.join(Outdir, "datanew_R2.fastq"), "w+")
-        Obread1 = open(os.path.join(Outdir, "Obread1.fastq"), "w+")
-        Obread2 = open(os.path.join(Outdir, "Obread2.fastq"), "w+")
-        with tqdm(desc="Processing reads", unit=" read") as pbar:
-            while True:
-                line1 = FRdata1.readline().rstrip().decode('utf-8')
-                if not line1:
-                    print(index)
-                    break
-
-                line2 = FRdata1.readline().rstrip().decode('utf-8')
-                lineUMI_before = line2.split(self.same_seq)
-                line3 = FRdata1.readline().rstrip().decode('utf-8')
-                line4 = FRdata1.readline().rstrip().decode('utf-8')
-
-                line2_1 = FRdata2.readline().rstrip().decode('utf-8')
-                line2_2 = FRdata2.readline().rstrip().decode('utf-8')
-                line2_3 = FRdata2.readline().rstrip().decode('utf-8')
-                line2_4 = FRdata2.readline().rstrip().decode('utf-8')
-
-                if len(lineUMI_before) > 1:
-                    lineUMI = lineUMI_before[1]
-                    lineUMI2 = str(lineUMI)[0:12]  # the first 12 bp as barcode
-                    if lineUMI2 in BClist:
-                        if len(lineUMI) > 23:
-                            line1BC = (
-                                line1.split(" ")[0] + "_" + lineUMI2 + "_" + lineUMI[12:22]
-                                + " " + line1.split(" ")[1]
-                            )
-                            line2_1BC = (
-                                line2_1.split(" ")[0] + "_" + lineUMI2 + "_" + lineUMI[12:22]
-                                + " " + line2_1.split(" ")[1]
-                            )
-                            line2toBC = line2.split(self.same_seq)[1][22:]
-                            line4toBC = line4[len(line4) - len(line2toBC):]
-                            datanew.write(
-                                line1BC + "\n"
-                                + line2toBC + "\n"
-                                + line3 + "\n"
-                                + line4toBC + "\n"
-                            )
-                            datanew2.write(
-                                line2_1BC + "\n"
-                                + line2_2 + "\n"
-                                + line2_3 + "\n"
-                                + line2_4 + "\n"
-                            )
-                            index += 1
-                        else:
-                            Obread1.write(
-                                line1 + "\n"
-                                + line2 + "\n"
-                                + line3 + "\n"
-                                + line4 + "\n"
-                            )
-                            Obread2.write(
-                                line2_1 + "\n"
-                                + line2_2 + "\n"
-                                + line2_3 + "\n"
-                                + line2_4 + "\n"
-                            )
-                            WRdata1.write(lineUMI2 + "\n")
-                    else:
-                        WRdata1D.write(line2 + "\n")
-                pbar.update(1)
-
-        datanew.close()
-        datanew2.close()
-        Obread1.close()
-        Obread2.close()
+    def _chunks(self, FRdata1, FRdata2, chunk_records, max_reads=None):
+        remaining = max_reads
+        while remaining is None or remaining > 0:
+            n = chunk_records if remaining is None else min(chunk_records, remaining)
+            lines1 = read_chunk(FRdata1, n)
+            if not lines1:
+                return
+            lines2 = read_chunk(FRdata2, n)
+            if remaining is not None:
+                remaining -= n
+            yield lines1, lines2
+
+    def iter_chunks(self, FRdata1, FRdata2, BClist, workers=1, chunk_records=CHUNK_RECORDS,
+                    max_reads=None, **settings):
+        """
+        Lazily yield a TransformedChunk per chunk_records read pairs, in input
+        order. FRdata1/FRdata2 are binary FASTQ streams or any iterables of
+        lines; settings are transform_chunk's keyword arguments. With
+        max_reads, input stops after that many pairs, so the rest of the
+        input is never read or decompressed. With
+        workers > 1 chunks are processed in a process pool, with a bounded
+        number in flight so memory stays flat.
+        """
+        if not isinstance(BClist, BarcodeIndex):
+            BClist = BarcodeIndex(BClist, max_mismatch=0)
+        FRdata1, FRdata2 = iter(FRdata1), iter(FRdata2)
+        chunks = self._chunks(FRdata1, FRdata2, chunk_records, max_reads)
+        if workers <= 1:
+            bc_lookup = BClist.byte_table.get
+            for lines1, lines2 in chunks:
+                yield transform_chunk(lines1, lines2, self.same_seq, bc_lookup, **settings)
+            return
+
+        # Ordered writer: results are consumed in submission order.
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(self.same_seq, BClist.byte_table, settings)) as pool:
+            pending = deque()
+            for lines1, lines2 in chunks:
+                pending.append(pool.submit(_worker_chunk, lines1, lines2))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def stream(self, FRdata1=None, FRdata2=None, BClist=None, pairs=None, workers=1,
+               chunk_records=CHUNK_RECORDS, trimmer=None, summary=None):
+        """
+        Lazily yield a ReadPair for every input pair without touching the
+        filesystem. Chunks come in input order; within a chunk the KEPT pairs
+        come first, then OBREAD, then the rejected ones. Input is two binary
+        streams (or iterables of lines), or pairs: an iterable of (R1 record,
+        R2 record). A diagnostics.TransformSummary passed as summary is
+        updated per chunk. Memory holds a few chunks, whatever the input size.
+
+            for pair in Transformer().stream(r1, r2, barcodes):
+                if pair.disposition == KEPT:
+                    ...
+        """
+        if pairs is not None:
+            FRdata1, FRdata2 = split_pairs(pairs, chunk_records)
+        for chunk in self.iter_chunks(FRdata1, FRdata2, BClist, workers, chunk_records,
+                                      trimmer=trimmer, records=True,
+                                      sample_reads=summary.sample.n if summary else 0):
+            if summary is not None:
+                summary.add_transformed(chunk)
+            for rec1, rec2 in zip(chunk.r1, chunk.r2):
+                name = rec1[1:rec1.find(b"\n")].split(b" ", 1)[0]
+                _, barcode, umi = name.rsplit(b"_", 2)
+                yield ReadPair(KEPT, rec1, rec2, barcode, umi)
+            for rec1, rec2 in zip(chunk.ob1, chunk.ob2):
+                yield ReadPair(OBREAD, rec1, rec2)
+            for disposition, rec1, rec2 in chunk.rejected:
+                yield ReadPair(disposition, rec1, rec2)
+
+    def transform(self, FRdata1, FRdata2, BClist, Outdir,
+                  workers=1, chunk_records=CHUNK_RECORDS,
+                  compress_level=None, compress_threads=4, r2_handle=None,
+                  top_barcodes=20, sample_reads=0, collapse=False, trimmer=None,
+                  well_qc=False, fraction=None, max_reads=None):
+        """
+        Write the tagged R1/R2 and the Obread files into Outdir, plus
+        transform_summary.json with the read counters, the top_barcodes most
+        frequent unmatched 12-mers and sample_reads sampled failed reads
+        (see diagnostics.py). With collapse, PCR duplicates are written once
+        and their multiplicities go to duplicates.tsv.gz (see collapse.py).
+        With a trimming.R2Trimmer, R2 is trimmed in the same pass. With
+        well_qc, per-well reads and estimated UMIs go to well_qc.tsv, written
+        periodically while the reads stream and again at the end. fraction
+        keeps that share of the pairs, chosen by a hash of the read name so
+        reruns keep the same pairs; max_reads stops after that many input
+        pairs without reading the rest. Returns the counters.
+        """
+        # A plain list keeps the historical exact-match behaviour; main.py
+        # passes a BarcodeIndex with single-mismatch correction enabled.
+        if not isinstance(BClist, BarcodeIndex):
+            BClist = BarcodeIndex(BClist, max_mismatch=0)
+        # With compress_level set the four FASTQs are written as BGZF (.gz)
+        # and compressed on background threads. r2_handle (e.g. the FIFO from
+        # star_stream.StarStream) replaces datanew_R2 and is left open.
+        names = ["datanew_R1.fastq", "Obread1.fastq", "Obread2.fastq"]
+        if r2_handle is None:
+            names.insert(1, "datanew_R2.fastq")
+        owned = [
+            open_output(os.path.join(Outdir, output_name(name, compress_level)),
+                        compress_level, compress_threads)
+            for name in names
+        ]
+        if r2_handle is None:
+            datanew, datanew2, Obread1, Obread2 = owned
+        else:
+            datanew, Obread1, Obread2 = owned
+            datanew2 = r2_handle
+        summary = TransformSummary(top_barcodes, sample_reads)
+        collapser = DuplicateCollapser(Outdir) if collapse else None
+        qc = WellQC(BClist.barcodes) if well_qc else None
+        chunks = self.iter_chunks(FRdata1, FRdata2, BClist, workers, chunk_records,
+                                  sample_reads=sample_reads, collapse=collapse, trimmer=trimmer,
+                                  well_qc=well_qc, max_reads=max_reads,
+                                  keep_below=subsample_threshold(fraction))
+        if trimmer is not None:
+            summary.counters.update(trimmed_too_short=0, trimmed_bases=0)
+        if subsample_threshold(fraction) is not None:
+            summary.counters[SUBSAMPLED] = 0
+        try:
+            with tqdm(desc="Processing reads", unit=" read") as pbar:
+                for chunk in chunks:
+                    r1, r2 = chunk.r1, chunk.r2
+                    if collapser is not None:
+                        r1, r2 = collapser.filter(chunk.keys, r1, r2)
+                    datanew.write(r1)
+                    datanew2.write(r2)
+                    Obread1.write(chunk.ob1)
+                    Obread2.write(chunk.ob2)
+                    summary.add_transformed(chunk)
+                    if qc is not None:
+                        qc.add_chunk(chunk.wells)
+                        qc.maybe_write(Outdir)
+                    # One update per chunk, not per read.
+                    pbar.update(chunk.reads)
+        finally:
+            chunks.close()
+            for handle in owned:
+                handle.close()
+        if collapser is not None:
+            collapser.write()
+            summary.counters["duplicates"] = collapser.duplicates
+        if qc is not None:
+            rows = qc.rows()
+            qc.write(Outdir, rows)
+            summary.well_qc = qc.overview(rows)
+        summary.write(Outdir)
+        stats = summary.counters
+        print(f"[Info] Transformed {stats['reads']} read pairs: {stats['kept']} kept, "
+              f"{stats['obread']} to Obread, {stats['barcode_miss']} barcode misses, "
+              f"{stats['no_linker']} without linker")
+        if SUBSAMPLED in stats:
+            print(f"[Info] Subsampling kept {stats['reads'] - stats[SUBSAMPLED]} of "
+                  f"{stats['reads']} read pairs (fraction {fraction})")
+        if max_reads is not None and stats["reads"] >= max_reads:
+            print(f"[Info] Stopped after the first {max_reads} read pairs (--max-reads)")
+        if trimmer is not None:
+            print(f"[Info] R2 trimming removed {stats['trimmed_bases']} bases; "
+                  f"{stats['trimmed_too_short']} pairs shorter than {trimmer.min_length} bp dropped")
+        if collapser is not None:
+            print(f"[Info] Collapsed {collapser.duplicates} PCR duplicates; "
+                  f"{stats['kept'] - collapser.duplicates} unique reads go to alignment")
+            if collapser.windows > 1:
+                print(f"[Warning] More than {collapser.max_keys} unique reads: duplicates were "
+                      f"collapsed within {collapser.windows} windows to bound memory")
+        if qc is not None:
+            overview = summary.well_qc
+            print(f"[Info] {overview['wells_with_reads']}/{overview['wells']} wells with reads, "
+                  f"median {overview['median_reads']} reads, estimated UMI saturation "
+                  f"{overview['saturation']:.1%}")
+            if overview["low_wells"]:
+                print(f"[Warning] {len(overview['low_wells'])} wells have under "
+                      f"{LOW_WELL_FRACTION:.0%} of the median reads: "
+                      f"{', '.join(overview['low_wells'][:10])}")
+        for entry in summary.as_dict()["unmatched_barcodes"][:3]:
+            print(f"[Info] Frequent unmatched barcode {entry['barcode']}: {entry['count']} reads")
+        return stats
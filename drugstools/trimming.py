@@ -0,0 +1,100 @@
+# trimming.py
+"""
+R2 (cDNA) trimming fused into the transform pass.
+
+R2Trimmer.trim returns where a read should end after, in this order:
+
+1. 3' quality trimming with BWA's (and cutadapt -q's) running-sum rule.
+   The scan walks back from the 3' end and stops as soon as the sum turns
+   negative, so a read ending in good bases costs a single comparison.
+2. Adapter trimming: the read is cut at the first exact occurrence of the
+   adapter's first ADAPTER_PROBE bases, or at a 3' suffix that is a prefix
+   of the adapter (at least min_overlap bases long).
+3. PolyA trimming: a trailing run of As, scored +1 per A and -4 per other
+   base (cutadapt --poly-a style) so isolated errors inside a long tail are
+   tolerated, if at least polya_min long.
+
+transform_chunk then writes R2 cut to that length, or drops the pair when
+fewer than min_length bases are left, so these reads never reach STAR.
+"""
+
+ADAPTER_PROBE = 12
+A = ord("A")
+
+
+class R2Trimmer:
+    def __init__(self, quality=0, adapter=None, polya=False, polya_min=6, min_length=0,
+                 min_overlap=3, phred_offset=33):
+        self.quality = quality
+        self.adapter = adapter.encode() if isinstance(adapter, str) else adapter
+        self.polya = polya
+        self.polya_min = polya_min
+        # An empty R2 read would break STAR, so at least 1 base is kept.
+        self.min_length = max(1, min_length)
+        self._requested_length = min_length
+        self.min_overlap = min_overlap
+        self.phred_offset = phred_offset
+        self._probe = self.adapter[:ADAPTER_PROBE] if self.adapter else None
+        # quality cutoff as a raw byte value, so the scan needs no decoding
+        self._cutoff = quality + phred_offset
+
+    @classmethod
+    def from_options(cls, options):
+        """The trimmer for the trimming options, or None when none is set."""
+        trimmer = cls(quality=options.trim_quality or 0, adapter=options.trim_adapter,
+                      polya=options.trim_polya, min_length=options.min_r2_length or 0)
+        return trimmer if trimmer.enabled else None
+
+    @property
+    def enabled(self):
+        return bool(self.quality or self.adapter or self.polya or self._requested_length)
+
+    def params(self):
+        return {"quality": self.quality, "adapter": self.adapter.decode() if self.adapter else None,
+                "polya": self.polya, "min_length": self.min_length}
+
+    def quality_end(self, qual):
+        cutoff = self._cutoff
+        total = best = 0
+        end = len(qual)
+        for i in range(len(qual) - 1, -1, -1):
+            total += cutoff - qual[i]
+            if total < 0:
+                break
+            if total > best:
+                best, end = total, i
+        return end
+
+    def adapter_end(self, seq):
+        probe = self._probe
+        pos = seq.find(probe)
+        if pos >= 0:
+            return pos
+        for k in range(min(len(probe) - 1, len(seq)), self.min_overlap - 1, -1):
+            if seq.endswith(probe[:k]):
+                return len(seq) - k
+        return len(seq)
+
+    def polya_end(self, seq):
+        score = best = 0
+        end = len(seq)
+        for i in range(len(seq) - 1, -1, -1):
+            score += 1 if seq[i] == A else -4
+            if score < 0:
+                break
+            if score > best:
+                best, end = score, i
+        return end if len(seq) - end >= self.polya_min else len(seq)
+
+    def trim(self, seq, qual):
+        """Length to keep of seq/qual (bytes without newline)."""
+        end = len(seq)
+        if self.quality:
+            end = self.quality_end(qual)
+            seq = seq[:end]
+        if self._probe and end:
+            end = self.adapter_end(seq)
+            seq = seq[:end]
+        if self.polya and end:
+            end = self.polya_end(seq)
+        return end
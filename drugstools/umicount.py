@@ -0,0 +1,218 @@
+# umicount.py
+"""
+Per-well UMI counting straight from the featureCounts-annotated BAM.
+
+This replaces `samtools sort` + `samtools index` + `umi_tools count
+--per-gene --per-cell --wide-format-cell-counts`: alignments are streamed
+once (no coordinate sort), reads with XS:Z:Assigned are grouped by
+(gene from XT, well barcode and UMI from the _BARCODE_UMI read-name suffix
+added by Transformer), and UMIs are deduplicated per (well, gene) with
+umi_tools' "directional" network method (or "unique"). The result is
+written in the same wide-format table umi_tools produces, and optionally
+as a sparse matrix (see sparse.py).
+"""
+
+import gzip
+import subprocess
+
+from .sparse import write_sparse
+
+METHODS = ["directional", "unique"]
+
+# Unmapped (0x4), secondary (0x100) and supplementary (0x800) records do
+# not count.
+SKIP_FLAGS = 0x904
+
+
+def parse_read_name(qname):
+    """Return (barcode, umi) from a read name ending in _BARCODE_UMI."""
+    rest, barcode, umi = qname.rsplit(b"_", 2)
+    return barcode, umi
+
+
+def _neighbours(umi):
+    for i, base in enumerate(umi):
+        prefix, suffix = umi[:i], umi[i + 1:]
+        for sub in b"ACGTN":
+            if sub != base:
+                yield prefix + bytes((sub,)) + suffix
+
+
+def directional_count(umi_counts):
+    """
+    Number of molecules among {umi: reads} with umi_tools' directional
+    method: an edge a -> b exists when a and b differ at one position and
+    count(a) >= 2 * count(b) - 1; each component reached by walking edges
+    from the most abundant unvisited UMI is one molecule.
+    """
+    if len(umi_counts) == 1:
+        return 1
+    found = set()
+    molecules = 0
+    for umi in sorted(umi_counts, key=umi_counts.get, reverse=True):
+        if umi in found:
+            continue
+        molecules += 1
+        found.add(umi)
+        queue = [umi]
+        while queue:
+            node = queue.pop()
+            threshold = umi_counts[node]
+            for other in _neighbours(node):
+                count = umi_counts.get(other)
+                if count is not None and other not in found and threshold >= 2 * count - 1:
+                    found.add(other)
+                    queue.append(other)
+    return molecules
+
+
+class UMICounter:
+    """Hash-based (gene, barcode) -> {umi: reads} table."""
+
+    def __init__(self, method="directional"):
+        if method not in METHODS:
+            raise ValueError(f"Unknown UMI method '{method}', choose from {METHODS}")
+        self.method = method
+        self.groups = {}
+        self.reads = 0
+
+    def add(self, gene, barcode, umi, n=1):
+        umis = self.groups.get((gene, barcode))
+        if umis is None:
+            umis = self.groups[(gene, barcode)] = {}
+        umis[umi] = umis.get(umi, 0) + n
+        self.reads += n
+
+    def merge(self, groups, reads):
+        """
+        Add another counter's groups (e.g. one shard's, see scatter.py). Read
+        counts per UMI are summed before deduplication, so merging is exact.
+        """
+        for key, other in groups.items():
+            umis = self.groups.get(key)
+            if umis is None:
+                self.groups[key] = dict(other)
+                continue
+            for umi, n in other.items():
+                umis[umi] = umis.get(umi, 0) + n
+        self.reads += reads
+
+    def counts(self):
+        """Yield (gene, barcode, molecules) for every non-empty group."""
+        for (gene, barcode), umis in self.groups.items():
+            if self.method == "unique":
+                yield gene, barcode, len(umis)
+            else:
+                yield gene, barcode, directional_count(umis)
+
+    def table(self):
+        """Return (genes, barcodes, {gene: {barcode: molecules}}), sorted."""
+        table = {}
+        barcodes = set()
+        for gene, barcode, n in self.counts():
+            table.setdefault(gene, {})[barcode] = n
+            barcodes.add(barcode)
+        return sorted(table), sorted(barcodes), table
+
+    def write_wide(self, path, table=None):
+        """Write a gene x barcode table like umi_tools --wide-format-cell-counts."""
+        genes, barcodes, table = table or self.table()
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "wt") as out:
+            out.write("gene\t" + "\t".join(b.decode() for b in barcodes) + "\n")
+            for gene in genes:
+                row = table[gene]
+                out.write(gene.decode() + "\t"
+                          + "\t".join(str(row.get(b, 0)) for b in barcodes) + "\n")
+
+    def write_sparse(self, prefix, npz=False, table=None):
+        genes, barcodes, table = table or self.table()
+        column = {b: j for j, b in enumerate(barcodes)}
+        rows = [sorted((column[b], n) for b, n in table[gene].items()) for gene in genes]
+        return write_sparse(prefix, [g.decode() for g in genes],
+                            [b.decode() for b in barcodes], rows, npz=npz)
+
+    def write(self, out_path, sparse_prefix=None, npz=False):
+        table = self.table()
+        self.write_wide(out_path, table)
+        if sparse_prefix:
+            self.write_sparse(sparse_prefix, npz=npz, table=table)
+
+
+def iter_assigned(sam_lines, gene_tag=b"XT", status_tag=b"XS", multiplicities=None,
+                  assigner=None):
+    """
+    Yield (gene, barcode, umi, reads) for every primary, mapped, Assigned
+    alignment in an iterable of SAM text lines (bytes). reads is 1, or the
+    read's multiplicity from duplicates.tsv.gz (see collapse.py). With an
+    annotation.GeneAssigner the gene is assigned here instead of read from
+    the featureCounts tags.
+    """
+    multiplicity = (multiplicities or {}).get
+    gene_prefix = gene_tag + b":Z:"
+    status_prefix = status_tag + b":Z:"
+    for line in sam_lines:
+        if line[:1] == b"@":
+            continue
+        fields = line.rstrip(b"\n").split(b"\t")
+        if int(fields[1]) & SKIP_FLAGS:
+            continue
+        if assigner is not None:
+            status, gene = assigner.assign(fields)
+            if gene is None:
+                continue
+            barcode, umi = parse_read_name(fields[0])
+            yield gene, barcode, umi, multiplicity(fields[0], 1)
+            continue
+        gene = status = None
+        for tag in fields[11:]:
+            if tag.startswith(gene_prefix):
+                gene = tag[5:]
+            elif tag.startswith(status_prefix):
+                status = tag[5:]
+        if status != b"Assigned" or gene is None:
+            continue
+        barcode, umi = parse_read_name(fields[0])
+        yield gene, barcode, umi, multiplicity(fields[0], 1)
+
+
+def collect_sam_lines(sam_lines, method="directional", multiplicities=None, assigner=None):
+    counter = UMICounter(method)
+    add = counter.add
+    for gene, barcode, umi, n in iter_assigned(sam_lines, multiplicities=multiplicities,
+                                               assigner=assigner):
+        add(gene, barcode, umi, n)
+    return counter
+
+
+def count_sam_lines(sam_lines, out_path, method="directional", sparse_prefix=None, npz=False,
+                    multiplicities=None, assigner=None):
+    counter = collect_sam_lines(sam_lines, method, multiplicities, assigner)
+    counter.write(out_path, sparse_prefix, npz)
+    return counter
+
+
+def collect_bam(bam_path, method="directional", samtools="samtools", threads=1,
+                multiplicities=None, assigner=None):
+    """Stream bam_path through `samtools view` once into a UMICounter."""
+    cmd = [samtools, "view", "-F", str(SKIP_FLAGS)]
+    if int(threads) > 1:
+        cmd += ["-@", str(int(threads) - 1)]
+    cmd.append(bam_path)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1 << 20)
+    try:
+        counter = collect_sam_lines(proc.stdout, method, multiplicities, assigner)
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        raise RuntimeError(f"samtools view {bam_path} failed with exit code {returncode}")
+    return counter
+
+
+def count_bam(bam_path, out_path, method="directional", samtools="samtools", threads=1,
+              sparse_prefix=None, npz=False, multiplicities=None, assigner=None):
+    """Stream bam_path through `samtools view` once and write the counts table."""
+    counter = collect_bam(bam_path, method, samtools, threads, multiplicities, assigner)
+    counter.write(out_path, sparse_prefix, npz)
+    return counter
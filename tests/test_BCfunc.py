@@ -0,0 +1,31 @@
+from drugstools.BCfunc import BCFunc, BarcodeIndex
+
+
+def test_get_barcodes_skips_blank_lines(tmp_path):
+    bcfile = tmp_path / "BC.txt"
+    bcfile.write_text("GTACAACGTGAT\n\nGTACAAACATCG\n")
+    assert BCFunc.get_barcodes(str(bcfile)) == ["GTACAACGTGAT", "GTACAAACATCG"]
+
+
+def test_exact_lookup():
+    index = BarcodeIndex(["GTACAACGTGAT", "GTACAAACATCG"], max_mismatch=0)
+    assert index.lookup("GTACAACGTGAT") == "GTACAACGTGAT"
+    assert index.lookup("GTACAACGTGAA") is None
+    assert len(index) == 2
+
+
+def test_single_mismatch_is_corrected():
+    index = BarcodeIndex(["GTACAACGTGAT", "GTACAAACATCG"])
+    assert index.lookup("GTACAACGTGAA") == "GTACAACGTGAT"
+    assert index.lookup("NTACAAACATCG") == "GTACAAACATCG"
+    assert index.lookup("GTACAACGTGCC") is None
+
+
+def test_ambiguous_neighbours_are_dropped():
+    # AAAA and AAAC share the neighbours AAAG/AAAT/AAAN.
+    index = BarcodeIndex(["AAAA", "AAAC"])
+    assert index.lookup("AAAG") is None
+    assert index.lookup("AAAA") == "AAAA"
+    assert index.lookup("AAAC") == "AAAC"
+    assert index.lookup("CAAA") == "AAAA"
+    assert index.n_ambiguous == 3
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+from drugstools.annotation import GeneAssigner, GeneIndex, aligned_blocks, cache_path
+
+GTF = """\
+#!genome-build test
+chr1\tt\tgene\t100\t400\t.\t+\t.\tgene_id "A";
+chr1\tt\texon\t100\t200\t.\t+\t.\tgene_id "A"; transcript_id "A1";
+chr1\tt\texon\t150\t220\t.\t+\t.\tgene_id "A"; transcript_id "A2";
+chr1\tt\texon\t300\t400\t.\t+\t.\tgene_id "A"; transcript_id "A1";
+chr1\tt\texon\t380\t500\t.\t-\t.\tgene_id "B"; transcript_id "B1";
+chr2\tt\texon\t10\t50\t.\t+\t.\tgene_id "C"; transcript_id "C1";
+"""
+
+
+def sam(chrom, pos, cigar, flag=0, tags=("NH:i:1",)):
+    return [b"r_AAAA_CCCC", str(flag).encode(), chrom, str(pos).encode(), b"255", cigar,
+            b"*", b"0", b"0", b"ACGT", b"FFFF"] + [t.encode() for t in tags]
+
+
+@pytest.fixture
+def gtf(tmp_path):
+    path = tmp_path / "genes.gtf"
+    path.write_text(GTF)
+    return str(path)
+
+
+def test_index_merges_exons_per_gene(gtf):
+    index = GeneIndex.from_gtf(gtf)
+    assert index.genes == ["A", "B", "C"]
+    starts, ends, numbers, _ = index.chroms["chr1"]
+    assert list(zip(starts, ends, numbers)) == [(100, 220, 0), (300, 400, 0), (380, 500, 1)]
+
+
+def test_aligned_blocks_split_at_junctions():
+    assert list(aligned_blocks(100, b"5S10M2D5M100N20M3I5M")) == [(100, 116), (217, 241)]
+
+
+@pytest.mark.parametrize("fields, expected", [
+    (sam(b"chr1", 90, b"20M"), ("Assigned", b"A")),
+    # Spliced across the intron: both blocks land in A's exons.
+    (sam(b"chr1", 211, b"5M80N10M"), ("Assigned", b"A")),
+    (sam(b"chr1", 230, b"50M"), ("Unassigned_NoFeatures", None)),
+    (sam(b"chr1", 390, b"20M"), ("Unassigned_Ambiguity", None)),
+    (sam(b"chr3", 10, b"20M"), ("Unassigned_NoFeatures", None)),
+    (sam(b"chr1", 100, b"20M", tags=("NH:i:2",)), ("Unassigned_MultiMapping", None)),
+    (sam(b"*", 0, b"*", flag=4), ("Unassigned_Unmapped", None)),
+])
+def test_assigner_follows_featurecounts_rules(gtf, fields, expected):
+    assigner = GeneAssigner(GeneIndex.from_gtf(gtf))
+    assert assigner.assign(fields) == expected
+    assert assigner.summary[expected[0]] == 1
+
+
+def test_tag_adds_featurecounts_tags(gtf):
+    assigner = GeneAssigner(GeneIndex.from_gtf(gtf))
+    line = b"\t".join(sam(b"chr2", 20, b"10M")) + b"\n"
+    assert assigner.tag(line).endswith(b"NH:i:1\tXS:Z:Assigned\tXT:Z:C\n")
+    assert assigner.tag(b"@HD\tVN:1.6\n") == b"@HD\tVN:1.6\n"
+
+
+def test_index_is_cached_next_to_the_gtf(gtf, monkeypatch):
+    built = GeneIndex.load(gtf)
+    cached = cache_path(gtf)
+    monkeypatch.setattr(GeneIndex, "from_gtf", classmethod(lambda cls, path: pytest.fail("rebuilt")))
+    assert GeneIndex.load(gtf).chroms == built.chroms
+    # Keyed on path, size and mtime: found with a stat(), without reading the GTF.
+    monkeypatch.setattr("builtins.open", lambda *args, **kwargs: pytest.fail("GTF read"))
+    assert cache_path(gtf) == cached
+    monkeypatch.undo()
+    st = os.stat(gtf)
+    os.utime(gtf, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    assert cache_path(gtf) != cached
+    with open(gtf, "a") as out:
+        out.write('chr2\tt\texon\t60\t70\t.\t+\t.\tgene_id "D";\n')
+    assert cache_path(gtf) != cached
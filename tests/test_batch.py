@@ -0,0 +1,140 @@
+import gzip
+import os
+import threading
+import time
+
+from drugstools.BCfunc import BarcodeIndex, BCFunc
+from drugstools.bench import install_stub_tools
+from drugstools.batch import ResourcePool, pair_samples, run_batch
+from drugstools.pipeline_params import get_parser
+from drugstools.synthetic import random_barcodes, write_gtf, write_pair, write_whitelist
+
+LINKER = "CAGTGGTATCAACGCAGA"
+BARCODE = "GTACAACGTGAT"
+
+
+def touch_gz(path, text=""):
+    with gzip.open(str(path), "wt") as handle:
+        handle.write(text)
+
+
+def test_pair_samples(tmp_path):
+    for name in ["A_1.fastq.gz", "A_2.fastq.gz", "B_L3_801_1.fq.gz", "B_L3_801_2.fq.gz",
+                 "C_R1.fastq.gz", "C_R2.fastq.gz", "orphan_1.fastq.gz"]:
+        touch_gz(tmp_path / name)
+    samples = pair_samples(str(tmp_path))
+    assert [(s, os.path.basename(a), os.path.basename(b)) for s, a, b in samples] == [
+        ("A", "A_1.fastq.gz", "A_2.fastq.gz"),
+        ("B_L3_801", "B_L3_801_1.fq.gz", "B_L3_801_2.fq.gz"),
+        ("C", "C_R1.fastq.gz", "C_R2.fastq.gz"),
+    ]
+
+
+def test_pair_samples_merges_lanes(tmp_path):
+    for lane in ("L002", "L001"):
+        for read in ("1", "2"):
+            touch_gz(tmp_path / f"A_S1_{lane}_{read}.fastq.gz")
+    touch_gz(tmp_path / "B_L3_801_1.fq.gz")
+    touch_gz(tmp_path / "B_L3_801_2.fq.gz")
+    samples = pair_samples(str(tmp_path))
+    assert [(s, [os.path.basename(p) for p in a], [os.path.basename(p) for p in b])
+            for s, a, b in samples[:1]] == [
+        ("A_S1", ["A_S1_L001_1.fastq.gz", "A_S1_L002_1.fastq.gz"],
+         ["A_S1_L001_2.fastq.gz", "A_S1_L002_2.fastq.gz"])]
+    assert samples[1][0] == "B_L3_801" and isinstance(samples[1][1], str)
+
+
+def test_pair_samples_reads_illumina_lane_names(tmp_path):
+    for lane in ("L002", "L001"):
+        for read in ("R1", "R2"):
+            touch_gz(tmp_path / f"A_S1_{lane}_{read}_001.fastq.gz")
+    samples = pair_samples(str(tmp_path))
+    assert [(s, [os.path.basename(p) for p in a], [os.path.basename(p) for p in b])
+            for s, a, b in samples] == [
+        ("A_S1", ["A_S1_L001_R1_001.fastq.gz", "A_S1_L002_R1_001.fastq.gz"],
+         ["A_S1_L001_R2_001.fastq.gz", "A_S1_L002_R2_001.fastq.gz"])]
+
+
+def test_resource_pool_caps_concurrency():
+    pool = ResourcePool(cores=8, memory_gb=64)
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def job():
+        with pool.reserve(2, 30):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+    threads = [threading.Thread(target=job) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 2
+
+
+def test_resource_pool_disk_budget():
+    pool = ResourcePool(cores=8, memory_gb=64, disk_gb=10)
+    order = []
+
+    def job(name, disk_gb):
+        with pool.reserve(0, 0, disk_gb):
+            order.append(name)
+            time.sleep(0.05)
+
+    first = threading.Thread(target=job, args=("big", 8))
+    first.start()
+    time.sleep(0.01)
+    second = threading.Thread(target=job, args=("small", 4))
+    start = time.time()
+    second.start()
+    second.join()
+    first.join()
+    assert order == ["big", "small"] and time.time() - start >= 0.03
+    # Without a budget, and for requests above it, nothing waits forever.
+    with ResourcePool(8, 64).reserve(1, 1, 100), pool.reserve(0, 0, 100):
+        pass
+
+
+def test_batch_transform_writes_one_directory_per_sample(tmp_path):
+    reads = tmp_path / "reads"
+    reads.mkdir()
+    for sample in ("S1", "S2"):
+        r1 = f"@{sample}r 1:N:0:A\n{LINKER}{BARCODE}AAAAACCCCCGGGGTTTT\n+\n{'F' * 48}\n"
+        r2 = f"@{sample}r 2:N:0:A\nACGTACGT\n+\nFFFFFFFF\n"
+        touch_gz(reads / f"{sample}_1.fastq.gz", r1)
+        touch_gz(reads / f"{sample}_2.fastq.gz", r2)
+    out = tmp_path / "out"
+    options, _ = get_parser().parse_args([
+        "-f", str(reads), "-b", "unused", "-o", str(out), "-g", "genes.gtf", "-d", "genome",
+        "--batch", "--step", "transform", "--keep-temp-files", "--cores", "4", "--memory-gb", "8",
+        "--decompressor", "gzip",
+    ])
+    run_batch(options, pair_samples(str(reads)), BarcodeIndex([BARCODE]))
+    for sample in ("S1", "S2"):
+        with open(str(out / sample / "datanew_R2.fastq")) as handle:
+            assert handle.readline() == f"@{sample}r_{BARCODE}_AAAAACCCCC 2:N:0:A\n"
+        assert (out / sample / "Druglog.txt").exists()
+
+
+def test_batch_resolves_relative_paths_before_entering_sample_dirs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("PATH", install_stub_tools(str(tmp_path / "bin")) + os.pathsep
+                       + os.environ["PATH"])
+    os.mkdir("reads")
+    os.mkdir("genomeIndex")
+    barcodes = random_barcodes(4)
+    write_whitelist("barcodes.txt", barcodes)
+    write_gtf("genes.gtf")
+    write_pair("reads/S_1.fastq.gz", "reads/S_2.fastq.gz", 200, barcodes)
+    options, _ = get_parser().parse_args([
+        "-f", "./reads", "-b", "./barcodes.txt", "-o", "./out", "-g", "./genes.gtf",
+        "-d", "./genomeIndex", "--batch", "--cores", "2", "--memory-gb", "8",
+        "--decompressor", "gzip",
+    ])
+    run_batch(options, pair_samples("reads"), BarcodeIndex(BCFunc.get_barcodes("barcodes.txt")))
+    assert (tmp_path / "out" / "S" / "S_counts.tsv.gz").exists()
@@ -0,0 +1,29 @@
+import json
+
+from drugstools import bench
+from drugstools.synthetic import generate_reads, random_barcodes
+
+
+def test_generator_rates():
+    barcodes = random_barcodes(8)
+    pairs = list(generate_reads(1000, barcodes, linker_rate=0.5, barcode_error_rate=0))
+    with_linker = sum("CAGTGGTATCAACGCAGA" in r1 for r1, _ in pairs)
+    assert 400 < with_linker < 600
+    assert pairs[0][0].split()[0] == pairs[0][1].split()[0] == "@SYN0"
+
+
+def test_bench_runs_offline_with_stub_tools(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    out = str(tmp_path / "bench.json")
+    bench.main(["--reads", "300", "--whitelist", "8,16", "--repeat", "1", "--count", "--out", out])
+    with open(out) as handle:
+        results = json.load(handle)["results"]
+    benchmarks = {(r["benchmark"], r["params"]["whitelist"]) for r in results}
+    assert ("transform", 16) in benchmarks and ("stage:count", 8) in benchmarks
+    transform = [r for r in results if r["benchmark"] == "transform"][0]
+    assert transform["counters"]["reads"] == 300
+    count = [r for r in results if r["benchmark"] == "stage:count"][0]
+    assert count["metrics"]["status"] == "done" and count["metrics"]["records"] > 0
+
+    bench.main(["--reads", "300", "--whitelist", "8", "--repeat", "1", "--count",
+                "--umi-counter", "umi_tools", "--out", str(tmp_path / "new.json"), "--compare", out])
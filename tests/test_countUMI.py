@@ -0,0 +1,79 @@
+import gzip
+
+from drugstools.countUMI import CountUMI
+from drugstools.sparse import load_counts, wide_to_sparse
+from drugstools.umicount import UMICounter, count_sam_lines, directional_count
+
+
+def sam(qname, gene="GENE1", status="Assigned", flag=0):
+    tags = [f"XS:Z:{status}"]
+    if gene:
+        tags.append(f"XT:Z:{gene}")
+    fields = [qname, str(flag), "chr1", "100", "255", "50M", "*", "0", "0", "ACGT", "FFFF",
+              "NH:i:1"] + tags
+    return ("\t".join(fields) + "\n").encode()
+
+
+def test_directional_collapses_one_mismatch_children():
+    assert directional_count({b"AAAA": 10, b"AAAT": 2, b"TTTT": 1}) == 2
+    assert directional_count({b"AAAA": 2, b"AAAT": 2}) == 2
+    assert directional_count({b"AAAA": 1, b"AAAT": 1}) == 1
+    # Chains are followed: AAAA -> AAAT -> AATT.
+    assert directional_count({b"AAAA": 20, b"AAAT": 5, b"AATT": 1}) == 1
+
+
+def test_wide_counts_table(tmp_path):
+    lines = [
+        b"@HD\tVN:1.6\n",
+        sam("r1_BC1_AAAAAAAAAA"),
+        sam("r2_BC1_AAAAAAAAAA"),
+        sam("r3_BC1_CCCCCCCCCC"),
+        sam("r4_BC2_AAAAAAAAAA"),
+        sam("r5_BC2_AAAAAAAAAA", gene="GENE2"),
+        sam("r6_BC2_GGGGGGGGGG", gene="GENE2", status="Unassigned_NoFeatures"),
+        sam("r7_BC2_TTTTTTTTTT", gene="GENE2", flag=256),
+    ]
+    out = str(tmp_path / "S1_counts.tsv.gz")
+    counter = count_sam_lines(lines, out)
+    assert counter.reads == 5
+    with gzip.open(out, "rt") as handle:
+        assert handle.read() == "gene\tBC1\tBC2\nGENE1\t2\t1\nGENE2\t0\t1\n"
+
+
+def test_native_counter_is_default():
+    count_umi = CountUMI("genes.gtf", "genome")
+    assert count_umi.umi_counter == "native"
+    assert count_umi.umi_method == "directional"
+
+
+def test_sparse_output_round_trip(tmp_path):
+    lines = [sam("r1_BC1_AAAAAAAAAA"), sam("r2_BC2_CCCCCCCCCC", gene="GENE2"),
+             sam("r3_BC2_GGGGGGGGGG", gene="GENE2")]
+    prefix = str(tmp_path / "S1")
+    count_sam_lines(lines, prefix + "_counts.tsv.gz", sparse_prefix=prefix)
+    counts = load_counts(prefix)
+    assert counts.features == ["GENE1", "GENE2"]
+    assert counts.barcodes == ["BC1", "BC2"]
+    assert counts.nnz == 2
+    assert counts.row("GENE2") == {"BC2": 2}
+    with gzip.open(prefix + "_matrix.mtx.gz", "rt") as handle:
+        assert handle.read().splitlines()[1:] == ["2 2 2", "1 1 1", "2 2 2"]
+
+    converted = str(tmp_path / "converted")
+    wide_to_sparse(prefix + "_counts.tsv.gz", converted)
+    assert load_counts(converted).row("GENE1") == {"BC1": 1}
+
+
+def test_merged_shards_deduplicate_like_one_table():
+    # Each shard alone sees a different dominant UMI (two molecules in total),
+    # but merged, AAAA (3 reads) absorbs AAAT (2 reads).
+    shards = [[b"AAAA", b"AAAA"], [b"AAAA", b"AAAT", b"AAAT"]]
+    whole, merged = UMICounter(), UMICounter()
+    for umis in shards:
+        shard = UMICounter()
+        for umi in umis:
+            shard.add(b"G", b"W", umi)
+            whole.add(b"G", b"W", umi)
+        merged.merge(shard.groups, shard.reads)
+    assert list(merged.counts()) == list(whole.counts()) == [(b"G", b"W", 1)]
+    assert merged.reads == whole.reads == 5
@@ -0,0 +1,83 @@
+import gzip
+import os
+import shutil
+import stat
+
+import pytest
+
+from drugstools import fastq_io
+from drugstools.fastq_io import LaneReader, open_fastq
+
+RECORDS = b"".join(b"@r%d 1:N:0:A\nACGTACGT\n+\nFFFFFFFF\n" % i for i in range(5000))
+
+
+def write_gz(tmp_path, name="reads_1.fastq.gz", data=RECORDS):
+    path = tmp_path / name
+    with gzip.open(str(path), "wb") as handle:
+        handle.write(data)
+    return str(path)
+
+
+@pytest.mark.parametrize("method", ["thread", "gzip"])
+def test_readers_return_decompressed_lines(tmp_path, method):
+    path = write_gz(tmp_path)
+    with open_fastq(path, method) as handle:
+        assert handle.readline() == b"@r0 1:N:0:A\n"
+        assert b"".join(handle) == RECORDS[len(b"@r0 1:N:0:A\n"):]
+
+
+def test_uncompressed_input_is_read_directly(tmp_path):
+    path = tmp_path / "reads_1.fastq"
+    path.write_bytes(RECORDS)
+    with open_fastq(str(path), "thread") as handle:
+        assert handle.read() == RECORDS
+
+
+def test_threaded_reader_reports_corrupt_input(tmp_path):
+    path = write_gz(tmp_path)
+    with open(path, "r+b") as handle:
+        handle.truncate(os.path.getsize(path) // 2)
+    with pytest.raises(EOFError):
+        with open_fastq(path, "thread") as handle:
+            handle.read()
+
+
+def test_pipe_reader(tmp_path, monkeypatch):
+    # A stand-in "pigz" so the pipe path runs without the real tool.
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    fake = bindir / "pigz"
+    fake.write_text("#!/bin/sh\nshift\nexec gzip -dc \"$@\"\n")
+    fake.chmod(fake.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(bindir) + os.pathsep + os.environ["PATH"])
+    if shutil.which("gzip") is None:
+        pytest.skip("gzip not available")
+    assert fastq_io.resolve_method("auto") == "pigz"
+    path = write_gz(tmp_path)
+    with open_fastq(path) as handle:
+        assert handle.read() == RECORDS
+
+
+def test_bgzf_writer_roundtrip(tmp_path):
+    path = str(tmp_path / "out.fastq.gz")
+    data = RECORDS * 10
+    with fastq_io.open_output(path, compress_level=1, threads=2) as handle:
+        for start in range(0, len(data), 7777):
+            handle.write(data[start:start + 7777])
+    with gzip.open(path, "rb") as handle:
+        assert handle.read() == data
+    with open(path, "rb") as handle:
+        assert handle.read()[-28:] == fastq_io.BGZF_EOF
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 5])
+def test_lanes_are_read_back_to_back(tmp_path, prefetch):
+    half = len(RECORDS) // 2
+    lanes = [write_gz(tmp_path, "A_L001_1.fastq.gz", RECORDS[:half]),
+             write_gz(tmp_path, "A_L002_1.fastq.gz", RECORDS[half:]), str(tmp_path / "A_L003_1.fastq")]
+    (tmp_path / "A_L003_1.fastq").write_bytes(RECORDS)
+    with open_fastq(lanes, "thread", prefetch) as handle:
+        assert isinstance(handle, LaneReader)
+        assert handle.readline() == b"@r0 1:N:0:A\n"
+        assert len(handle._open) == min(prefetch, 2)
+        assert b"".join(handle) == RECORDS[len(b"@r0 1:N:0:A\n"):] + RECORDS
@@ -0,0 +1,56 @@
+import os
+import stat
+import sys
+
+import pytest
+
+from drugstools.countUMI import CountUMI
+from drugstools.genome_load import GenomeLoadError, GenomeResidency
+
+FAKE_STAR = """#!{python}
+import sys
+with open({calls!r}, "a") as calls:
+    calls.write(" ".join(sys.argv[1:]) + "\\n")
+sys.exit({code})
+"""
+
+
+def fake_star(tmp_path, code=0):
+    calls = tmp_path / "calls.txt"
+    star = tmp_path / "STAR"
+    star.write_text(FAKE_STAR.format(python=sys.executable, calls=str(calls), code=code))
+    star.chmod(star.stat().st_mode | stat.S_IEXEC)
+    return str(star), calls
+
+
+def modes(calls):
+    return [line.split("--genomeLoad ")[1].split()[0] for line in calls.read_text().splitlines()]
+
+
+def test_load_and_unload(tmp_path):
+    star, calls = fake_star(tmp_path)
+    with GenomeResidency("genome", star=star) as residency:
+        assert residency.loaded
+    assert modes(calls) == ["LoadAndExit", "Remove"]
+    assert residency.load_seconds is not None and residency.unload_seconds is not None
+
+
+def test_unload_on_failure(tmp_path):
+    star, calls = fake_star(tmp_path)
+    with pytest.raises(KeyboardInterrupt):
+        with GenomeResidency("genome", star=star):
+            raise KeyboardInterrupt
+    assert modes(calls) == ["LoadAndExit", "Remove"]
+
+
+def test_failed_load_raises(tmp_path):
+    star, _ = fake_star(tmp_path, code=1)
+    with pytest.raises(GenomeLoadError):
+        with GenomeResidency("genome", star=star):
+            pass
+
+
+def test_shared_genome_star_command():
+    cmd = " ".join(CountUMI("genes.gtf", "genome", shared_genome=True).star_argv("in.fastq", "out", "S1"))
+    assert "--genomeLoad LoadAndKeep --limitBAMsortRAM" in cmd
+    assert "--genomeLoad" not in CountUMI("genes.gtf", "genome").star_argv("in.fastq", "out", "S1")
@@ -0,0 +1,240 @@
+import gzip
+import json
+import os
+import time
+
+import pytest
+
+from drugstools.BCfunc import BarcodeIndex, BCFunc
+from drugstools.bench import install_stub_tools
+from drugstools.countUMI import CountUMI
+from drugstools.metrics import RunMetrics
+from drugstools.pipeline import MANIFEST_NAME, Manifest, SamplePipeline, Stage, StageRunner
+from drugstools.pipeline_params import get_parser
+from drugstools import collapse, scatter
+from drugstools.scatter import ShardQueue
+from drugstools.synthetic import random_barcodes, write_gtf, write_pair, write_whitelist
+
+
+def copy_stage(tmp_path, calls, fail=False):
+    src, dst = str(tmp_path / "in.txt"), str(tmp_path / "out.txt")
+
+    def run():
+        calls.append("copy")
+        if fail:
+            raise RuntimeError("boom")
+        with open(src) as i, open(dst, "w") as o:
+            o.write(i.read().upper())
+
+    return Stage("copy", [src], [dst], {"upper": True}, [], run)
+
+
+def test_rerun_skips_up_to_date_stage(tmp_path):
+    (tmp_path / "in.txt").write_text("acgt")
+    calls = []
+    assert StageRunner(Manifest(str(tmp_path))).run(copy_stage(tmp_path, calls))
+    assert not StageRunner(Manifest(str(tmp_path))).run(copy_stage(tmp_path, calls))
+    assert calls == ["copy"]
+    assert StageRunner(Manifest(str(tmp_path)), force=True).run(copy_stage(tmp_path, calls))
+    assert calls == ["copy", "copy"]
+
+
+def test_changed_input_or_output_reruns(tmp_path):
+    (tmp_path / "in.txt").write_text("acgt")
+    calls = []
+    StageRunner(Manifest(str(tmp_path))).run(copy_stage(tmp_path, calls))
+    (tmp_path / "in.txt").write_text("ttttt")
+    runner = StageRunner(Manifest(str(tmp_path)))
+    assert runner.stale_reason(copy_stage(tmp_path, calls)).endswith("in.txt changed")
+    runner.run(copy_stage(tmp_path, calls))
+    assert (tmp_path / "out.txt").read_text() == "TTTTT"
+    os.remove(tmp_path / "out.txt")
+    assert StageRunner(Manifest(str(tmp_path))).run(copy_stage(tmp_path, calls))
+    assert calls == ["copy"] * 3
+
+
+def test_failed_stage_is_recorded_and_retried(tmp_path):
+    (tmp_path / "in.txt").write_text("acgt")
+    calls = []
+    with pytest.raises(RuntimeError):
+        StageRunner(Manifest(str(tmp_path))).run(copy_stage(tmp_path, calls, fail=True))
+    with open(tmp_path / MANIFEST_NAME) as handle:
+        assert json.load(handle)["stages"]["copy"]["status"] == "failed"
+    assert StageRunner(Manifest(str(tmp_path))).run(copy_stage(tmp_path, calls))
+    assert calls == ["copy", "copy"]
+
+
+def test_stage_names_follow_options():
+    class Options:
+        force = False
+    native = SamplePipeline(Options(), CountUMI("genes.gtf", "genome"), "out", "S1")
+    assert native.stage_names("all") == ["transform", "align", "assign", "count"]
+    streamed = SamplePipeline(Options(), CountUMI("genes.gtf", "genome", umi_counter="umi_tools"),
+                              "out", "S1", stream_star=True)
+    assert streamed.stage_names("count") == ["assign", "sort", "index", "count"]
+
+
+def test_run_metrics_recorded(tmp_path):
+    (tmp_path / "in.txt").write_text("acgt")
+    metrics = RunMetrics(str(tmp_path))
+    runner = StageRunner(Manifest(str(tmp_path)), metrics=metrics, profile_dir=str(tmp_path / "prof"))
+    stage = copy_stage(tmp_path, [])
+
+    def run():
+        stage.run()
+        return {"records": 4, "counters": {"kept": 3}}
+
+    counted = stage._replace(run=run, in_process=True)
+    runner.run(counted)
+    with open(tmp_path / "run_metrics.json") as handle:
+        entry = json.load(handle)["stages"]["copy"]
+    assert entry["status"] == "done"
+    assert entry["bytes_read"] == 4 and entry["bytes_written"] == 4
+    assert entry["records"] == 4 and entry["counters"] == {"kept": 3}
+    assert entry["wall_seconds"] >= 0 and entry["peak_rss_mb"] > 0
+    assert os.path.exists(entry["profile"])
+    runner.run(counted)
+    assert RunMetrics(str(tmp_path)).stages["copy"] == {"status": "skipped"}
+
+
+def run_stub_pipeline(tmp_path, monkeypatch, name, *extra):
+    reads = tmp_path / "reads"
+    if not reads.exists():
+        reads.mkdir()
+        barcodes = random_barcodes(8)
+        write_whitelist(str(tmp_path / "barcodes.txt"), barcodes)
+        write_pair(str(reads / "S_1.fastq.gz"), str(reads / "S_2.fastq.gz"), 2000, barcodes,
+                   duplicate_rate=0.6)
+        (tmp_path / "genome").mkdir()
+        write_gtf(str(tmp_path / "genes.gtf"))
+        monkeypatch.setenv("PATH", install_stub_tools(str(tmp_path / "bin")) + os.pathsep
+                           + os.environ["PATH"])
+    out = tmp_path / name
+    out.mkdir(exist_ok=True)
+    options, _ = get_parser().parse_args([
+        "-f", str(reads), "-b", str(tmp_path / "barcodes.txt"), "-o", str(out),
+        "-g", str(tmp_path / "genes.gtf"), "-d", str(tmp_path / "genome"),
+        "--decompressor", "gzip"] + list(extra))
+    pipeline = SamplePipeline(options, CountUMI.from_options(options), str(out), "S",
+                              str(reads / "S_1.fastq.gz"), str(reads / "S_2.fastq.gz"),
+                              BarcodeIndex(BCFunc.get_barcodes(options.barcode)),
+                              log_filename=str(out / "Druglog.txt"))
+    pipeline.run(pipeline.stage_names("all"))
+    with gzip.open(str(out / "S_counts.tsv.gz"), "rt") as handle:
+        counts = handle.read()
+    with open(str(out / "run_metrics.json")) as handle:
+        metrics = json.load(handle)["stages"]
+    return counts, metrics
+
+
+def test_collapsed_duplicates_count_the_same(tmp_path, monkeypatch):
+    plain, plain_metrics = run_stub_pipeline(tmp_path, monkeypatch, "plain")
+    collapsed, metrics = run_stub_pipeline(tmp_path, monkeypatch, "collapsed", "--collapse-duplicates")
+    assert collapsed == plain
+    assert metrics["count"]["records"] == plain_metrics["count"]["records"]
+    assert metrics["align"]["records"] < plain_metrics["align"]["records"] / 2
+
+
+def test_collapse_memory_cap_keeps_counts_exact(tmp_path, monkeypatch):
+    plain, plain_metrics = run_stub_pipeline(tmp_path, monkeypatch, "plain")
+    _, unbounded = run_stub_pipeline(tmp_path, monkeypatch, "unbounded", "--collapse-duplicates")
+    monkeypatch.setattr(collapse, "MAX_KEYS", 100)
+    capped, metrics = run_stub_pipeline(tmp_path, monkeypatch, "capped", "--collapse-duplicates")
+    assert capped == plain
+    assert (unbounded["align"]["records"] < metrics["align"]["records"]
+            < plain_metrics["align"]["records"])
+
+
+def test_builtin_assigner_fuses_assign_and_count(tmp_path, monkeypatch):
+    tagged, _ = run_stub_pipeline(tmp_path, monkeypatch, "tagged", "--assigner", "builtin",
+                                  "--umi-counter", "umi_tools")
+    fused, metrics = run_stub_pipeline(tmp_path, monkeypatch, "fused", "--assigner", "builtin",
+                                       "--umi-method", "unique")
+    assert fused == tagged
+    assert "assign" not in metrics and metrics["count"]["counters"]["Unassigned_Ambiguity"] > 0
+    assert not (tmp_path / "fused" / "S_Aligned.sortedByCoord.out.bam.featureCounts.bam").exists()
+    assert (tmp_path / "fused" / "gene_assigned.summary").exists()
+
+
+@pytest.mark.parametrize("extra", [[], ["--assigner", "builtin"], ["--collapse-duplicates"],
+                                   ["--shard-workers", "2"]])
+def test_sharded_counts_match_unsharded(tmp_path, monkeypatch, extra):
+    plain, _ = run_stub_pipeline(tmp_path, monkeypatch, "plain", *extra)
+    sharded, metrics = run_stub_pipeline(tmp_path, monkeypatch, "sharded", "--shards", "3", *extra)
+    assert sharded == plain
+    assert set(metrics) == {"transform", "scatter", "count"}
+    assert metrics["scatter"]["counters"]["shards"] == 3
+
+
+def test_intermediates_released_after_last_reader(tmp_path, monkeypatch):
+    kept, _ = run_stub_pipeline(tmp_path, monkeypatch, "kept", "--keep-temp-files")
+    released, metrics = run_stub_pipeline(tmp_path, monkeypatch, "released")
+    assert released == kept
+    out = tmp_path / "released"
+    for name in ["datanew_R1.fastq", "datanew_R2.fastq", "S_Aligned.sortedByCoord.out.bam"]:
+        assert (tmp_path / "kept" / name).exists() and not (out / name).exists()
+    with open(out / MANIFEST_NAME) as handle:
+        assert str(out / "datanew_R2.fastq") in json.load(handle)["released"]
+    assert all("peak_disk_mb" in entry for entry in metrics.values())
+    assert RunMetrics(str(out)).disk["released_mb"] > 0
+    _, rerun = run_stub_pipeline(tmp_path, monkeypatch, "released")
+    assert all(entry == {"status": "skipped"} for entry in rerun.values())
+
+
+def test_changed_count_option_recreates_released_inputs(tmp_path, monkeypatch):
+    unique, _ = run_stub_pipeline(tmp_path, monkeypatch, "unique", "--umi-method", "unique")
+    run_stub_pipeline(tmp_path, monkeypatch, "released")
+    disk = RunMetrics(str(tmp_path / "released")).disk
+    counts, metrics = run_stub_pipeline(tmp_path, monkeypatch, "released", "--umi-method", "unique")
+    assert counts == unique
+    assert metrics["transform"]["status"] == "done" and metrics["align"]["status"] == "done"
+    assert not (tmp_path / "released" / "datanew_R2.fastq").exists()
+    # The count stages alone rerun the transform when they are given the reads.
+    out = tmp_path / "released"
+    options, _ = get_parser().parse_args([
+        "-f", str(tmp_path / "reads"), "-b", str(tmp_path / "barcodes.txt"), "-o", str(out),
+        "-g", str(tmp_path / "genes.gtf"), "-d", str(tmp_path / "genome"),
+        "--decompressor", "gzip"])
+    pipeline = SamplePipeline(options, CountUMI.from_options(options), str(out), "S",
+                              str(tmp_path / "reads" / "S_1.fastq.gz"),
+                              str(tmp_path / "reads" / "S_2.fastq.gz"),
+                              BarcodeIndex(BCFunc.get_barcodes(options.barcode)),
+                              log_filename=str(out / "Druglog.txt"))
+    pipeline.run(pipeline.stage_names("count"), merge_disk=True)
+    merged = RunMetrics(str(out))
+    assert merged.stages["transform"]["status"] == "done"
+    assert merged.disk["released_mb"] > disk["released_mb"]
+
+
+def test_shard_queue_jobs_run_in_any_worker(tmp_path, monkeypatch):
+    plain, _ = run_stub_pipeline(tmp_path, monkeypatch, "plain")
+    queue = tmp_path / "queue"
+    queued, _ = run_stub_pipeline(tmp_path, monkeypatch, "queued", "--shards", "2",
+                                  "--shard-queue", str(queue))
+    assert queued == plain
+    assert len(os.listdir(queue / "done")) == 2 and not os.listdir(queue / "pending")
+
+
+def test_shard_queue_requeues_dead_workers_and_times_out(tmp_path, monkeypatch):
+    queue = ShardQueue(str(tmp_path / "queue"))
+    queue.submit("a", {})
+    assert queue.claim() == "a"
+    assert queue.requeue_stale(lease=60) == []
+    # The worker died: its job file stops being touched.
+    old = time.time() - 120
+    os.utime(queue.path("running", "a"), (old, old))
+    assert queue.requeue_stale(lease=60) == ["a"]
+    assert os.path.exists(queue.path("pending", "a"))
+
+    # A live worker holds the job past the deadline.
+    assert queue.claim() == "a"
+    with pytest.raises(RuntimeError, match="not done after"):
+        queue.wait(["a"], poll=0.01, timeout=0.1)
+
+    # A job requeued while its worker was still running is still marked done.
+    os.rename(queue.path("running", "a"), queue.path("pending", "a"))
+    monkeypatch.setattr(scatter, "run_shard", lambda job: os.rename(
+        queue.path("running", "a"), queue.path("pending", "a")))
+    queue.wait(["a"], poll=0.01, timeout=5)
+    assert os.path.exists(queue.path("done", "a"))
+    assert not os.path.exists(queue.path("pending", "a"))
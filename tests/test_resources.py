@@ -0,0 +1,58 @@
+import pytest
+
+from drugstools import resources
+from drugstools.countUMI import CountUMI
+from drugstools.pipeline_params import get_parser
+from drugstools.resources import GB, ResourcePlan
+
+
+def fake_cgroup(monkeypatch, files):
+    monkeypatch.setattr(resources, "_read", lambda path: files.get(path, "").split() or None)
+
+
+def test_cgroup_v2_limits(monkeypatch):
+    fake_cgroup(monkeypatch, {"/sys/fs/cgroup/cpu.max": "250000 100000",
+                              "/sys/fs/cgroup/memory.max": str(16 * GB),
+                              "/sys/fs/cgroup/memory.current": str(4 * GB)})
+    assert resources.cgroup_cpu_limit() == 3
+    assert resources.cgroup_memory_gb() == 12
+
+
+def test_cgroup_v1_unlimited(monkeypatch):
+    fake_cgroup(monkeypatch, {"/sys/fs/cgroup/cpu.max": "max 100000",
+                              "/sys/fs/cgroup/cpu/cpu.cfs_quota_us": "-1",
+                              "/sys/fs/cgroup/cpu/cpu.cfs_period_us": "100000",
+                              "/sys/fs/cgroup/memory/memory.limit_in_bytes": str(1 << 62)})
+    assert resources.cgroup_cpu_limit() is None
+    assert resources.cgroup_memory_gb() is None
+
+
+def test_plan_splits_node_between_concurrent_jobs():
+    options, _ = get_parser().parse_args(["--cores", "32", "--memory-gb", "128", "--shards", "8"])
+    plan = ResourcePlan.from_options(options, parallel=8)
+    # 128 GB fits four 32 GB STAR jobs.
+    assert plan.jobs == 4 and plan.star_threads == 8 and plan.featurecounts_threads == 8
+    assert plan.bam_sort_ram == 0
+    single = ResourcePlan.from_options(get_parser().parse_args(
+        ["--cores", "16", "--memory-gb", "64"])[0])
+    assert single.jobs == 1 and single.star_threads == 16
+    assert single.bam_sort_ram == 24 * GB and single.sort_memory_mb == 2048
+
+
+def test_plan_overrides_reach_the_tools():
+    options, _ = get_parser().parse_args([
+        "-g", "genes.gtf", "-d", "genome", "--cores", "8", "--memory-gb", "64",
+        "--umi-counter", "umi_tools", "--transform-workers", "3",
+        "--resources", "star_threads=6, sort_memory_mb=1000"])
+    plan = ResourcePlan.from_options(options)
+    assert plan.transform_workers == 3 and plan.star_threads == 6
+    count_umi = CountUMI.from_options(options, plan)
+    argv = count_umi.star_argv("in.fastq", "out", "S")
+    assert argv[argv.index("--runThreadN") + 1] == "6"
+    assert argv[argv.index("--limitBAMsortRAM") + 1] == str(plan.bam_sort_ram)
+    calls = []
+    count_umi._run = lambda stage, argv, *args: calls.append(argv)
+    count_umi.sort("out", "S", "log.txt")
+    assert calls[0][:6] == ["samtools", "sort", "-@", "7", "-m", "1000M"]
+    with pytest.raises(ValueError):
+        plan.override("star=4")
@@ -0,0 +1,52 @@
+import sys
+import time
+
+import pytest
+
+from drugstools.countUMI import CountUMI
+from drugstools.runner import CommandFailed, run_command, run_commands
+
+
+def py(code):
+    return [sys.executable, "-c", code]
+
+
+def test_captures_output_and_times(tmp_path):
+    result = run_command(py("import sys; print('out'); print('err', file=sys.stderr)"),
+                         name="S1_align", log_dir=str(tmp_path))
+    assert result.returncode == 0
+    assert (tmp_path / "S1_align.out").read_text() == "out\n"
+    assert (tmp_path / "S1_align.err").read_text() == "err\n"
+    assert result.wall_seconds > 0 and result.cpu_seconds > 0
+
+
+def test_nonzero_exit_raises(tmp_path):
+    with pytest.raises(CommandFailed, match="exit code 3") as e:
+        run_command(py("raise SystemExit(3)"), name="bad", log_dir=str(tmp_path))
+    assert e.value.result.returncode == 3
+    assert run_command(py("raise SystemExit(3)"), check=False).returncode == 3
+    with pytest.raises(CommandFailed, match="could not start"):
+        run_command(["no-such-tool-drugstools"])
+
+
+def test_timeout_stops_command():
+    start = time.time()
+    with pytest.raises(CommandFailed, match="timed out"):
+        run_command(py("import time; time.sleep(30)"), timeout=0.5)
+    assert time.time() - start < 10
+
+
+def test_independent_commands_overlap():
+    start = time.time()
+    results = run_commands([{"argv": py("import time; time.sleep(1)")} for _ in range(3)])
+    assert [r.returncode for r in results] == [0, 0, 0]
+    assert time.time() - start < 2.5
+
+
+def test_featurecounts_writes_into_output_dir():
+    argv = []
+    count_umi = CountUMI("genes.gtf", "genome")
+    count_umi._run = lambda stage, a, *rest: argv.extend(a)
+    count_umi.assign("out/S1", "S1", "log")
+    assert argv[argv.index("-o") + 1] == "out/S1/gene_assigned"
+    assert argv[argv.index("--Rpath") + 1] == "out/S1"
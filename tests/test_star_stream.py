@@ -0,0 +1,91 @@
+import io
+import os
+import stat
+import sys
+
+import pytest
+
+from drugstools.countUMI import CountUMI
+from drugstools.star_stream import StarFailed, StarStream
+from drugstools.transformer import Transformer
+
+FAKE_STAR = """#!{python}
+import sys
+args = sys.argv[1:]
+infile = args[args.index("--readFilesIn") + 1]
+prefix = args[args.index("--outFileNamePrefix") + 1]
+mode = {mode!r}
+if mode == "early":
+    sys.exit(3)
+if mode == "hang":
+    import os, time
+    with open(prefix + "pid", "w") as out:
+        out.write(str(os.getpid()))
+    print("aligning", flush=True)
+    reads = open(infile, "rb")
+    time.sleep(60)
+with open(infile, "rb") as reads:
+    if mode == "midway":
+        reads.read(10)
+        sys.exit(4)
+    data = reads.read()
+with open(prefix + "reads.txt", "wb") as out:
+    out.write(data)
+"""
+
+
+def fake_star(tmp_path, monkeypatch, mode):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    star = bindir / "STAR"
+    star.write_text(FAKE_STAR.format(python=sys.executable, mode=mode))
+    star.chmod(star.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(bindir) + os.pathsep + os.environ["PATH"])
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    return CountUMI("genes.gtf", "genome"), str(outdir)
+
+
+def test_reads_reach_star(tmp_path, monkeypatch):
+    count_umi, outdir = fake_star(tmp_path, monkeypatch, "ok")
+    log = str(tmp_path / "log.txt")
+    with StarStream(count_umi, outdir, "S1", log_filename=log) as handle:
+        handle.write(b"@r1\nACGT\n+\nFFFF\n")
+    with open(os.path.join(outdir, "S1_reads.txt"), "rb") as reads:
+        assert reads.read() == b"@r1\nACGT\n+\nFFFF\n"
+    assert not os.path.exists(os.path.join(outdir, "datanew_R2.fifo"))
+
+
+def test_star_exit_before_open(tmp_path, monkeypatch):
+    count_umi, outdir = fake_star(tmp_path, monkeypatch, "early")
+    with pytest.raises(StarFailed, match="code 3"):
+        with StarStream(count_umi, outdir, "S1", log_filename=str(tmp_path / "log.txt")):
+            pass
+
+
+def test_star_failure_aborts_transform(tmp_path, monkeypatch):
+    count_umi, outdir = fake_star(tmp_path, monkeypatch, "midway")
+    record = (b"@r1 1:N:0:A\n" + b"CAGTGGTATCAACGCAGAGTACAACGTGAT" + b"A" * 40 + b"\n+\n"
+              + b"F" * 70 + b"\n")
+    r2 = b"@r1 2:N:0:A\n" + b"A" * 50 + b"\n+\n" + b"F" * 50 + b"\n"
+    with pytest.raises(StarFailed, match="code 4"):
+        with StarStream(count_umi, outdir, "S1", log_filename=str(tmp_path / "log.txt")) as handle:
+            Transformer().transform(io.BytesIO(record * 50000), io.BytesIO(r2 * 50000),
+                                    ["GTACAACGTGAT"], outdir,
+                                    chunk_records=1000, r2_handle=handle)
+    assert not os.path.exists(os.path.join(outdir, "datanew_R2.fifo"))
+
+
+def test_failed_transform_terminates_star(tmp_path, monkeypatch):
+    count_umi, outdir = fake_star(tmp_path, monkeypatch, "hang")
+    log = str(tmp_path / "log.txt")
+    with pytest.raises(ValueError):
+        with StarStream(count_umi, outdir, "S1", log_filename=log):
+            raise ValueError("transform failed")
+    with open(os.path.join(outdir, "S1_pid")) as handle:
+        pid = int(handle.read())
+    # STAR itself was terminated and reaped, not a shell in front of it.
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+    with open(log) as handle:
+        assert "aligning" in handle.read()
@@ -0,0 +1,313 @@
+import gzip
+import io
+import json
+import os
+
+import pytest
+
+from drugstools.BCfunc import BarcodeIndex
+from drugstools.diagnostics import HeavyHitters, HyperLogLog, TransformSummary, hll_update
+from drugstools.synthetic import generate_reads, random_barcodes
+from drugstools.transformer import KEPT, Transformer
+from drugstools.trimming import R2Trimmer
+
+LINKER = "CAGTGGTATCAACGCAGA"
+BARCODES = ["GTACAACGTGAT", "GTACAAACATCG"]
+
+
+def make_pair(name, r1_seq, r2_seq="ACGTACGTACGTACGTACGT"):
+    r1 = f"@{name} 1:N:0:ACGT\n{r1_seq}\n+\n{'F' * len(r1_seq)}\n"
+    r2 = f"@{name} 2:N:0:ACGT\n{r2_seq}\n+\n{'F' * len(r2_seq)}\n"
+    return r1, r2
+
+
+def run_transform(tmp_path, pairs, barcodes=BARCODES, **kwargs):
+    r1 = "".join(p[0] for p in pairs).encode()
+    r2 = "".join(p[1] for p in pairs).encode()
+    Transformer().transform(io.BytesIO(r1), io.BytesIO(r2), barcodes, str(tmp_path), **kwargs)
+    out = {}
+    for name in ("datanew_R1.fastq", "datanew_R2.fastq", "Obread1.fastq", "Obread2.fastq"):
+        with open(os.path.join(str(tmp_path), name)) as handle:
+            out[name] = handle.read()
+    with open(os.path.join(str(tmp_path), "transform_summary.json")) as handle:
+        out["summary"] = json.load(handle)
+    if os.path.exists(os.path.join(str(tmp_path), "well_qc.tsv")):
+        with open(os.path.join(str(tmp_path), "well_qc.tsv")) as handle:
+            out["well_qc"] = [line.rstrip("\n").split("\t") for line in handle]
+    return out
+
+
+def legacy_transform(FRdata1, FRdata2, BClist, same_seq=LINKER):
+    """The str-based transform loop this package started from, for golden tests."""
+    outs = {name: [] for name in ("datanew_R1.fastq", "datanew_R2.fastq",
+                                  "Obread1.fastq", "Obread2.fastq")}
+    while True:
+        line1 = FRdata1.readline().rstrip().decode("utf-8")
+        if not line1:
+            break
+        line2 = FRdata1.readline().rstrip().decode("utf-8")
+        lineUMI_before = line2.split(same_seq)
+        line3 = FRdata1.readline().rstrip().decode("utf-8")
+        line4 = FRdata1.readline().rstrip().decode("utf-8")
+        line2_1 = FRdata2.readline().rstrip().decode("utf-8")
+        line2_2 = FRdata2.readline().rstrip().decode("utf-8")
+        line2_3 = FRdata2.readline().rstrip().decode("utf-8")
+        line2_4 = FRdata2.readline().rstrip().decode("utf-8")
+        if len(lineUMI_before) > 1:
+            lineUMI = lineUMI_before[1]
+            lineUMI2 = str(lineUMI)[0:12]
+            if lineUMI2 in BClist:
+                if len(lineUMI) > 23:
+                    tag = "_" + lineUMI2 + "_" + lineUMI[12:22]
+                    line1BC = line1.split(" ")[0] + tag + " " + line1.split(" ")[1]
+                    line2_1BC = line2_1.split(" ")[0] + tag + " " + line2_1.split(" ")[1]
+                    line2toBC = line2.split(same_seq)[1][22:]
+                    line4toBC = line4[len(line4) - len(line2toBC):]
+                    outs["datanew_R1.fastq"].append(
+                        line1BC + "\n" + line2toBC + "\n" + line3 + "\n" + line4toBC + "\n")
+                    outs["datanew_R2.fastq"].append(
+                        line2_1BC + "\n" + line2_2 + "\n" + line2_3 + "\n" + line2_4 + "\n")
+                else:
+                    outs["Obread1.fastq"].append(
+                        line1 + "\n" + line2 + "\n" + line3 + "\n" + line4 + "\n")
+                    outs["Obread2.fastq"].append(
+                        line2_1 + "\n" + line2_2 + "\n" + line2_3 + "\n" + line2_4 + "\n")
+    return {name: "".join(records).encode() for name, records in outs.items()}
+
+
+@pytest.mark.parametrize("workers,chunk_records", [(1, 100000), (1, 7), (2, 53)])
+def test_output_matches_legacy_transform(tmp_path, workers, chunk_records):
+    barcodes = random_barcodes(24)
+    pairs = list(generate_reads(3000, barcodes, linker_rate=0.8, barcode_error_rate=0.2,
+                                short_rate=0.1, seed=7))
+    pairs += [
+        # A second linker: the legacy split()[1] stops at it.
+        make_pair("two", "AC" + LINKER + barcodes[0] + "AAAAACCCCC" + "GGTTCC" + LINKER + "TTTT"),
+        # UMI segment of exactly 23 and 24 bases around the short-read cut.
+        make_pair("b23", LINKER + barcodes[1] + "A" * 11),
+        make_pair("b24", LINKER + barcodes[1] + "A" * 12),
+        # Linker at the very end, and a barcode cut short by the read end.
+        make_pair("end", "ACGT" + LINKER),
+        make_pair("cut", LINKER + barcodes[2][:8]),
+    ]
+    r1 = "".join(p[0] for p in pairs).encode()
+    r2 = "".join(p[1] for p in pairs).encode()
+    expected = legacy_transform(io.BytesIO(r1), io.BytesIO(r2), set(barcodes))
+    Transformer().transform(io.BytesIO(r1), io.BytesIO(r2), barcodes, str(tmp_path),
+                            workers=workers, chunk_records=chunk_records)
+    for name, data in expected.items():
+        with open(os.path.join(str(tmp_path), name), "rb") as handle:
+            assert handle.read() == data, name
+    assert expected["datanew_R1.fastq"] and expected["Obread1.fastq"]
+
+
+def test_exact_barcode_is_tagged(tmp_path):
+    cdna = "TTTTGGGGCCCCAAAATTTTGGGG"
+    pair = make_pair("r1", "AC" + LINKER + BARCODES[0] + "AAAAACCCCC" + cdna)
+    out = run_transform(tmp_path, [pair])
+    assert out["datanew_R1.fastq"].splitlines()[:2] == [
+        "@r1_" + BARCODES[0] + "_AAAAACCCCC 1:N:0:ACGT", cdna]
+    assert out["datanew_R2.fastq"].startswith("@r1_" + BARCODES[0] + "_AAAAACCCCC 2:N:0:ACGT\n")
+
+
+def test_plain_list_does_not_correct(tmp_path):
+    pair = make_pair("r1", LINKER + "GTACAACGTGAA" + "AAAAACCCCC" + "TTTTGGGG")
+    out = run_transform(tmp_path, [pair])
+    assert out["datanew_R1.fastq"] == ""
+    assert out["summary"]["unmatched_barcodes"] == [{"barcode": "GTACAACGTGAA", "count": 1}]
+
+
+def test_index_corrects_single_mismatch(tmp_path):
+    pair = make_pair("r1", LINKER + "GTACAACGTGAA" + "AAAAACCCCC" + "TTTTGGGG")
+    out = run_transform(tmp_path, [pair], barcodes=BarcodeIndex(BARCODES))
+    assert out["datanew_R1.fastq"].startswith("@r1_GTACAACGTGAT_AAAAACCCCC 1:N:0:ACGT\n")
+
+
+def test_short_umi_goes_to_obread(tmp_path):
+    pair = make_pair("r1", LINKER + BARCODES[1] + "AAAAACCCCC")
+    out = run_transform(tmp_path, [pair])
+    assert out["datanew_R1.fastq"] == ""
+    assert out["Obread1.fastq"] == pair[0]
+    assert out["Obread2.fastq"] == pair[1]
+    assert out["summary"]["counters"]["obread"] == 1
+
+
+def test_parallel_matches_serial(tmp_path):
+    pairs = []
+    for i in range(50):
+        tail = "ACGT" * (i % 8)
+        pairs.append(make_pair("r%d" % i, LINKER + BARCODES[i % 2] + "AAAAACCCCC" + tail))
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "parallel").mkdir()
+    serial = run_transform(tmp_path / "serial", pairs)
+    parallel = run_transform(tmp_path / "parallel", pairs, workers=2, chunk_records=7)
+    assert serial == parallel
+
+
+def test_compressed_output(tmp_path):
+    pair = make_pair("r1", LINKER + BARCODES[0] + "AAAAACCCCC" + "TTTTGGGG")
+    Transformer().transform(io.BytesIO(pair[0].encode()), io.BytesIO(pair[1].encode()),
+                            BARCODES, str(tmp_path), compress_level=6)
+    with gzip.open(str(tmp_path / "datanew_R2.fastq.gz"), "rt") as handle:
+        assert handle.read().startswith("@r1_" + BARCODES[0] + "_AAAAACCCCC 2:N:0:ACGT\n")
+    assert not (tmp_path / "datanew_R2.fastq").exists()
+
+
+def test_transform_returns_read_counters(tmp_path):
+    pairs = [
+        make_pair("kept", LINKER + BARCODES[0] + "AAAAACCCCC" + "TTTTGGGGCCCC"),
+        make_pair("short", LINKER + BARCODES[1] + "AAAAACCCCC"),
+        make_pair("miss", LINKER + "CCCCCCCCCCCC" + "AAAAACCCCC" + "TTTTGGGG"),
+        make_pair("nolinker", "ACGT" * 10),
+    ]
+    r1 = "".join(p[0] for p in pairs).encode()
+    r2 = "".join(p[1] for p in pairs).encode()
+    stats = Transformer().transform(io.BytesIO(r1), io.BytesIO(r2), BARCODES, str(tmp_path),
+                                    chunk_records=3)
+    assert stats == {"reads": 4, "kept": 1, "obread": 1, "barcode_miss": 1, "no_linker": 1}
+
+
+def test_unmatched_summary_is_bounded_and_sampled(tmp_path):
+    # Two frequent unmatched barcodes and 16 singletons.
+    singletons = ["GGGGGGGG" + a + c + g + t for a in "AC" for c in "AC" for g in "AC" for t in "AC"]
+    misses = ["CCCCCCCCCCCC"] * 5 + ["AAAAAAAAAAAA"] * 3 + singletons
+    pairs = [make_pair(f"m{i}", LINKER + bc + "A" * 30) for i, bc in enumerate(misses)]
+    pairs += [make_pair(f"n{i}", "ACGT" * 10) for i in range(20)]
+    (tmp_path / "serial").mkdir()
+    (tmp_path / "parallel").mkdir()
+    serial = run_transform(tmp_path / "serial", pairs, top_barcodes=2, sample_reads=4)["summary"]
+    assert serial["unmatched_barcodes"] == [{"barcode": "CCCCCCCCCCCC", "count": 5},
+                                            {"barcode": "AAAAAAAAAAAA", "count": 3}]
+    assert serial["counters"]["barcode_miss"] == len(misses)
+    assert serial["counters"]["no_linker"] == 20
+    assert len(serial["sampled_reads"]) == 4
+    parallel = run_transform(tmp_path / "parallel", pairs, top_barcodes=2, sample_reads=4,
+                             workers=2, chunk_records=7)["summary"]
+    assert parallel == serial
+
+
+def test_heavy_hitters_stay_bounded():
+    hitters = HeavyHitters(capacity=3)
+    hitters.update({b"A": 100, b"B": 80})
+    for i in range(100):
+        hitters.update({b"x%d" % i: 1})
+    assert len(hitters.counts) <= 3
+    assert [key for key, _ in hitters.top(2)] == [b"A", b"B"]
+    assert hitters.counts[b"A"] == 100 - hitters.error
+
+
+def test_r2_trimmer_steps():
+    trimmer = R2Trimmer(quality=20, adapter="CTGTCTCTTATACACATCT", polya=True)
+    good, bad = b"I" * 30, b"#" * 5
+    assert trimmer.trim(b"C" * 35, good + bad) == 30
+    assert trimmer.trim(b"ACGT" * 5 + b"CTGTCTCTTATA" + b"GG", b"I" * 34) == 20
+    # A 3' partial adapter of at least min_overlap bases.
+    assert trimmer.trim(b"ACGT" * 5 + b"CTGT", b"I" * 24) == 20
+    # PolyA with one sequencing error inside the tail.
+    assert trimmer.trim(b"ACGT" * 5 + b"AAAAAGAAAAAAAA", b"I" * 34) == 20
+    assert trimmer.trim(b"ACGT" * 5 + b"AAAA", b"I" * 24) == 24
+
+
+def test_transform_trims_r2_and_drops_short_reads(tmp_path):
+    umi = "AAAAACCCCC"
+    cdna = "ACGTACGTTTGGCCAAGGTT"
+    pairs = [make_pair("keep", LINKER + BARCODES[0] + umi + "TTTTGGGGCC", cdna + "A" * 15),
+             make_pair("drop", LINKER + BARCODES[0] + umi + "TTTTGGGGCC", "ACGTA" + "A" * 30)]
+    trimmer = R2Trimmer(polya=True, min_length=10)
+    out = run_transform(tmp_path, pairs, trimmer=trimmer)
+    assert out["datanew_R2.fastq"].splitlines()[1:4] == [cdna, "+", "F" * len(cdna)]
+    assert "@drop" not in out["datanew_R1.fastq"] + out["datanew_R2.fastq"]
+    counters = out["summary"]["counters"]
+    assert counters["kept"] == 1 and counters["obread"] == 0
+    assert counters["trimmed_too_short"] == 1 and counters["trimmed_bases"] == 15
+
+
+def test_hyperloglog_estimate_and_merge():
+    halves = [{}, {}]
+    for i in range(20000):
+        hll_update(halves[i % 2], b"UMI%d" % i)
+    sketch = HyperLogLog()
+    for half in halves:
+        sketch.merge(half)
+    assert abs(sketch.estimate() - 20000) < 20000 * 0.05
+    small = HyperLogLog()
+    small.merge(halves[0])
+    assert abs(small.estimate() - 10000) < 10000 * 0.05
+
+
+def test_transform_writes_well_qc(tmp_path):
+    barcodes = BARCODES + ["GTACATGCCTAA"]
+    cdna = "TTTTGGGGCC"
+    pairs = [make_pair("a%d" % i, LINKER + BARCODES[0] + "AAAAACCC%02d" % (i % 5) + cdna)
+             for i in range(20)]
+    pairs += [make_pair("b%d" % i, LINKER + BARCODES[1] + "AAAAACCC%02d" % i + cdna)
+              for i in range(4)]
+    out = run_transform(tmp_path, pairs, barcodes=barcodes, chunk_records=7, well_qc=True)
+    assert out["well_qc"] == [
+        ["barcode", "reads", "umis_estimate", "saturation", "flag"],
+        [BARCODES[0], "20", "5", "0.7500", ""],
+        [BARCODES[1], "4", "4", "0.0000", ""],
+        ["GTACATGCCTAA", "0", "0", "0.0000", "low_reads"],
+    ]
+    assert out["summary"]["well_qc"]["low_wells"] == ["GTACATGCCTAA"]
+    assert out["summary"]["well_qc"]["saturation"] == round(1 - 9 / 24, 4)
+    (tmp_path / "off").mkdir()
+    assert "well_qc" not in run_transform(tmp_path / "off", pairs)
+
+
+def test_stream_yields_tagged_pairs_without_files(tmp_path):
+    pairs = [
+        make_pair("kept", LINKER + BARCODES[0] + "AAAAACCCCC" + "TTTTGGGGCCCC"),
+        make_pair("short", LINKER + BARCODES[1] + "AAAAACCCCC"),
+        make_pair("miss", LINKER + "CCCCCCCCCCCC" + "AAAAACCCCC" + "TTTTGGGG"),
+        make_pair("nolinker", "ACGT" * 10),
+    ] * 3
+    records = [(r1.encode(), r2.encode()) for r1, r2 in pairs]
+    summary = TransformSummary()
+    streamed = list(Transformer().stream(pairs=iter(records), BClist=BARCODES, chunk_records=5,
+                                         summary=summary))
+    assert sorted(p.disposition for p in streamed) == sorted(
+        ["kept", "obread", "barcode_miss", "no_linker"] * 3)
+    kept = [p for p in streamed if p.disposition == KEPT]
+    assert kept[0].barcode == BARCODES[0].encode() and kept[0].umi == b"AAAAACCCCC"
+    assert {p.r1 for p in streamed if p.disposition == "no_linker"} == {records[3][0]}
+    assert summary.counters == {"reads": 12, "kept": 3, "obread": 3, "barcode_miss": 3,
+                                "no_linker": 3}
+    out = run_transform(tmp_path, pairs)
+    assert "".join(p.r1.decode() for p in kept) == out["datanew_R1.fastq"]
+    assert "".join(p.r2.decode() for p in kept) == out["datanew_R2.fastq"]
+    r1 = io.BytesIO(b"".join(r[0] for r in records))
+    r2 = io.BytesIO(b"".join(r[1] for r in records))
+    parallel = Transformer().stream(r1, r2, BARCODES, workers=2, chunk_records=5)
+    assert [(p.disposition, p.r1, p.r2) for p in parallel] == \
+        [(p.disposition, p.r1, p.r2) for p in streamed]
+
+
+def test_fraction_keeps_the_same_pairs_on_every_run(tmp_path):
+    pairs = [make_pair("r%d" % i, LINKER + BARCODES[i % 2] + "AAAAACCCCC" + "TTTTGGGG")
+             for i in range(400)]
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    first = run_transform(tmp_path / "a", pairs, fraction=0.25)
+    second = run_transform(tmp_path / "b", pairs, fraction=0.25, workers=2, chunk_records=33)
+    assert first == second
+    counters = first["summary"]["counters"]
+    assert counters["reads"] == 400 and counters["obread"] == 0
+    assert counters["kept"] + counters["subsampled_out"] == 400
+    assert 60 < counters["kept"] < 140
+    # A whitespace-only header (malformed input) is hashed, not a crash.
+    blank = ("   \n" + LINKER + "\n+\n" + "F" * len(LINKER) + "\n", pairs[0][1])
+    (tmp_path / "c").mkdir()
+    counters = run_transform(tmp_path / "c", pairs[:3] + [blank], fraction=0.25)["summary"]["counters"]
+    assert counters["reads"] == 4
+
+
+def test_max_reads_stops_reading_early(tmp_path):
+    pairs = [make_pair("r%d" % i, LINKER + BARCODES[0] + "AAAAACCCCC" + "TTTTGGGG")
+             for i in range(100)]
+    r1 = io.BytesIO("".join(p[0] for p in pairs).encode())
+    r2 = io.BytesIO("".join(p[1] for p in pairs).encode())
+    stats = Transformer().transform(r1, r2, BARCODES, str(tmp_path), chunk_records=7,
+                                    max_reads=30)
+    assert stats["reads"] == 30 and stats["kept"] == 30
+    assert r1.tell() < len(r1.getvalue()) and r2.tell() < len(r2.getvalue())